@@ -1,4 +1,6 @@
+import asyncio
 import json
+import time
 
 from typing import TYPE_CHECKING, Optional
 
@@ -14,6 +16,7 @@ from constants import (
     ALPACA_INPUT_STRING,
     ALPACA_ANSWER_STRING,
     DEFAULT_ACTION_TIMEOUT_SECONDS,
+    DISCORD_EDIT_INTERVAL_SECONDS,
     DISCORD_EMBED_MAX_LENGTH,
     DISCORD_MESSAGE_MAX_LENGTH,
     DEFAULT_MAX_TOKENS,
@@ -22,7 +25,17 @@ from constants import (
     JSON_CHAT_FILE_FN,
     PROMPT_IN_TRUNCATION_LENGTH,
 )
+from llama_model.cancellation import (
+    CANCEL_ABANDONED,
+    CANCEL_DELETED,
+    CancellationToken,
+    GenerationCancelled,
+)
+from llama_model.metrics import LATENCY_BUCKETS, REGISTRY
+from llama_model.result import FINISH_CANCELLED
+from llama_model.tracing import Trace
 from ui import (
+    CancelButton,
     ChatButtons,
 )
 from util import (
@@ -36,6 +49,24 @@ from util import (
 
 if TYPE_CHECKING:
     from ..client import YALClient
+    from llama_model.batching import GenerationResult
+    from llama_model.stream import TokenStream
+    from scheduler import Job
+
+
+OUTCOME_CANCELLED = 'cancelled'
+OUTCOME_COMPLETED = 'completed'
+OUTCOME_ERROR = 'error'
+OUTCOME_REJECTED = 'rejected'
+OUTCOME_TIMEOUT = 'timeout'
+
+PROMPTS = REGISTRY.counter('yal_prompts_total',
+    'Prompts that were admitted, by how they ended.', ('outcome',))
+GENERATION_SECONDS = REGISTRY.histogram('yal_prompt_generation_seconds',
+    'Seconds from starting to generate for a prompt to its reply.',
+    buckets=LATENCY_BUCKETS)
+DISCORD_EDIT_FAILURES = REGISTRY.counter('yal_discord_edit_failures_total',
+    'Failed edits of work messages.')
 
 
 def create_embed_for_prompt_and_response(
@@ -109,6 +140,127 @@ async def send_alert_message(
     await channel.send(f'Job completed for <@{author_id}>.', embed=embed)
 
 
+async def stream_output_to_message(
+    stream: 'TokenStream',
+    work_msg: discord.Message,
+    author_id: str,
+    span: dict|None=None,
+) -> 'GenerationResult':
+    '''
+    Progressively edit work_msg with the text of stream as it is generated
+    and return the final result. Edits are coalesced to at most one every
+    DISCORD_EDIT_INTERVAL_SECONDS to stay within Discord's rate limits. The
+    number and total seconds of the edits are set on span.
+    '''
+    if span is None:
+        span = {}
+    span['edits'] = 0
+    span['edit_seconds'] = 0.
+    text = ''
+    last_edit = 0.
+    async for delta in stream:
+        text += delta
+        now = time.monotonic()
+        if now - last_edit < DISCORD_EDIT_INTERVAL_SECONDS or \
+            text.strip() == '':
+            continue
+        last_edit = now
+
+        partial = text
+        if len(partial) > DISCORD_EMBED_MAX_LENGTH:
+            partial = '...' + partial[-DISCORD_EMBED_MAX_LENGTH + 3:]
+        embed = discord.Embed()
+        embed.add_field(name='Output', value=partial, inline=False)
+        try:
+            await work_msg.edit(
+                content=f'Generating text for <@{author_id}>...',
+                embed=embed)
+        except discord.HTTPException as e:
+            DISCORD_EDIT_FAILURES.inc()
+            print(f'Failed to update message while streaming: {e}')
+        span['edits'] += 1
+        span['edit_seconds'] += time.monotonic() - now
+
+    return await stream.result()
+
+
+def queued_message(
+    author_id: str,
+    position: int,
+    eta: float|None=None,
+) -> str:
+    message = f'Your prompt is number {position} in the queue, <@{author_id}>. Please be patient until I get to it.'
+    if eta is not None:
+        message += f' It should start in about {format_eta(eta)}.'
+    return message
+
+
+def format_eta(seconds: float) -> str:
+    if seconds < 90:
+        return f'{max(1, round(seconds))} seconds'
+    return f'{round(seconds / 60)} minutes'
+
+
+async def wait_for_turn(
+    context: 'YALClient',
+    job: 'Job',
+    work_msg: discord.Message,
+    author_id: str,
+    cancel_token: CancellationToken,
+) -> bool:
+    '''
+    Wait until the scheduler admits job, keeping its place in the queue
+    shown in work_msg. Returns False if the prompt was cancelled meanwhile.
+    '''
+    position = context.scheduler.position(job) # type: ignore
+    while not await context.scheduler.wait(job, # type: ignore
+        timeout=DISCORD_EDIT_INTERVAL_SECONDS):
+        if cancel_token.cancelled:
+            return False
+        new_position = context.scheduler.position(job) # type: ignore
+        if new_position == position:
+            continue
+        position = new_position
+        try:
+            await work_msg.edit(content=queued_message(author_id, position, # type: ignore
+                context.scheduler.start_eta(job))) # type: ignore
+        except discord.HTTPException as e:
+            print(f'Failed to update queue position: {e}')
+    try:
+        await work_msg.edit(
+            content=f'Now beginning work on new prompt for <@{author_id}>. Please be patient until I finish that.')
+    except discord.HTTPException as e:
+        print(f'Failed to update queue position: {e}')
+    return True
+
+
+async def finish_cancelled(
+    work_msg: discord.Message,
+    author_id: str,
+    cancel_token: CancellationToken,
+    partial_output: str='',
+):
+    '''
+    Show that the prompt of work_msg was cancelled, with the text generated
+    until then.
+    '''
+    if cancel_token.reason == CANCEL_DELETED:
+        return
+    embed = None
+    if partial_output.strip() != '':
+        if len(partial_output) > DISCORD_EMBED_MAX_LENGTH:
+            partial_output = '...' + \
+                partial_output[-DISCORD_EMBED_MAX_LENGTH + 3:]
+        embed = discord.Embed()
+        embed.add_field(name='Output', value=partial_output, inline=False)
+    try:
+        await work_msg.edit(
+            content=f'Text generation for <@{author_id}> was cancelled.',
+            embed=embed, view=None)
+    except discord.HTTPException as e:
+        print(f'Failed to update cancelled message: {e}')
+
+
 def serialize_to_json_and_store_request(
     prompt: str,
     output: str,
@@ -140,6 +292,7 @@ async def run_prompt(
     bypass_alpaca_formatting: bool=False,
     input_string: str|None=None,
     max_tokens: int=DEFAULT_MAX_TOKENS,
+    parent_short_id: str|None=None,
     temperature: float=DEFAULT_TEMPERATURE,
     top_p: float=DEFAULT_TOP_P,
 ):
@@ -149,75 +302,138 @@ async def run_prompt(
         return
 
     short_id = short_id_generator()
+    # Spans of every stage, written to the trace log under short_id.
+    trace = Trace(short_id, user_id=author_id, channel_id=str(channel.id),
+        parent_short_id=parent_short_id, max_tokens=max_tokens)
 
-    prompt = await context.prompt_check_fn(prompt, author_id, channel) # type: ignore
+    with trace.span('prompt_check'):
+        prompt = await context.prompt_check_fn(prompt, author_id, channel) # type: ignore
     if prompt is False:
+        trace.finish(outcome=OUTCOME_REJECTED)
         return
 
-    if not await check_user_joined_at(context.cli_args.hours_needed, channel, # type: ignore
-        user):
+    with trace.span('check_user_joined_at'):
+        joined = await check_user_joined_at(context.cli_args.hours_needed, # type: ignore
+            channel, user)
+    if not joined:
+        trace.finish(outcome=OUTCOME_REJECTED)
         return
 
     queue_message = prompt
-    if not await check_queue_and_maybe_write_to(context, channel, author_id,
-        queue_message):
+    with trace.span('queue_submit'):
+        job = await check_queue_and_maybe_write_to(context, channel,
+            author_id, queue_message, prompt, max_tokens)
+    if job is None:
+        trace.finish(outcome=OUTCOME_REJECTED)
         return
-
-    if '### Input:' not in prompt and \
-        context.cli_args.alpaca and \
-        input_string is None and \
-        not bypass_alpaca_formatting:
-        prompt = ALPACA_INSTRUCT_STRING + prompt + ALPACA_ANSWER_STRING
-        prompt = ALPACA_PREFIX_NO_INPUT_STRING + prompt
-
-    if '### Input:' not in prompt and \
-        context.cli_args.alpaca and \
-        input_string is not None and \
-        not bypass_alpaca_formatting: # type: ignore
-        prompt = ALPACA_INSTRUCT_STRING + prompt + \
-            ALPACA_INPUT_STRING + input_string + \
-            ALPACA_ANSWER_STRING
-        prompt = ALPACA_PREFIX_INPUT_STRING + prompt
-
-    work_msg = await channel.send(
-        f'Now beginning work on new prompt for <@{author_id}>. Please be patient until I finish that.')
+    if job.shortened:
+        await channel.send(f'I am busy right now, so your prompt will generate at most {job.max_tokens} tokens instead of {max_tokens} to finish in time, <@{author_id}>.',
+            delete_after=10)
+
+    with trace.span('template'):
+        if '### Input:' not in prompt and \
+            context.cli_args.alpaca and \
+            input_string is None and \
+            not bypass_alpaca_formatting:
+            prompt = ALPACA_INSTRUCT_STRING + prompt + ALPACA_ANSWER_STRING
+            prompt = ALPACA_PREFIX_NO_INPUT_STRING + prompt
+
+        if '### Input:' not in prompt and \
+            context.cli_args.alpaca and \
+            input_string is not None and \
+            not bypass_alpaca_formatting: # type: ignore
+            prompt = ALPACA_INSTRUCT_STRING + prompt + \
+                ALPACA_INPUT_STRING + input_string + \
+                ALPACA_ANSWER_STRING
+            prompt = ALPACA_PREFIX_INPUT_STRING + prompt
+
+    cancel_token = CancellationToken()
+    work_msg = None
+    new_tokens = None
+    outcome = OUTCOME_ERROR
     try:
+        cancel_view = CancelButton(cancel_token=cancel_token, uid=user.id)
+        position = context.scheduler.position(job) # type: ignore
+        if position is None:
+            with trace.span('discord_send_work_message'):
+                work_msg = await channel.send(
+                    f'Now beginning work on new prompt for <@{author_id}>. Please be patient until I finish that.',
+                    view=cancel_view)
+            context.active_generations[work_msg.id] = cancel_token # type: ignore
+        else:
+            with trace.span('discord_send_work_message'):
+                work_msg = await channel.send(queued_message(author_id,
+                    position, context.scheduler.start_eta(job)), # type: ignore
+                    view=cancel_view)
+            context.active_generations[work_msg.id] = cancel_token # type: ignore
+            with trace.span('queue_wait', position=position):
+                admitted = await wait_for_turn(context, job, work_msg,
+                    author_id, cancel_token)
+            if not admitted:
+                outcome = OUTCOME_CANCELLED
+                await finish_cancelled(work_msg, author_id, cancel_token)
+                return None
         async with timeout(DEFAULT_ACTION_TIMEOUT_SECONDS):
-            output = prompt
-            tries = 0
-
-            # Try to ignore it when it simply yield EOT for some input.
-            while output == prompt:
-                if tries >= 5:
-                    output = 'Sorry, I don\'t know how to answer this prompt.'
-                    break
-
-                output = await context.llama_engine.predict_text(prompt, # type: ignore
-                    max_tokens, temperature, top_p)
-
-                tries += 1
-
-            output_embed = create_embed_for_prompt_and_response(prompt, output,
-                input_string=input_string,
-                is_alpaca=context.cli_args.alpaca) # type: ignore
-
-            serialize_to_json_and_store_request(prompt, output, short_id,
-                user.id,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p)
-
-            btns = ChatButtons(context=context, message_id=work_msg.id,
-                short_id_parent=short_id, uid=user.id)
-            btns.serialize_to_json_and_store(context.button_store_dict) # type: ignore
+            # Stop tokens are masked until --min-new-tokens have been
+            # generated, so a single generation is enough.
+            started = time.monotonic()
+            with trace.span('generate', max_tokens=job.max_tokens) as span:
+                stream = context.llama_engine.stream_text(prompt, # type: ignore
+                    job.max_tokens, temperature, top_p,
+                    request_id=short_id,
+                    parent_id=parent_short_id,
+                    cancel_token=cancel_token)
+                result = await stream_output_to_message(stream, work_msg,
+                    author_id, span=span)
+            trace.extend(result.spans)
+            trace.attrs.update({key: value
+                for key, value in result.counts().items() if key != 'spans'})
+            if result.finish_reason == FINISH_CANCELLED:
+                outcome = OUTCOME_CANCELLED
+                await finish_cancelled(work_msg, author_id, cancel_token,
+                    result.new_text)
+                return None
+            new_tokens = result.new_tokens
+            GENERATION_SECONDS.observe(time.monotonic() - started)
+            output = result.text
+            if result.stopped_early:
+                output = 'Sorry, I don\'t know how to answer this prompt.'
+
+            with trace.span('embed'):
+                output_embed = create_embed_for_prompt_and_response(prompt,
+                    output,
+                    input_string=input_string,
+                    is_alpaca=context.cli_args.alpaca) # type: ignore
+
+            with trace.span('persist'):
+                serialize_to_json_and_store_request(prompt, output, short_id,
+                    user.id,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    top_p=top_p)
+
+                btns = ChatButtons(context=context, message_id=work_msg.id,
+                    short_id_parent=short_id, uid=user.id)
+                btns.serialize_to_json_and_store(context.button_store_dict) # type: ignore
             context.add_view(btns, message_id=work_msg.id)
-            work_msg = await work_msg.edit(
-                content=f'Text generation for <@{author_id}> complete.',
-                embed=output_embed,
-                view=btns)
-
-            await send_alert_message(channel, author_id, work_msg)
+            with trace.span('discord_edit_result'):
+                work_msg = await work_msg.edit(
+                    content=f'Text generation for <@{author_id}> complete.',
+                    embed=output_embed,
+                    view=btns)
+
+            outcome = OUTCOME_COMPLETED
+            with trace.span('discord_send_alert'):
+                await send_alert_message(channel, author_id, work_msg)
+    except GenerationCancelled:
+        # Cancelled before it started generating.
+        outcome = OUTCOME_CANCELLED
+        await finish_cancelled(work_msg, author_id, cancel_token) # type: ignore
+        return None
     except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            outcome = OUTCOME_TIMEOUT
+        trace.attrs['error'] = f'{type(e).__name__}: {e}'
         import traceback
         traceback.print_exc()
         await channel.send(f'Got unknown error on prompt "{prompt}" type {type(e).__name__}!')
@@ -230,6 +446,13 @@ async def run_prompt(
                 ```
                 ''')
     finally:
-        complete_request(context, author_id, queue_message)
+        # Does nothing once the generation finished, otherwise (a timeout or
+        # an error) stops it so it does not hold a slot of the batch.
+        cancel_token.cancel(CANCEL_ABANDONED)
+        PROMPTS.inc(outcome=outcome)
+        trace.finish(outcome=outcome)
+        if work_msg is not None:
+            context.active_generations.pop(work_msg.id, None) # type: ignore
+        complete_request(context, job, new_tokens)
 
     return short_id
@@ -0,0 +1,639 @@
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import pathlib
+import random
+import re
+import time
+
+from argparse import Namespace
+from typing import Any
+
+import discord
+import torch
+
+import actions
+from client import YALClient
+from constants import (
+    ALPACA_ANSWER_STRING,
+    ALPACA_INPUT_STRING,
+    ALPACA_PINNED_PREFIXES,
+    ALPACA_PROMPT_TEMPLATES,
+    ALPACA_TURN_MARKERS,
+    BUTTON_STORE_CHAT_BUTTONS_KEY,
+    DEFAULT_ACTION_TIMEOUT_SECONDS,
+    DEFAULT_MAX_TOKENS,
+    DEFAULT_TEMPERATURE,
+    DEFAULT_TOP_P,
+    MAX_TOKENS_MAX,
+    MAX_TOKENS_MIN,
+    TEMP_JSON_STORAGE_FOLDER,
+)
+from llama_model.engine import LlamaEngine
+from llama_model.profiling import random_quantize
+from llama_model.tracing import TraceLog, set_trace_log
+from scheduler import FairShareScheduler
+from ui import ChatButtons
+
+
+# Words of the synthetic prompts, and so the vocabulary of the tiny model.
+WORDS = '''
+the of and to a in is it you that he was for on are with as I his they be
+at one have this from or had by hot word but what some we can out other were
+all there when up use your how said an each she which do their time if will
+way about many then them write would like so these her long make thing see
+him two has look more day could go come did number sound no most people my
+over know water than call first who may down side been now find any new work
+part take get place made live where after back little only round man year
+came show every good me give our under name very through just form sentence
+great think say help low line differ turn cause much mean before move right
+boy old too same tell does set three want air well also play small end put
+home read hand port large spell add even land here must big high such follow
+act why ask men change went light kind off need house picture try us again
+animal point mother world near build self earth father head stand own page
+should country found answer school grow study still learn plant cover food
+sun four between state keep eye never last let thought city tree cross farm
+hard start might story saw far sea draw left late run while press close night
+real life few north poem recipe explain summarize translate list describe
+'''.split()
+
+SPECIAL_PIECES = ['<unk>', '<s>', '</s>']
+UNK_ID = 0
+BOS_ID = 1
+
+_PIECE = re.compile(r'\n| ?[^\s]+|[^\S\n]')
+
+
+class WordTokenizer():
+    '''
+    Splits text into words with their leading space, like SentencePiece,
+    out of a fixed vocabulary so a randomly initialized model can be served.
+    Anything else is <unk>. About as many characters per token as LLaMA, so
+    the estimates of the scheduler hold.
+    '''
+    is_fast = False
+
+    def __init__(self, texts: list[str]):
+        words = set(WORDS)
+        for text in texts:
+            words.update(piece.strip() for piece in _PIECE.findall(text))
+        words.discard('')
+        self.pieces = SPECIAL_PIECES + ['\n', ' '] + \
+            [prefix + word for word in sorted(words) for prefix in ('', ' ')]
+        self.ids = {piece: idx for idx, piece in enumerate(self.pieces)}
+        self.eos_token_id = SPECIAL_PIECES.index('</s>')
+
+    def __len__(self) -> int:
+        return len(self.pieces)
+
+    def encode(self, text: str, add_special_tokens: bool=True) -> list[int]:
+        ids = [self.ids.get(piece, UNK_ID) for piece in _PIECE.findall(text)]
+        if add_special_tokens:
+            return [BOS_ID] + ids
+        return ids
+
+    def decode(self, ids: list[int]) -> str:
+        return ''.join(self.pieces[idx] for idx in ids
+            if idx >= len(SPECIAL_PIECES))
+
+
+def random_prompt(rng: random.Random, tokens: int) -> str:
+    '''
+    A prompt of words that encodes to exactly tokens tokens (without BOS),
+    broken into lines now and then.
+    '''
+    pieces = []
+    line_start = True
+    for _ in range(tokens):
+        if not line_start and rng.random() < 0.08:
+            pieces.append('\n')
+            line_start = True
+            continue
+        word = rng.choice(WORDS)
+        pieces.append(word if line_start else ' ' + word)
+        line_start = False
+    return ''.join(pieces)
+
+
+class Arrival():
+    '''
+    A prompt, or a press of Continue on the reply to an earlier arrival
+    (parent), time seconds into the trace.
+    '''
+    time: float = 0.
+    user_id: int = 0
+    prompt_tokens: int = 0
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    parent: int|None = None
+
+    def __init__(
+        self,
+        time: float,
+        user_id: int,
+        prompt_tokens: int,
+        max_tokens: int,
+        parent: int|None=None,
+    ):
+        self.time = time
+        self.user_id = user_id
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.parent = parent
+
+    def to_record(self, idx: int) -> dict:
+        '''
+        In the format of the bot's trace log, so recorded and synthetic
+        traces are replayed alike.
+        '''
+        return {
+            'trace_id': f'arrival-{idx}',
+            'time': self.time,
+            'user_id': str(self.user_id),
+            'parent_short_id': None if self.parent is None else
+                f'arrival-{self.parent}',
+            'prompt_tokens': self.prompt_tokens,
+            'max_tokens': self.max_tokens,
+        }
+
+
+def synthetic_trace(
+    rng: random.Random,
+    requests: int,
+    rate: float,
+    users: int,
+    prompt_tokens: int,
+    new_tokens: int,
+    continue_fraction: float,
+) -> list[Arrival]:
+    '''
+    Poisson arrivals of prompts with log-normal prompt and max new token
+    counts around the given medians. A continue_fraction of the arrivals
+    continue one of the recent earlier ones, by the same user.
+    '''
+    arrivals: list[Arrival] = []
+    now = 0.
+    for idx in range(requests):
+        now += rng.expovariate(rate)
+        if idx > 0 and rng.random() < continue_fraction:
+            parent = rng.randrange(max(0, idx - 16), idx)
+            arrivals.append(Arrival(now, arrivals[parent].user_id, 0,
+                arrivals[parent].max_tokens, parent))
+            continue
+        tokens = int(rng.lognormvariate(math.log(prompt_tokens), 0.8))
+        max_tokens = int(rng.lognormvariate(math.log(new_tokens), 0.5))
+        arrivals.append(Arrival(now, 1000 + rng.randrange(users),
+            max(4, tokens),
+            min(MAX_TOKENS_MAX, max(MAX_TOKENS_MIN, max_tokens)), None))
+    return arrivals
+
+
+def load_trace(path: str, default_prompt_tokens: int) -> list[Arrival]:
+    '''
+    Arrivals of a trace log written by the bot (--trace-log) or saved by
+    --save-trace. The text of prompts is not logged, so prompts of the
+    recorded token counts are made up.
+    '''
+    with open(path, 'r') as trace_file:
+        records = [json.loads(line) for line in trace_file
+            if line.strip() != '']
+    records.sort(key=lambda record: record['time'])
+    start = records[0]['time'] if len(records) > 0 else 0.
+    indices: dict[str, int] = {}
+    user_ids: dict[str, int] = {}
+    arrivals = []
+    for record in records:
+        parent = indices.get(record.get('parent_short_id') or '', None)
+        user_id = user_ids.setdefault(str(record.get('user_id')),
+            1000 + len(user_ids))
+        indices[record['trace_id']] = len(arrivals)
+        arrivals.append(Arrival(record['time'] - start, user_id,
+            record.get('prompt_tokens') or default_prompt_tokens,
+            record.get('max_tokens') or DEFAULT_MAX_TOKENS, parent))
+    return arrivals
+
+
+_UNSET: Any = object()
+
+
+class FakeGuild():
+    def __init__(self, id: int):
+        self.id = id
+
+
+class FakeUser():
+    def __init__(self, id: int):
+        self.id = id
+        self.mention = f'<@{id}>'
+        self.joined_at = datetime.datetime.now(datetime.timezone.utc) - \
+            datetime.timedelta(days=365)
+
+
+class FakeMessage():
+    '''
+    A message of a FakeChannel. Edits take the channel's latency, like a
+    round trip to Discord, and are timed by the channel.
+    '''
+    def __init__(
+        self,
+        channel: 'FakeChannel',
+        id: int,
+        content: str|None,
+        embed: discord.Embed|None,
+        view: discord.ui.View|None,
+    ):
+        self.channel = channel
+        self.id = id
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.edits = 0
+
+    async def edit(self, content=_UNSET, embed=_UNSET, view=_UNSET):
+        await asyncio.sleep(self.channel.latency)
+        if content is not _UNSET:
+            self.content = content
+        if embed is not _UNSET:
+            self.embed = embed
+        if view is not _UNSET:
+            self.view = view
+        self.edits += 1
+        self.channel.observe_edit(self, embed, view)
+        return self
+
+
+class FakeChannel():
+    '''
+    Stands in for the text channel of one arrival, remembering the work
+    message and when output first showed and when the reply was done.
+    '''
+    first_output_at: float|None = None
+    replied_at: float|None = None
+    work_message: FakeMessage|None = None
+
+    def __init__(self, id: int, guild: FakeGuild, latency: float):
+        self.id = id
+        self.guild = guild
+        self.latency = latency
+        self.messages: list[FakeMessage] = []
+
+    async def send(self, content=None, *, embed=None, view=None,
+        delete_after=None):
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(self, self.id * 1000 + len(self.messages),
+            content, embed, view)
+        self.messages.append(message)
+        if view is not None and self.work_message is None:
+            self.work_message = message
+        return message
+
+    def observe_edit(self, message: FakeMessage, embed: Any, view: Any):
+        now = time.monotonic()
+        if embed is not _UNSET and embed is not None and \
+            self.first_output_at is None:
+            self.first_output_at = now
+        if isinstance(view, ChatButtons):
+            self.replied_at = now
+
+
+class FakeResponse():
+    async def defer(self, **kwargs):
+        pass
+
+
+class FakeInteraction():
+    def __init__(self, channel: FakeChannel, user: FakeUser):
+        self.channel = channel
+        self.user = user
+        self.response = FakeResponse()
+
+
+def percentile(values: list[float], q: float) -> float|None:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100.
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return values[lower] + (values[upper] - values[lower]) * \
+        (position - lower)
+
+
+def distribution(values: list[float]) -> dict:
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if len(values) > 0 else None,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if len(values) > 0 else None,
+    }
+
+
+async def replay(
+    arrivals: list[Arrival],
+    context: YALClient,
+    latency: float,
+    seed: int,
+    speedup: float,
+) -> tuple[list[dict], list[FakeChannel], float, int]:
+    '''
+    Send every arrival through actions.run_prompt, or through
+    ChatButtons.handle_continue on the reply to its parent once the parent
+    is done, at its time in the trace.
+    '''
+    rng = random.Random(seed)
+    guild = FakeGuild(1)
+    channels = [FakeChannel(1000000 + idx, guild, latency)
+        for idx in range(len(arrivals))]
+    done = [asyncio.Event() for _ in arrivals]
+    results: list[dict] = [{} for _ in arrivals]
+    in_flight = 0
+    peak_in_flight = 0
+    start = time.monotonic()
+
+    async def run(idx: int, arrival: Arrival):
+        nonlocal in_flight, peak_in_flight
+        result = results[idx]
+        result.update(index=idx, user_id=arrival.user_id,
+            kind='prompt' if arrival.parent is None else 'continue',
+            max_tokens=arrival.max_tokens)
+        await asyncio.sleep(max(0.,
+            start + arrival.time / speedup - time.monotonic()))
+        view = None
+        if arrival.parent is not None:
+            await done[arrival.parent].wait()
+            parent_message = channels[arrival.parent].work_message
+            if parent_message is None or \
+                not isinstance(parent_message.view, ChatButtons):
+                result['outcome'] = 'skipped'
+                done[idx].set()
+                return
+            view = parent_message.view
+        channel = channels[idx]
+        user = FakeUser(arrival.user_id)
+        result['start'] = time.monotonic() - start
+        in_flight += 1
+        peak_in_flight = max(peak_in_flight, in_flight)
+        started = time.monotonic()
+        try:
+            if view is not None:
+                await view.handle_continue(FakeInteraction(channel, user),
+                    None) # type: ignore
+            else:
+                await actions.run_prompt(channel, user, context, # type: ignore
+                    random_prompt(rng, arrival.prompt_tokens),
+                    max_tokens=arrival.max_tokens,
+                    temperature=DEFAULT_TEMPERATURE,
+                    top_p=DEFAULT_TOP_P)
+        finally:
+            in_flight -= 1
+            done[idx].set()
+        if channel.first_output_at is not None:
+            result['first_output_seconds'] = channel.first_output_at - started
+        if channel.replied_at is not None:
+            result['latency_seconds'] = channel.replied_at - started
+
+    await asyncio.gather(*[run(idx, arrival)
+        for idx, arrival in enumerate(arrivals)])
+    return results, channels, time.monotonic() - start, peak_in_flight
+
+
+def merge_traces(
+    results: list[dict],
+    channels: list[FakeChannel],
+    trace_path: str,
+):
+    '''
+    Add what the bot logged for every arrival, matched by channel: how it
+    ended, its token counts and how long it waited in the queue.
+    '''
+    by_channel = {str(channel.id): idx for idx, channel in enumerate(channels)}
+    with open(trace_path, 'r') as trace_file:
+        for line in trace_file:
+            record = json.loads(line)
+            idx = by_channel.get(record.get('channel_id'), None)
+            if idx is None:
+                continue
+            result = results[idx]
+            result['outcome'] = record.get('outcome')
+            for key in ('prompt_tokens', 'new_tokens', 'cached_tokens'):
+                if record.get(key) is not None:
+                    result[key] = record[key]
+            for span in record['spans']:
+                if span['name'] == 'queue_wait':
+                    result['queue_wait_seconds'] = span['seconds']
+                if span['name'] == 'generate' and \
+                    result.get('new_tokens', 0) > 0:
+                    result['tokens_per_second'] = \
+                        result['new_tokens'] / span['seconds']
+
+
+def summarize(results: list[dict], wall_seconds: float,
+    peak_in_flight: int) -> dict:
+    outcomes: dict[str, int] = {}
+    for result in results:
+        outcome = result.get('outcome') or 'unknown'
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    completed = [result for result in results
+        if result.get('outcome') == 'completed']
+    new_tokens = sum(result.get('new_tokens', 0) for result in results)
+    return {
+        'arrivals': len(results),
+        'continues': len([result for result in results
+            if result['kind'] == 'continue']),
+        'outcomes': outcomes,
+        'wall_seconds': wall_seconds,
+        'peak_in_flight': peak_in_flight,
+        'completed_per_second': len(completed) / wall_seconds,
+        'new_tokens': new_tokens,
+        'new_tokens_per_second': new_tokens / wall_seconds,
+        **{key: distribution([result[key] for result in completed
+            if key in result]) for key in ('latency_seconds',
+            'first_output_seconds', 'queue_wait_seconds',
+            'tokens_per_second')},
+    }
+
+
+def format_summary(summary: dict) -> str:
+    outcomes = ', '.join(f'{outcome} {count}'
+        for outcome, count in sorted(summary['outcomes'].items()))
+    lines = [f'Replayed {summary["arrivals"]} arrivals ' +
+        f'({summary["continues"]} continues) in ' +
+        f'{summary["wall_seconds"]:.1f}s, at most ' +
+        f'{summary["peak_in_flight"]} at once: {outcomes}',
+        f'Throughput: {summary["completed_per_second"]:.3f} replies/s, ' +
+        f'{summary["new_tokens_per_second"]:.1f} new tokens/s ' +
+        f'({summary["new_tokens"]} tokens)',
+        f'{"completed":<22} {"mean":>8} {"p50":>8} {"p90":>8} {"p99":>8} ' +
+        f'{"max":>8}']
+    for key in ('latency_seconds', 'first_output_seconds',
+        'queue_wait_seconds', 'tokens_per_second'):
+        stats = summary[key]
+        if stats['count'] == 0:
+            lines.append(f'{key:<22} {"-":>8}')
+            continue
+        lines.append(f'{key:<22} ' + ' '.join(f'{stats[name]:>8.3f}'
+            for name in ('mean', 'p50', 'p90', 'p99', 'max')))
+    return '\n'.join(lines)
+
+
+def tiny_model(args: Namespace, vocab_size: int) -> torch.nn.Module:
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+    )
+    model = LlamaForCausalLM(config).eval()
+    if args.wbits < 16:
+        threshold = 128
+        if not args.device.startswith('cuda'):
+            # The quant_cuda kernel only runs on CUDA.
+            threshold = 1
+        random_quantize(model, args.wbits, args.groupsize, threshold)
+    return model
+
+
+async def main(args: Namespace):
+    rng = random.Random(args.seed)
+    torch.manual_seed(args.seed)
+    if args.trace is not None:
+        arrivals = load_trace(args.trace, args.prompt_tokens)
+    else:
+        arrivals = synthetic_trace(rng, args.requests, args.rate, args.users,
+            args.prompt_tokens, args.new_tokens, args.continue_fraction)
+    if args.save_trace is not None:
+        with open(args.save_trace, 'w') as trace_file:
+            for idx, arrival in enumerate(arrivals):
+                trace_file.write(json.dumps(arrival.to_record(idx)) + '\n')
+
+    templates = ALPACA_PROMPT_TEMPLATES if args.alpaca else None
+    tokenizer = WordTokenizer(ALPACA_PROMPT_TEMPLATES +
+        [ALPACA_ANSWER_STRING, ALPACA_INPUT_STRING])
+    llama_engine = LlamaEngine('', '', args.wbits, args.groupsize,
+        device=args.device,
+        max_batch_size=args.max_batch_size,
+        min_new_tokens=args.min_new_tokens,
+        pinned_prefixes=ALPACA_PINNED_PREFIXES if args.alpaca else None,
+        turn_markers=ALPACA_TURN_MARKERS if args.alpaca else None,
+        prompt_templates=templates,
+        prompt_lookup=args.prompt_lookup,
+        model=tiny_model(args, len(tokenizer)),
+        tokenizer=tokenizer)
+
+    scheduler = FairShareScheduler(
+        max_concurrent=args.max_concurrent or args.max_batch_size,
+        max_queued_tokens=args.max_queued_tokens,
+        max_per_user=args.max_per_user,
+        deadline_seconds=None if args.no_deadline_admission else
+            DEFAULT_ACTION_TIMEOUT_SECONDS,
+        min_tokens=MAX_TOKENS_MIN,
+    )
+
+    async def prompt_check_fn(prompt, author_id, channel):
+        return prompt
+
+    pathlib.Path(TEMP_JSON_STORAGE_FOLDER).mkdir(parents=True, exist_ok=True)
+    context = YALClient(
+        intents=discord.Intents.none(),
+        button_store_dict={BUTTON_STORE_CHAT_BUTTONS_KEY: []},
+        button_store_path=pathlib.Path(TEMP_JSON_STORAGE_FOLDER) /
+            'button-store-benchmark.json',
+        cli_args=Namespace(alpaca=args.alpaca, hours_needed=None,
+            restrict_all_to_channel=None),
+        llama_engine=llama_engine,
+        prompt_check_fn=prompt_check_fn,
+        scheduler=scheduler,
+    )
+
+    # Never rotated, it is read back for the outcome of every arrival.
+    open(args.trace_log, 'w').close()
+    set_trace_log(TraceLog(args.trace_log, max_bytes=0))
+    try:
+        results, channels, wall_seconds, peak_in_flight = await replay(
+            arrivals, context, args.discord_latency, args.seed, args.speedup)
+    finally:
+        set_trace_log(None)
+        llama_engine.worker.shutdown() # type: ignore
+    merge_traces(results, channels, args.trace_log)
+
+    summary = summarize(results, wall_seconds, peak_in_flight)
+    print(format_summary(summary))
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({'args': vars(args), 'summary': summary,
+                'arrivals': results}, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a trace of ' +
+        'prompts and continues through the bot\'s actions against fake ' +
+        'Discord channels, served by a tiny randomly initialized LLaMA, and ' +
+        'report latency percentiles and throughput.')
+    parser.add_argument('--trace', type=str, default=None,
+        help='Replay a trace log of the bot (--trace-log) or of ' +
+        '--save-trace instead of a synthetic trace')
+    parser.add_argument('--save-trace', dest='save_trace', type=str,
+        default=None, help='Write the replayed trace here')
+    parser.add_argument('--output', type=str, default=None,
+        help='Write the summary and every arrival as JSON here')
+    parser.add_argument('--trace-log', dest='trace_log', type=str,
+        default=f'{TEMP_JSON_STORAGE_FOLDER}/benchmark-traces.jsonl',
+        help='Where the bot writes the spans of the replayed prompts')
+    parser.add_argument('--requests', type=int, default=48,
+        help='Arrivals of the synthetic trace')
+    parser.add_argument('--rate', type=float, default=0.5,
+        help='Arrivals per second of the synthetic trace')
+    parser.add_argument('--users', type=int, default=12)
+    parser.add_argument('--prompt-tokens', dest='prompt_tokens', type=int,
+        default=96, help='Median prompt tokens of the synthetic trace')
+    parser.add_argument('--new-tokens', dest='new_tokens', type=int,
+        default=DEFAULT_MAX_TOKENS,
+        help='Median max tokens of the synthetic trace')
+    parser.add_argument('--continue-fraction', dest='continue_fraction',
+        type=float, default=0.25,
+        help='Share of the synthetic arrivals that continue an earlier one')
+    parser.add_argument('--speedup', type=float, default=1.,
+        help='Replay the trace this many times faster')
+    parser.add_argument('--discord-latency', dest='discord_latency',
+        type=float, default=0.05,
+        help='Seconds every send and edit of a message takes')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--layers', type=int, default=2)
+    # QuantLinear packs zeros for 256 output features at a time.
+    parser.add_argument('--hidden-size', dest='hidden_size', type=int,
+        default=256)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--wbits', type=int, default=16,
+        choices=[2, 3, 4, 8, 16],
+        help='Replace the linear layers with random QuantLinear weights ' +
+        'of this many bits, 16 to keep them in full precision')
+    parser.add_argument('--groupsize', type=int, default=-1)
+    parser.add_argument('--max-batch-size', dest='max_batch_size', type=int,
+        default=4)
+    parser.add_argument('--max-concurrent', dest='max_concurrent', type=int,
+        default=None, help='(default=--max-batch-size)')
+    parser.add_argument('--max-per-user', dest='max_per_user', type=int,
+        default=1,
+        help='Simultaneous prompts per user, 1 like the bot without ' +
+        '--allow-queue')
+    parser.add_argument('--max-queued-tokens', dest='max_queued_tokens',
+        type=int, default=32768)
+    parser.add_argument('--no-deadline-admission',
+        dest='no_deadline_admission', action='store_true')
+    parser.add_argument('--min-new-tokens', dest='min_new_tokens', type=int,
+        default=MAX_TOKENS_MAX,
+        help='Stop tokens are masked until this many tokens were ' +
+        'generated. By default every generation runs to its max tokens, ' +
+        'as the random model would otherwise stop at random')
+    parser.add_argument('--prompt-lookup', dest='prompt_lookup',
+        action='store_true')
+    parser.add_argument('--alpaca', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -4,7 +4,7 @@ import pathlib
 import sys
 import time
 
-from typing import Callable, List, Optional, Union
+from typing import Callable, Optional
 
 import discord
 
@@ -14,7 +14,11 @@ from tqdm import tqdm
 import actions
 from client import YALClient
 from constants import (
+    ALPACA_PINNED_PREFIXES,
+    ALPACA_PROMPT_TEMPLATES,
+    ALPACA_TURN_MARKERS,
     BUTTON_STORE_CHAT_BUTTONS_KEY,
+    DEFAULT_ACTION_TIMEOUT_SECONDS,
     DEFAULT_TOP_P,
     DEFAULT_MAX_TOKENS,
     DEFAULT_TEMPERATURE,
@@ -25,8 +29,13 @@ from constants import (
     TEMPERATURE_MAX,
     TOP_P_MAX,
     TOP_P_MIN,
+    TRACE_LOG_FILE,
 )
-from llama_model.engine import LlamaEngine
+from llama_model.args import add_engine_args, build_engine
+from llama_model.cancellation import CANCEL_DELETED
+from llama_model.remote import RemoteEngine
+from llama_model.tracing import TraceLog, set_trace_log
+from scheduler import FairShareScheduler
 from util import (
     prompt_contains_nsfw,
 )
@@ -43,26 +52,11 @@ parser.add_argument('--default-tokens', dest='default_tokens', nargs='?',
 parser.add_argument('--default-top-p', dest='default_top_p', nargs='?',
     type=float, help='Default top p', default=DEFAULT_TOP_P)
 parser.add_argument(
-    '--llama-model', dest='llama_model', type=str,
-    default='decapoda-research/llama-13b-hf',
-    help='HF transformers llama model to load',
-)
-parser.add_argument(
-    '--wbits', dest='wbits', type=int, default=4, choices=[2, 3, 4, 8, 16],
-    help='Bit width to use for quantization of llama',
-)
-parser.add_argument(
-    '--groupsize', dest='groupsize', type=int, default=-1,
-    help='Group size to use for quantization of llama (default=-1)',
-)
-parser.add_argument(
-    '--load-checkpoint', dest='load_checkpoint', type=str, default='',
-    help='Load quantized model checkpoint',
-)
-parser.add_argument(
-    '--device', dest='torch_device', type=str, default='cuda:0',
-    help='Torch device to load model onto',
+    '--engine-socket', dest='engine_socket', type=str,
+    help='Use the model of an engine server listening on this socket ' +
+    'instead of loading it in the bot',
 )
+add_engine_args(parser)
 parser.add_argument('--hours-on-server-to-use', dest='hours_needed', nargs='?',
     type=int,
     help='The hours the user has been on the server before they can use the bot',
@@ -76,6 +70,55 @@ parser.add_argument('--max-queue',
     required=False,
     default=9999,
 )
+parser.add_argument('--max-concurrent',
+    dest='max_concurrent',
+    type=int,
+    help='The maximum number of requests generated at once across all ' +
+    'users, the rest wait in the queue (default=--max-batch-size for every ' +
+    'device of --devices, of the engine server with --engine-socket)',
+    required=False,
+)
+parser.add_argument('--max-queued-tokens',
+    dest='max_queued_tokens',
+    type=int,
+    help='The maximum estimated prompt and new tokens of all running and ' +
+    'queued requests, new requests are refused beyond it (default=32768)',
+    default=32768,
+)
+parser.add_argument('--short-prompt-tokens',
+    dest='short_prompt_tokens',
+    type=int,
+    help='Requests of at most this many estimated tokens are run before ' +
+    'longer ones (default=512)',
+    default=512,
+)
+parser.add_argument('--metrics-port',
+    dest='metrics_port',
+    type=int,
+    help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics ' +
+    '(default=off)',
+    default=None,
+)
+parser.add_argument('--max-queue-eta-seconds',
+    dest='max_queue_eta_seconds',
+    type=float,
+    help='Reject requests estimated to wait longer than this before they ' +
+    'start (default=no limit)',
+    default=None,
+)
+parser.add_argument('--no-deadline-admission',
+    dest='no_deadline_admission',
+    action='store_true',
+    help='Do not shorten or reject requests estimated to not finish ' +
+    'before the action timeout',
+)
+parser.add_argument('--max-queue-wait-seconds',
+    dest='max_queue_wait_seconds',
+    type=float,
+    help='Requests waiting longer than this run next regardless of their ' +
+    'priority (default=60)',
+    default=60.,
+)
 parser.add_argument('--nsfw-prompt-detection',
     dest='nsfw_prompt_detection',
     action=argparse.BooleanOptionalAction)
@@ -84,6 +127,13 @@ parser.add_argument('--nsfw-wordlist',
     help='Newline separated wordlist filename',
     type=str,
     required=False)
+parser.add_argument('--trace-log',
+    dest='trace_log',
+    type=str,
+    help='Where to write the spans of every prompt, an empty string to not ' +
+    f'write them (default={TRACE_LOG_FILE})',
+    default=TRACE_LOG_FILE,
+)
 parser.add_argument('--reload-last-minutes', dest='reload_last_minutes',
     help='When reloading the bot, how far back in minutes to load old ' +
     'UI elements (default 120 minutes)', type=int, required=False)
@@ -101,7 +151,8 @@ parser.add_argument(
 )
 args = parser.parse_args()
 
-if args.load_checkpoint is None or args.load_checkpoint == '':
+if args.engine_socket is None and \
+    (args.load_checkpoint is None or args.load_checkpoint == ''):
     print('You must supply a checkpoint file')
     sys.exit(1)
 
@@ -138,7 +189,6 @@ async def prompt_check_fn(
 guild = args.guild
 
 # In memory k-v stores.
-currently_fetching_ai_text: dict[str, Union[str, List[str], bool]] = {}
 user_text_generation_nonces: dict[str, int] = {}
 
 button_store_dict: dict[str, list] = {
@@ -150,6 +200,9 @@ BUTTON_STORE = f'{TEMP_JSON_STORAGE_FOLDER}/button-store-{str(guild)}.json'
 
 pathlib.Path(TEMP_JSON_STORAGE_FOLDER).mkdir(parents=True, exist_ok=True)
 
+if args.trace_log:
+    set_trace_log(TraceLog(args.trace_log))
+
 
 # A simple JSON store for button views that we write to when making new buttons
 # for new calls and which is kept in memory and keeps track of all buttons ever
@@ -166,20 +219,44 @@ if bs_path.is_file():
             button_store_dict[BUTTON_STORE_CHAT_BUTTONS_KEY] = []
 
 
+# Message events are needed to see deleted work messages and cancel their
+# prompts.
 intents = discord.Intents(
-    messages=False,
-    dm_messages=False,
-    guild_messages=False,
+    messages=True,
+    dm_messages=True,
+    guild_messages=True,
     message_content=True,
 )
 
 
-llama_engine = LlamaEngine(
-    args.llama_model,
-    args.load_checkpoint,
-    args.wbits,
-    args.groupsize,
-    args.torch_device,
+if args.engine_socket is not None:
+    llama_engine = RemoteEngine(args.engine_socket)
+elif args.alpaca:
+    llama_engine = build_engine(args, parser,
+        pinned_prefixes=ALPACA_PINNED_PREFIXES,
+        turn_markers=ALPACA_TURN_MARKERS,
+        prompt_templates=ALPACA_PROMPT_TEMPLATES)
+else:
+    llama_engine = build_engine(args, parser)
+
+# An engine server batches as many prompts as its own --max-batch-size and
+# --devices allow, so it is asked for that when the bot starts.
+concurrency_from_engine = args.max_concurrent is None and \
+    args.engine_socket is not None
+max_concurrent = args.max_concurrent
+if max_concurrent is None:
+    max_concurrent = 1 if concurrency_from_engine else \
+        llama_engine.capacity() # type: ignore
+scheduler = FairShareScheduler(
+    max_concurrent=max_concurrent,
+    max_queued_tokens=args.max_queued_tokens,
+    max_per_user=args.max_queue if args.allow_queue else 1,
+    short_prompt_tokens=args.short_prompt_tokens,
+    max_wait_seconds=args.max_queue_wait_seconds,
+    deadline_seconds=None if args.no_deadline_admission else
+        DEFAULT_ACTION_TIMEOUT_SECONDS,
+    min_tokens=MAX_TOKENS_MIN,
+    max_start_eta_seconds=args.max_queue_eta_seconds,
 )
 
 
@@ -187,11 +264,13 @@ client = YALClient(
     button_store_dict=button_store_dict,
     button_store_path=bs_path,
     cli_args=args,
-    currently_fetching_ai_text=currently_fetching_ai_text,
+    concurrency_from_engine=concurrency_from_engine,
     guild_id=guild,
     intents=intents,
     llama_engine=llama_engine,
+    metrics_port=args.metrics_port,
     prompt_check_fn=prompt_check_fn,
+    scheduler=scheduler,
 )
 
 model_string = 'LLaMA'
@@ -250,6 +329,16 @@ async def on_message(message):
     return
 
 
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    '''
+    Stop generating for a prompt whose work message was deleted.
+    '''
+    cancel_token = client.active_generations.get(payload.message_id, None)
+    if cancel_token is not None:
+        cancel_token.cancel(CANCEL_DELETED)
+
+
 @client.event
 async def on_ready():
     from ui import (
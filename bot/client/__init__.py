@@ -7,22 +7,34 @@ import discord
 
 from discord import app_commands
 
+from llama_model.metrics import MetricsServer
+
 
 if TYPE_CHECKING:
+    from llama_model.cancellation import CancellationToken
     from llama_model.engine import LlamaEngine
+    from llama_model.pool import EnginePool
+    from llama_model.remote import RemoteEngine
+    from scheduler import FairShareScheduler
 
 
 class YALClient(discord.Client):
     '''
     The root client for YAL discord bot.
     '''
+    # Cancellation tokens of the prompts in progress, by work message id.
+    active_generations: dict[int, 'CancellationToken']|None = None
     button_store_dict: dict[str, Any]|None = None
     button_store_path: pathlib.Path|None = None
     cli_args: Namespace|None = None
-    currently_fetching_ai_text: dict[str, bool|str|list[str]]|None = None
+    # Whether the scheduler runs as many prompts at once as the engine
+    # server batches, asked for when the bot starts.
+    concurrency_from_engine: bool = False
     guild_id: int|None = None
-    llama_engine: 'LlamaEngine|None' = None
+    llama_engine: 'LlamaEngine|EnginePool|RemoteEngine|None' = None
+    metrics_port: int|None = None
     prompt_check_fn: Callable|None = lambda x: x
+    scheduler: 'FairShareScheduler|None' = None
 
     def __init__(
         self,
@@ -30,10 +42,12 @@ class YALClient(discord.Client):
         button_store_dict=None,
         button_store_path: pathlib.Path=None,
         cli_args: Namespace=None,
-        currently_fetching_ai_text: dict[str, bool|str|list[str]]=None,
+        concurrency_from_engine: bool=False,
         guild_id: int|None=None,
-        llama_engine: 'LlamaEngine|None' = None,
+        llama_engine: 'LlamaEngine|EnginePool|RemoteEngine|None' = None,
+        metrics_port: int|None=None,
         prompt_check_fn: Callable=None,
+        scheduler: 'FairShareScheduler|None'=None,
     ):
         super().__init__(intents=intents)
         self.tree = app_commands.CommandTree(self)
@@ -41,15 +55,44 @@ class YALClient(discord.Client):
         self.button_store_dict = button_store_dict
         self.button_store_path = button_store_path
         self.cli_args = cli_args
-        self.currently_fetching_ai_text = currently_fetching_ai_text
+        self.concurrency_from_engine = concurrency_from_engine
         self.guild_id = guild_id
         self.llama_engine = llama_engine
+        self.metrics_port = metrics_port
         self.prompt_check_fn = prompt_check_fn
+        self.scheduler = scheduler
+        self.active_generations = {}
 
     async def setup_hook(self):
+        if self.concurrency_from_engine:
+            await self.use_engine_capacity()
+        if self.metrics_port is not None:
+            await MetricsServer(self.metrics_port).start()
         guild_id = None
         if self.guild_id is not None:
             guild_id =  discord.Object(id=self.guild_id)
         if guild_id is not None:
             self.tree.copy_global_to(guild=guild_id)
             await self.tree.sync(guild=guild_id)
+
+    async def close(self):
+        from llama_model.remote import RemoteEngine
+
+        if isinstance(self.llama_engine, RemoteEngine):
+            await self.llama_engine.close()
+        await super().close()
+
+    async def use_engine_capacity(self):
+        '''
+        Run as many prompts at once as the engine server batches across its
+        devices.
+        '''
+        try:
+            capacity = await self.llama_engine.capacity() # type: ignore
+        except OSError as e:
+            raise RuntimeError('Could not ask the engine at ' +
+                f'{self.llama_engine.path} how many prompts it runs at ' + # type: ignore
+                f'once ({e}), start the engine server first or pass ' +
+                '--max-concurrent') from e
+        self.scheduler.max_concurrent = capacity # type: ignore
+        print(f'Running up to {capacity} prompts at once, like the engine')
@@ -11,11 +11,15 @@ ID_LENGTH = 12
 BUTTON_STORE_CHAT_BUTTONS_KEY = 'chat_views'
 
 JSON_CHAT_FILE_FN = lambda uid, short_id: f'../temp_json/request-{uid}_{short_id}.json'
+# Spans of every prompt, one JSON object per line, rotated when it gets big.
+TRACE_LOG_FILE = '../temp_json/traces.jsonl'
 
 PROMPT_IN_TRUNCATION_LENGTH = 256
 
 DISCORD_MESSAGE_MAX_LENGTH = 2000
 DISCORD_EMBED_MAX_LENGTH = 1024
+# Minimum time between progressive edits of a message while streaming.
+DISCORD_EDIT_INTERVAL_SECONDS = 1.5
 
 DEFAULT_ACTION_TIMEOUT_SECONDS = 120
 
@@ -36,3 +40,18 @@ ALPACA_PREFIX_INPUT_STRING = 'Below is an instruction that describes a task, pai
 ALPACA_INSTRUCT_STRING = '### Instruction:\n'
 ALPACA_INPUT_STRING = '\n### Input:\n'
 ALPACA_ANSWER_STRING = '\n### Response:\n'
+
+# When a conversation outgrows the context window, keep the ALPACA preamble
+# and drop the oldest turns first.
+ALPACA_PINNED_PREFIXES = [ALPACA_PREFIX_INPUT_STRING, ALPACA_PREFIX_NO_INPUT_STRING]
+ALPACA_TURN_MARKERS = [
+    ALPACA_PREFIX_INPUT_STRING,
+    ALPACA_PREFIX_NO_INPUT_STRING,
+    ALPACA_INSTRUCT_STRING,
+]
+# Every ALPACA prompt starts with one of these, so their token ids are only
+# computed once.
+ALPACA_PROMPT_TEMPLATES = [
+    ALPACA_PREFIX_NO_INPUT_STRING + ALPACA_INSTRUCT_STRING,
+    ALPACA_PREFIX_INPUT_STRING + ALPACA_INSTRUCT_STRING,
+]
@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+import sys
+
+from constants import (
+    ALPACA_PINNED_PREFIXES,
+    ALPACA_PROMPT_TEMPLATES,
+    ALPACA_TURN_MARKERS,
+)
+from llama_model.args import add_engine_args, build_engine
+from llama_model.ipc import DEFAULT_ENGINE_SOCKET
+from llama_model.server import EngineServer
+
+
+parser = argparse.ArgumentParser(description='Load the model once and ' +
+    'serve it to the bot and other frontends over a local socket.')
+parser.add_argument(
+    '--socket', dest='socket', type=str, default=DEFAULT_ENGINE_SOCKET,
+    help=f'Unix socket to listen on (default={DEFAULT_ENGINE_SOCKET})',
+)
+parser.add_argument(
+    '--metrics-port', dest='metrics_port', type=int, default=None,
+    help='Serve Prometheus metrics of the engine on ' +
+    'http://127.0.0.1:PORT/metrics (default=off)',
+)
+parser.add_argument(
+    '--alpaca', dest='alpaca', action='store_true',
+    help='Trim and cache prompts in the ALPACA format',
+)
+add_engine_args(parser)
+args = parser.parse_args()
+
+if args.load_checkpoint is None or args.load_checkpoint == '':
+    print('You must supply a checkpoint file')
+    sys.exit(1)
+
+if args.alpaca:
+    llama_engine = build_engine(args, parser,
+        pinned_prefixes=ALPACA_PINNED_PREFIXES,
+        turn_markers=ALPACA_TURN_MARKERS,
+        prompt_templates=ALPACA_PROMPT_TEMPLATES)
+else:
+    llama_engine = build_engine(args, parser)
+
+asyncio.run(EngineServer(llama_engine, args.socket,
+    metrics_port=args.metrics_port).serve())
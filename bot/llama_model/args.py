@@ -0,0 +1,210 @@
+from argparse import ArgumentParser, Namespace
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .engine import LlamaEngine
+    from .pool import EnginePool
+
+
+def add_engine_args(parser: ArgumentParser):
+    '''
+    Add the arguments configuring the model and the LlamaEngine, shared by
+    the bot and the engine server.
+    '''
+    parser.add_argument(
+        '--llama-model', dest='llama_model', type=str,
+        default='decapoda-research/llama-13b-hf',
+        help='HF transformers llama model to load',
+    )
+    parser.add_argument(
+        '--wbits', dest='wbits', type=int, default=4, choices=[2, 3, 4, 8, 16],
+        help='Bit width to use for quantization of llama',
+    )
+    parser.add_argument(
+        '--groupsize', dest='groupsize', type=int, default=-1,
+        help='Group size to use for quantization of llama (default=-1)',
+    )
+    parser.add_argument(
+        '--load-checkpoint', dest='load_checkpoint', type=str, default='',
+        help='Load quantized model checkpoint',
+    )
+    parser.add_argument(
+        '--device', dest='torch_device', type=str, default='cuda:0',
+        help='Torch device to load model onto',
+    )
+    parser.add_argument(
+        '--devices', dest='torch_devices', type=str, default='',
+        help='Comma separated torch devices to load a replica of the model onto ' +
+        'each, requests go to the least loaded one (overrides --device)',
+    )
+    parser.add_argument(
+        '--pipeline-devices', dest='pipeline_devices', type=str, default='',
+        help='Comma separated torch devices to split the layers of one model ' +
+        'across, for models too large for a single device (overrides --device)',
+    )
+    parser.add_argument(
+        '--micro-batches', dest='micro_batches', type=int, default=None,
+        help='Micro-batches the running batch is split into to overlap the ' +
+        'devices of --pipeline-devices (default=number of devices)',
+    )
+    parser.add_argument(
+        '--max-batch-size', dest='max_batch_size', type=int, default=4,
+        help='Maximum number of prompts decoded together in one batch, each ' +
+        'reserves a full context window of KV cache (default=4)',
+    )
+    parser.add_argument(
+        '--residency', dest='residency', type=str, default='always',
+        choices=['always', 'idle', 'pressure'],
+        help='When to keep the model on the device: always, offload after being ' +
+        'idle, or offload when idle and device memory is under pressure ' +
+        '(default=always)',
+    )
+    parser.add_argument(
+        '--offload-after-idle-seconds', dest='offload_idle_seconds', type=float,
+        default=300., help='Idle seconds before offloading with --residency=idle',
+    )
+    parser.add_argument(
+        '--offload-memory-fraction', dest='offload_memory_fraction', type=float,
+        default=0.9, help='Used device memory fraction that triggers offloading ' +
+        'with --residency=pressure',
+    )
+    parser.add_argument(
+        '--memory-trim-watermark-mb', dest='trim_watermark_mb', type=int,
+        default=1024, help='Unused cached device memory in MB above which ' +
+        'the allocator cache is trimmed (default=1024)',
+    )
+    parser.add_argument(
+        '--prefix-cache-mb', dest='prefix_cache_mb', type=int, default=1024,
+        help='Device memory in MB for caching the keys and values of shared ' +
+        'prompt prefixes, 0 to disable (default=1024)',
+    )
+    parser.add_argument(
+        '--prefix-cache-entry-tokens', dest='prefix_cache_entry_tokens',
+        type=int, default=256, help='Prompt tokens cached at most when a ' +
+        'prompt does not start with a pinned prefix such as the ALPACA ' +
+        'preamble (default=256)',
+    )
+    parser.add_argument(
+        '--conversation-cache-mb', dest='conversation_cache_mb', type=int,
+        default=2048, help='Device memory in MB for keeping the cache of ' +
+        'finished generations for "Continue" (default=2048)',
+    )
+    parser.add_argument(
+        '--conversation-cache-cpu-mb', dest='conversation_cache_cpu_mb', type=int,
+        default=8192, help='Pinned CPU memory in MB that finished generations ' +
+        'spill to from the device (default=8192)',
+    )
+    parser.add_argument(
+        '--conversation-cache-ttl', dest='conversation_ttl_seconds', type=float,
+        default=7200., help='Seconds a finished generation is kept for ' +
+        '"Continue" (default=7200)',
+    )
+    parser.add_argument(
+        '--stop-string', dest='stop_strings', type=str, action='append',
+        help='Stop generating when the output contains this text, may be ' +
+        'given more than once',
+    )
+    parser.add_argument(
+        '--slow-tokenizer', dest='slow_tokenizer', action='store_true',
+        help='Use the slow SentencePiece tokenizer even if the fast one matches it',
+    )
+    parser.add_argument(
+        '--draft-model', dest='draft_model', type=str,
+        help='Path to the HF config of a small draft model for speculative ' +
+        'decoding, from the same family as the model',
+    )
+    parser.add_argument(
+        '--draft-checkpoint', dest='draft_checkpoint', type=str,
+        help='Quantized checkpoint of the draft model, enables speculative ' +
+        'decoding',
+    )
+    parser.add_argument(
+        '--draft-wbits', dest='draft_wbits', type=int,
+        help='Bits the draft model was quantized to (default=--wbits)',
+    )
+    parser.add_argument(
+        '--draft-groupsize', dest='draft_groupsize', type=int, default=-1,
+        help='Groupsize the draft model was quantized with (default=-1)',
+    )
+    parser.add_argument(
+        '--speculative-tokens', dest='speculative_tokens', type=int, default=4,
+        help='Tokens proposed per step with speculative decoding (default=4)',
+    )
+    parser.add_argument(
+        '--prompt-lookup', dest='prompt_lookup', action='store_true',
+        help='Speculatively decode spans repeated from the prompt, when no ' +
+        'draft model is given',
+    )
+    parser.add_argument(
+        '--prompt-lookup-ngram', dest='prompt_lookup_ngram', type=int, default=3,
+        help='Longest run of final tokens matched against the prompt for ' +
+        '--prompt-lookup (default=3)',
+    )
+    parser.add_argument(
+        '--profile-layers', dest='profile_layers', action='store_true',
+        help='Time every module of the model and print a report whenever ' +
+        'the batch drains, slows generation down',
+    )
+    parser.add_argument(
+        '--min-new-tokens', dest='min_new_tokens', type=int, default=1,
+        help='Tokens generated before EOS and stop sequences may be sampled, ' +
+        'so replies are never empty (default=1)',
+    )
+
+
+def build_engine(
+    args: Namespace,
+    parser: ArgumentParser,
+    pinned_prefixes: list[str]|None=None,
+    turn_markers: list[str]|None=None,
+    prompt_templates: list[str]|None=None,
+) -> 'LlamaEngine|EnginePool':
+    '''
+    Load the model as configured by the arguments of add_engine_args: a
+    LlamaEngine, optionally split across --pipeline-devices, or an
+    EnginePool with a replica on each of --devices.
+    '''
+    from .engine import LlamaEngine
+    from .pool import EnginePool
+
+    engine_kwargs = dict(
+        max_batch_size=args.max_batch_size,
+        residency=args.residency,
+        offload_idle_seconds=args.offload_idle_seconds,
+        offload_memory_fraction=args.offload_memory_fraction,
+        trim_watermark_mb=args.trim_watermark_mb,
+        prefix_cache_mb=args.prefix_cache_mb,
+        prefix_cache_entry_tokens=args.prefix_cache_entry_tokens,
+        conversation_cache_mb=args.conversation_cache_mb,
+        conversation_cache_cpu_mb=args.conversation_cache_cpu_mb,
+        conversation_ttl_seconds=args.conversation_ttl_seconds,
+        stop_strings=args.stop_strings,
+        min_new_tokens=args.min_new_tokens,
+        pinned_prefixes=pinned_prefixes,
+        turn_markers=turn_markers,
+        prompt_templates=prompt_templates,
+        fast_tokenizer=not args.slow_tokenizer,
+        draft_model_str=args.draft_model,
+        draft_checkpoint=args.draft_checkpoint,
+        draft_wbits=args.draft_wbits,
+        draft_groupsize=args.draft_groupsize,
+        speculative_tokens=args.speculative_tokens,
+        prompt_lookup=args.prompt_lookup,
+        prompt_lookup_ngram=args.prompt_lookup_ngram,
+        micro_batches=args.micro_batches,
+        profile_layers=args.profile_layers,
+    )
+    devices = [device.strip() for device in args.torch_devices.split(',')
+        if device.strip() != '']
+    pipeline_devices = [device.strip()
+        for device in args.pipeline_devices.split(',') if device.strip() != '']
+    if len(pipeline_devices) > 0:
+        if len(devices) > 1:
+            parser.error('--devices and --pipeline-devices can not be combined')
+        engine_kwargs['pipeline_devices'] = pipeline_devices
+    if len(devices) > 1:
+        return EnginePool.from_devices(devices, args.llama_model,
+            args.load_checkpoint, args.wbits, args.groupsize, **engine_kwargs)
+    return LlamaEngine(args.llama_model, args.load_checkpoint, args.wbits,
+        args.groupsize, devices[0] if len(devices) == 1 else args.torch_device,
+        **engine_kwargs)
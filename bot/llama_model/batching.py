@@ -0,0 +1,722 @@
+import asyncio
+import time
+
+from typing import TYPE_CHECKING, Any
+
+import torch
+
+from .cancellation import CancellationToken, GenerationCancelled
+from .memory import (
+    MEMORY_ACTIVATIONS,
+    MEMORY_KV_CACHE,
+    MEMORY_OUTPUT,
+    tensor_bytes,
+)
+from .metrics import REGISTRY, TOKEN_COUNT_BUCKETS, TOKENS_PER_SECOND_BUCKETS
+from .result import (
+    FINISH_CANCELLED,
+    FINISH_EOS,
+    FINISH_LENGTH,
+    FINISH_STOP_SEQUENCE,
+    FINISH_STOP_STRING,
+    GenerationResult,
+)
+from .sampling import sample_tokens, suppress_tokens
+from .speculative import verify_proposals
+from .stream import IncrementalDetokenizer, TokenStream
+from .tracing import make_span
+from .worker import resolve_future
+
+if TYPE_CHECKING:
+    from .engine import LlamaEngine
+
+
+# Every row reserves a MAX_TOKEN_WINDOW slot of the static KV cache, about
+# 1 GiB for LLaMA 7B in fp16.
+DEFAULT_MAX_BATCH_SIZE = 4
+# Stop and EOS tokens are masked until a request has this many new tokens, so
+# the model can not end its reply before starting it.
+DEFAULT_MIN_NEW_TOKENS_BEFORE_STOP = 1
+
+REQUESTS = REGISTRY.counter('yal_engine_requests_total',
+    'Generations that ended, by finish reason.', ('finish_reason',))
+FAILED_REQUESTS = REGISTRY.counter('yal_engine_failed_requests_total',
+    'Generations that failed with an error.')
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    'yal_engine_time_to_first_token_seconds',
+    'Seconds from queueing a prompt to sampling its first token.')
+DECODE_TOKENS_PER_SECOND = REGISTRY.histogram(
+    'yal_engine_decode_tokens_per_second',
+    'New tokens per second of a generation after its first token.',
+    buckets=TOKENS_PER_SECOND_BUCKETS)
+PREFILL_TOKENS = REGISTRY.counter('yal_engine_prefill_tokens_total',
+    'Prompt tokens run through the model.')
+CACHED_PROMPT_TOKENS = REGISTRY.counter('yal_engine_cached_prompt_tokens_total',
+    'Prompt tokens reused from the prefix or conversation cache.')
+PROMPT_TOKENS = REGISTRY.histogram('yal_engine_prompt_tokens',
+    'Prompt tokens of a generation, after fitting the context window.',
+    buckets=TOKEN_COUNT_BUCKETS)
+GENERATED_TOKENS = REGISTRY.counter('yal_engine_generated_tokens_total',
+    'New tokens generated.')
+
+
+class GenerationRequest():
+    '''
+    A single prompt being generated by the BatchScheduler.
+    '''
+    prompt: str = ''
+    max_new_tokens: int = 0
+    temperature: float = 1.0
+    top_p: float = 1.0
+    request_id: str|None = None
+    parent_id: str|None = None
+    min_new_tokens: int = DEFAULT_MIN_NEW_TOKENS_BEFORE_STOP
+    cancel_token: CancellationToken|None = None
+
+    created: float = 0.
+    first_token_at: float|None = None
+    detokenize_seconds: float = 0.
+    spans: list[dict]|None = None
+
+    prompt_ids: list[int]|None = None
+    output_ids: list[int]|None = None
+    cached_tokens: int = 0
+    dropped_tokens: int = 0
+    detokenizer: IncrementalDetokenizer|None = None
+    text: str = ''
+    stop_string: str|None = None
+    finish_reason: str|None = None
+    finished: bool = False
+
+    loop: asyncio.AbstractEventLoop|None = None
+    future: asyncio.Future|None = None
+    stream: TokenStream|None = None
+
+    def __init__(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        request_id: str|None=None,
+        parent_id: str|None=None,
+        min_new_tokens: int=DEFAULT_MIN_NEW_TOKENS_BEFORE_STOP,
+        cancel_token: CancellationToken|None=None,
+    ):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.request_id = request_id
+        self.parent_id = parent_id
+        self.min_new_tokens = min_new_tokens
+        self.cancel_token = cancel_token or CancellationToken()
+        self.created = time.time()
+        self.output_ids = []
+        self.spans = []
+
+    @property
+    def suppressing_stop(self) -> bool:
+        '''
+        Whether stop and EOS tokens are still masked for the next token.
+        '''
+        return len(self.output_ids) < self.min_new_tokens # type: ignore
+
+
+class BatchScheduler():
+    '''
+    Iteration-level (continuous) batching in front of a LlamaEngine.
+
+    Requests are admitted into the running decode batch at token boundaries
+    and finished sequences are retired immediately, so concurrent users share
+    every forward pass instead of waiting for each other. All methods other
+    than submit() run on the engine's inference worker thread.
+
+    Cancelled requests are dropped before every step. A row being generated
+    gives up its slot right away and resolves to what it generated so far
+    with FINISH_CANCELLED, a request still waiting raises
+    GenerationCancelled.
+
+    Rows decode in slots 0..n-1 of the engine's LlamaDecoder static KV
+    cache, each attending only to its own length, so rows of different
+    lengths decode together without padding.
+    '''
+    engine: 'LlamaEngine|None' = None
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE
+
+    def __init__(
+        self,
+        engine: 'LlamaEngine',
+        max_batch_size: int=DEFAULT_MAX_BATCH_SIZE,
+    ):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+
+        self.pending: list[GenerationRequest] = []
+        self.rows: list[GenerationRequest] = []
+        self.next_tokens: torch.Tensor|None = None
+        self.prev_tokens: torch.Tensor|None = None
+        self.history: torch.Tensor|None = None
+        self.remaining: torch.Tensor|None = None
+        self.temperatures: torch.Tensor|None = None
+        self.top_ps: torch.Tensor|None = None
+
+        engine.worker.step_fn = self.step # type: ignore
+
+    def enqueue(self, request: GenerationRequest, stream: bool=False):
+        '''
+        Queue a request for generation. Must be called from the event loop
+        that will await request.future (or iterate request.stream).
+        '''
+        request.loop = asyncio.get_running_loop()
+        request.future = request.loop.create_future()
+        if stream:
+            request.stream = TokenStream(request, request.loop)
+        self.engine.worker.call_soon(self.pending.append, request) # type: ignore
+
+    async def submit(self, request: GenerationRequest) -> Any:
+        '''
+        Queue a request for generation and await its final output.
+        '''
+        self.enqueue(request)
+        return await request.future # type: ignore
+
+    def step(self) -> bool:
+        '''
+        Admit waiting requests and run one decode step for the whole batch.
+        Returns True while there is still work to do.
+        '''
+        try:
+            with torch.no_grad():
+                self._drop_cancelled()
+                self._admit_pending()
+                if len(self.rows) > 0:
+                    self._decode_step()
+        except Exception as e:
+            self._fail_all(e)
+            raise
+        return len(self.rows) > 0 or len(self.pending) > 0
+
+    def _drop_cancelled(self):
+        for request in [request for request in self.pending
+            if request.cancel_token.cancelled]: # type: ignore
+            self.pending.remove(request)
+            REQUESTS.inc(finish_reason=FINISH_CANCELLED)
+            self._resolve(request, exception=GenerationCancelled(
+                request.cancel_token.reason)) # type: ignore
+        cancelled = [idx for idx, request in enumerate(self.rows)
+            if request.cancel_token.cancelled] # type: ignore
+        if len(cancelled) > 0:
+            self._retire(cancelled)
+
+    def _admit_pending(self):
+        max_rows = min(self.max_batch_size, self.engine.decoder.slots) # type: ignore
+        while len(self.pending) > 0 and len(self.rows) < max_rows:
+            request = self.pending.pop(0)
+            if len(self.rows) == 0:
+                self.engine.acquire_device() # type: ignore
+            try:
+                self._prefill(request)
+            except Exception as e:
+                self.engine.memory.release(request) # type: ignore
+                self._resolve(request, exception=e)
+                if len(self.rows) == 0:
+                    self.engine.release_device() # type: ignore
+
+    def _prefill(self, request: GenerationRequest):
+        engine = self.engine
+        started = time.time()
+        request.spans.append(make_span('engine_queue', request.created, # type: ignore
+            started - request.created))
+        request.prompt_ids = engine.encode_prompt(request.prompt, # type: ignore
+            parent_id=request.parent_id, request_id=request.request_id)
+        request.prompt_ids, request.max_new_tokens, request.dropped_tokens = \
+            engine.context_window.fit(request.prompt, request.prompt_ids, # type: ignore
+                request.max_new_tokens)
+        if request.dropped_tokens > 0:
+            print(f'Dropped {request.dropped_tokens} prompt tokens to fit ' +
+                'the context window, generating up to ' +
+                f'{request.max_new_tokens} tokens')
+        request.min_new_tokens = min(request.min_new_tokens,
+            request.max_new_tokens)
+        prompt_len = len(request.prompt_ids)
+        if request.stream is not None or \
+            len(engine.stop_matcher.stop_strings) > 0: # type: ignore
+            request.detokenizer = IncrementalDetokenizer(engine.tokenizer, # type: ignore
+                request.prompt_ids)
+        tokenized = time.time()
+        request.spans.append(make_span('tokenize', started, # type: ignore
+            tokenized - started, prompt_tokens=prompt_len,
+            dropped_tokens=request.dropped_tokens))
+
+        # Reuse the retained cache of the conversation being continued, else
+        # the cached keys and values of the longest known prefix. At least one
+        # token is always prefilled to get the next token logits.
+        cached_len, cached_past = 0, None
+        if request.parent_id is not None and \
+            engine.conversation_cache is not None: # type: ignore
+            cached_len, cached_past = engine.conversation_cache.match( # type: ignore
+                request.parent_id, request.prompt_ids[:-1])
+        if cached_past is None and engine.prefix_cache is not None: # type: ignore
+            cached_len, cached_past = engine.prefix_cache.match( # type: ignore
+                request.prompt_ids[:-1])
+        request.cached_tokens = cached_len
+
+        # The new row goes into the first free slot of the static cache.
+        decoder = engine.decoder # type: ignore
+        slot = len(self.rows)
+        if cached_past is not None:
+            decoder.cache.load(slot, cached_past, cached_len)
+        del cached_past
+        input_ids = torch.tensor([request.prompt_ids[cached_len:]],
+            dtype=torch.long, device=engine.device) # type: ignore
+        memory = engine.memory # type: ignore
+        start = memory.measure_start()
+        logits = decoder.prefill(slot, input_ids, cached_len)
+        if engine.prefix_cache is not None: # type: ignore
+            # Only the pinned prefix, such as the ALPACA preamble, when the
+            # prompt has one. The rest is unlikely to be shared and would
+            # evict it.
+            shared_len = engine.context_window.pinned_length( # type: ignore
+                request.prompt, request.prompt_ids)
+            engine.prefix_cache.insert( # type: ignore
+                request.prompt_ids[:shared_len or prompt_len],
+                decoder.cache.past(slot, prompt_len))
+        if request.suppressing_stop:
+            logits = suppress_tokens(logits,
+                engine.stop_matcher.suppress_ids(engine.device), # type: ignore
+                torch.ones((1,), dtype=torch.bool, device=engine.device)) # type: ignore
+        token = sample_tokens(
+            logits,
+            torch.tensor([request.temperature], device=engine.device), # type: ignore
+            torch.tensor([request.top_p], device=engine.device)) # type: ignore
+        stop_matcher = engine.stop_matcher # type: ignore
+        history = stop_matcher.history_for(request.prompt_ids, engine.device)
+        history = torch.cat([history[:, 1:], token], dim=1)
+        remaining = torch.tensor([request.max_new_tokens - 1],
+            device=engine.device) # type: ignore
+        done = stop_matcher(history, token[:, 0], remaining)
+        memory.set(request, MEMORY_ACTIVATIONS,
+            memory.measure_peak(start) or tensor_bytes(logits))
+        memory.set(request, MEMORY_KV_CACHE,
+            prompt_len * decoder.cache.token_bytes)
+        del logits
+        if engine.speculator is not None: # type: ignore
+            engine.speculator.prefill(slot, request.prompt_ids) # type: ignore
+
+        first_token, first_done = torch.stack(
+            [token[:, 0], done.long()], dim=1)[0].tolist()
+        request.first_token_at = time.time()
+        request.spans.append(make_span('prefill', tokenized, # type: ignore
+            request.first_token_at - tokenized, cached_tokens=cached_len,
+            prefill_tokens=prompt_len - cached_len))
+        TIME_TO_FIRST_TOKEN.observe(request.first_token_at - request.created)
+        PREFILL_TOKENS.inc(prompt_len - cached_len)
+        CACHED_PROMPT_TOKENS.inc(cached_len)
+        PROMPT_TOKENS.observe(prompt_len)
+        if self._record(request, first_token, bool(first_done)):
+            self._retain(request, request.prompt_ids,
+                decoder.cache.past(slot, prompt_len))
+            decoder.cache.lengths[slot] = 0
+            self._finish(request)
+            if len(self.rows) == 0:
+                self.engine.release_device() # type: ignore
+            return
+
+        self._join_batch(request, token, history, remaining)
+
+    def _join_batch(
+        self,
+        request: GenerationRequest,
+        token: torch.Tensor,
+        history: torch.Tensor,
+        remaining: torch.Tensor,
+    ):
+        prev = torch.tensor([request.prompt_ids[-1:]], dtype=torch.long, # type: ignore
+            device=token.device)
+        if len(self.rows) == 0:
+            self.next_tokens = token
+            self.prev_tokens = prev
+            self.history = history
+            self.remaining = remaining
+        else:
+            self.next_tokens = torch.cat([self.next_tokens, token]) # type: ignore
+            self.prev_tokens = torch.cat([self.prev_tokens, prev]) # type: ignore
+            self.history = torch.cat([self.history, history]) # type: ignore
+            self.remaining = torch.cat([self.remaining, remaining]) # type: ignore
+        self.rows.append(request)
+        self._update_sampling_params()
+
+    def _decode_step(self):
+        engine = self.engine
+        if engine.speculator is not None and self._speculative_step(): # type: ignore
+            return
+        batch_size = len(self.rows)
+        self.prev_tokens = self.next_tokens
+        logits = engine.decoder.decode(self.next_tokens) # type: ignore
+        suppress = [request.suppressing_stop for request in self.rows]
+        if any(suppress):
+            logits = suppress_tokens(logits,
+                engine.stop_matcher.suppress_ids(logits.device), # type: ignore
+                torch.tensor(suppress, device=logits.device))
+        self.next_tokens = sample_tokens(logits, self.temperatures,
+            self.top_ps) # type: ignore
+        output_bytes = tensor_bytes(logits) // batch_size
+        del logits
+        self._account_batch(output_bytes)
+
+        tokens = self.next_tokens[:, 0] # type: ignore
+        self.history = torch.cat([self.history[:, 1:], # type: ignore
+            self.next_tokens], dim=1)
+        self.remaining -= 1 # type: ignore
+        done = engine.stop_matcher(self.history, tokens, # type: ignore
+            self.remaining)
+        # The only host sync of the step: sampled tokens and done flags of
+        # every row in one transfer.
+        finished = []
+        for idx, (token, row_done) in enumerate(
+            torch.stack([tokens, done.long()], dim=1).tolist()):
+            if self._record(self.rows[idx], token, bool(row_done)):
+                finished.append(idx)
+        if len(finished) > 0:
+            self._retire(finished)
+
+    def _speculative_step(self) -> bool:
+        '''
+        Verify the speculator's proposals for every row in one forward pass
+        of the model. Returns False if nothing was proposed, in which case a
+        regular decode step has to run.
+        '''
+        engine = self.engine
+        decoder = engine.decoder # type: ignore
+        speculator = engine.speculator # type: ignore
+        batch_size = len(self.rows)
+        lengths = decoder.lengths[:batch_size]
+        num_tokens = min(speculator.num_tokens,
+            decoder.max_len - 1 - max(lengths))
+        if num_tokens < 1:
+            return False
+        proposal = speculator.propose(self, num_tokens)
+        if proposal is None:
+            return False
+
+        draft, draft_probs, proposed = proposal
+        logits = decoder.decode(torch.cat([self.next_tokens, draft], dim=1), # type: ignore
+            all_logits=True)
+        if any(request.suppressing_stop for request in self.rows):
+            # Position i samples the (produced + i + 1)th new token.
+            suppress = [[len(request.output_ids) + idx < request.min_new_tokens # type: ignore
+                for idx in range(logits.shape[1])] for request in self.rows]
+            logits = suppress_tokens(logits,
+                engine.stop_matcher.suppress_ids(logits.device), # type: ignore
+                torch.tensor(suppress, device=logits.device))
+        accepted, new_tokens = verify_proposals(logits, draft, draft_probs,
+            proposed, self.temperatures, self.top_ps) # type: ignore
+        output_bytes = tensor_bytes(logits) // batch_size
+        del logits, draft_probs
+
+        # The token before the new one: the last accepted draft token, or the
+        # previous token if none were accepted.
+        last_draft = draft.gather(1, (accepted - 1).clamp(min=0).unsqueeze(1))
+        self.prev_tokens = torch.where(accepted.unsqueeze(1) > 0, last_draft,
+            self.next_tokens) # type: ignore
+        self.next_tokens = new_tokens
+        # The only host sync of the step.
+        results = torch.cat([accepted.unsqueeze(1),
+            proposed.long().sum(dim=1, keepdim=True), draft, new_tokens],
+            dim=1).tolist()
+
+        finished = []
+        total_proposed, total_accepted = 0, 0
+        for idx, row in enumerate(results):
+            n_accepted, n_proposed = row[0], row[1]
+            total_accepted += n_accepted
+            total_proposed += n_proposed
+            # Rejected positions were written to the cache but are dropped by
+            # rolling the length back.
+            decoder.lengths[idx] = lengths[idx] + 1 + n_accepted
+            request = self.rows[idx]
+            for token in row[2:2 + n_accepted] + row[-1:]:
+                if self._record(request, token, self._host_done(request,
+                    token)):
+                    finished.append(idx)
+                    break
+        speculator.record(batch_size, total_proposed, total_accepted)
+        self._account_batch(output_bytes)
+
+        # Refresh the on-device stop state for the tokens added on the host.
+        device = self.next_tokens.device
+        self.history = engine.stop_matcher.histories_for( # type: ignore
+            [request.prompt_ids + request.output_ids for request in self.rows], # type: ignore
+            device)
+        self.remaining = torch.tensor([request.max_new_tokens -
+            len(request.output_ids) for request in self.rows], # type: ignore
+            device=device)
+        if len(finished) > 0:
+            self._retire(finished)
+        return True
+
+    def _host_done(self, request: GenerationRequest, token: int) -> bool:
+        '''
+        The stop check of StopSequenceMatcher.__call__ for a single token, on
+        the host.
+        '''
+        if len(request.output_ids) + 1 >= request.max_new_tokens: # type: ignore
+            return True
+        stop_matcher = self.engine.stop_matcher # type: ignore
+        tail = (request.prompt_ids + request.output_ids)[ # type: ignore
+            -stop_matcher.window:] + [token]
+        return stop_matcher.match(tail) is not None
+
+    def _account_batch(self, output_bytes: int):
+        '''
+        Attribute the used part of every row's cache slot and the step's
+        output buffers to the rows of the batch.
+        '''
+        memory = self.engine.memory # type: ignore
+        cache = self.engine.decoder.cache # type: ignore
+        for slot, request in enumerate(self.rows):
+            memory.set(request, MEMORY_KV_CACHE,
+                cache.lengths[slot] * cache.token_bytes)
+            memory.set(request, MEMORY_OUTPUT, output_bytes)
+
+    def _record(
+        self,
+        request: GenerationRequest,
+        token: int,
+        done: bool,
+    ) -> bool:
+        '''
+        Record a sampled token and return whether the sequence is finished.
+        '''
+        request.output_ids.append(token) # type: ignore
+        if token == self.engine.eos_token_id: # type: ignore
+            request.finish_reason = FINISH_EOS
+            return True
+        if done:
+            request.finish_reason = FINISH_LENGTH \
+                if len(request.output_ids) >= request.max_new_tokens \
+                else FINISH_STOP_SEQUENCE # type: ignore
+        if request.detokenizer is None:
+            return done
+
+        started = time.time()
+        text = request.detokenizer.push(token)
+        request.detokenize_seconds += time.time() - started
+        if request.stream is not None:
+            request.stream.put(text)
+        stop_strings = self.engine.stop_matcher.stop_strings # type: ignore
+        if text != '' and len(stop_strings) > 0:
+            # Only the tail that can contain a newly completed stop string.
+            tail = request.text[-max(len(stop) for stop in stop_strings):] + text
+            request.text += text
+            idx = self.engine.stop_matcher.match_text(tail) # type: ignore
+            if idx is not None:
+                request.stop_string = next(stop for stop in stop_strings
+                    if tail.find(stop) == idx)
+                request.finish_reason = FINISH_STOP_STRING
+                return True
+        return done
+
+    def _retire(self, finished: list[int]):
+        cache = self.engine.decoder.cache # type: ignore
+        for idx in finished:
+            request = self.rows[idx]
+            if request.cancel_token.cancelled: # type: ignore
+                # Abandoned, nothing to continue from.
+                request.finish_reason = FINISH_CANCELLED
+            elif request.request_id is not None and \
+                self.engine.conversation_cache is not None: # type: ignore
+                # The cache holds everything but the last sampled token, or
+                # speculated tokens past the stop with speculative decoding.
+                token_ids = request.prompt_ids + request.output_ids # type: ignore
+                length = min(cache.lengths[idx], len(token_ids))
+                self._retain(request, token_ids[:length],
+                    cache.past(idx, length))
+            self._finish(request)
+        keep = [idx for idx in range(len(self.rows)) if idx not in finished]
+        if len(keep) == 0:
+            self._reset()
+            self.engine.release_device() # type: ignore
+            return
+
+        cache.compact(keep)
+        if self.engine.speculator is not None: # type: ignore
+            self.engine.speculator.compact(keep) # type: ignore
+        keep_t = torch.tensor(keep, device=self.next_tokens.device) # type: ignore
+        self.rows = [self.rows[idx] for idx in keep]
+        self.next_tokens = self.next_tokens.index_select(0, keep_t) # type: ignore
+        self.prev_tokens = self.prev_tokens.index_select(0, keep_t) # type: ignore
+        self.history = self.history.index_select(0, keep_t) # type: ignore
+        self.remaining = self.remaining.index_select(0, keep_t) # type: ignore
+        self._update_sampling_params()
+        self.engine.trim_memory()
+
+    def _retain(
+        self,
+        request: GenerationRequest,
+        token_ids: list[int],
+        past_key_values: tuple,
+    ):
+        '''
+        Keep the final cache of a finished request for a later "Continue".
+        '''
+        cache = self.engine.conversation_cache # type: ignore
+        if cache is None or request.request_id is None:
+            return
+        cache.put(request.request_id, token_ids, tuple(
+            (k.clone(), v.clone()) for k, v in past_key_values))
+
+    def _finish(self, request: GenerationRequest):
+        request.finished = True
+        self.engine.memory.release(request) # type: ignore
+        self._observe(request)
+        started = time.time()
+        if request.first_token_at is not None:
+            request.spans.append(make_span('decode', request.first_token_at, # type: ignore
+                started - request.first_token_at,
+                new_tokens=len(request.output_ids), # type: ignore
+                finish_reason=request.finish_reason))
+            if request.detokenizer is not None:
+                # Summed over the tokens, interleaved with decoding.
+                request.spans.append(make_span('detokenize_stream', # type: ignore
+                    request.first_token_at, request.detokenize_seconds))
+        try:
+            result = self.engine.decode_output(request) # type: ignore
+        except Exception as e:
+            self._resolve(request, exception=e)
+            return
+        request.spans.append(make_span('detokenize', started, # type: ignore
+            time.time() - started))
+        self._resolve(request, result=result)
+
+    def _observe(self, request: GenerationRequest):
+        new_tokens = len(request.output_ids) # type: ignore
+        REQUESTS.inc(finish_reason=request.finish_reason)
+        GENERATED_TOKENS.inc(new_tokens)
+        if request.first_token_at is not None and new_tokens > 1:
+            elapsed = time.time() - request.first_token_at
+            if elapsed > 0:
+                DECODE_TOKENS_PER_SECOND.observe((new_tokens - 1) / elapsed)
+
+    def _fail_all(self, exception: Exception):
+        # The waiting requests fail too rather than retry on a device that
+        # just failed, and the worker does not step again until a new job.
+        for request in self.rows + self.pending:
+            FAILED_REQUESTS.inc()
+            self.engine.memory.release(request) # type: ignore
+            self._resolve(request, exception=exception)
+        self.pending = []
+        had_rows = len(self.rows) > 0
+        self._reset()
+        if had_rows:
+            self.engine.release_device() # type: ignore
+
+    def _resolve(
+        self,
+        request: GenerationRequest,
+        result: Any=None,
+        exception: Exception|None=None,
+    ):
+        resolve_future(request.loop, request.future, # type: ignore
+            result=result, exception=exception)
+        if request.stream is not None:
+            request.stream.close()
+
+    def _reset(self):
+        self.rows = []
+        cache = self.engine.decoder.cache # type: ignore
+        if cache is not None:
+            cache.compact([])
+        self.next_tokens = None
+        self.prev_tokens = None
+        self.history = None
+        self.remaining = None
+        self.temperatures = None
+        self.top_ps = None
+
+    def _update_sampling_params(self):
+        device = self.next_tokens.device # type: ignore
+        self.temperatures = torch.tensor(
+            [request.temperature for request in self.rows], device=device)
+        self.top_ps = torch.tensor(
+            [request.top_p for request in self.rows], device=device)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    from .engine import LlamaEngine
+
+    class ByteTokenizer():
+        '''
+        UTF-8 bytes after <unk>, <s> and </s>, enough to serve a random
+        model.
+        '''
+        eos_token_id = 2
+        is_fast = False
+
+        def __len__(self) -> int:
+            return 3 + 256
+
+        def encode(self, text: str, add_special_tokens: bool=True) -> list[int]:
+            ids = [byte + 3 for byte in text.encode('utf-8')]
+            if add_special_tokens:
+                return [1] + ids
+            return ids
+
+        def decode(self, ids: list[int]) -> str:
+            return bytes(idx - 3 for idx in ids if idx >= 3).decode('utf-8',
+                errors='replace')
+
+    parser = argparse.ArgumentParser(description='Check that every queued ' +
+        'and running generation fails when a decode step raises, on a tiny ' +
+        'randomly initialized LLaMA.')
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--max-batch-size', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=30.)
+    args = parser.parse_args()
+
+    tokenizer = ByteTokenizer()
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+    )
+    engine = LlamaEngine('', '', 16, device='cpu',
+        max_batch_size=args.max_batch_size,
+        model=LlamaForCausalLM(config).eval(),
+        tokenizer=tokenizer)
+
+    def failing_decode(*inputs, **kwargs):
+        raise RuntimeError('decode step failed')
+
+    # The first step admits max_batch_size requests and leaves the rest
+    # queued, then its decode raises.
+    engine.decoder.decode = failing_decode # type: ignore
+
+    async def check() -> bool:
+        results = await asyncio.wait_for(asyncio.gather(*[
+            engine.predict_text(f'Prompt {idx}', 16, 1., 1.)
+            for idx in range(args.requests)], return_exceptions=True),
+            args.timeout)
+        return all(isinstance(result, RuntimeError) for result in results)
+
+    try:
+        resolved = asyncio.run(check())
+    except asyncio.TimeoutError:
+        print(f'Generations still waited after {args.timeout} seconds.')
+        raise SystemExit(1)
+    finally:
+        engine.worker.shutdown() # type: ignore
+    if not resolved:
+        print('A generation did not fail with the decode step.')
+        raise SystemExit(1)
+    print('A failing decode step fails every queued and running generation.')
@@ -0,0 +1,50 @@
+from typing import Callable
+
+
+CANCEL_ABANDONED = 'abandoned'
+CANCEL_DELETED = 'deleted'
+CANCEL_DISCONNECTED = 'disconnected'
+CANCEL_TIMEOUT = 'timeout'
+CANCEL_USER = 'user'
+
+
+class GenerationCancelled(Exception):
+    '''
+    Raised for a request that was cancelled before its prompt was prefilled.
+    '''
+    def __init__(self, reason: str):
+        super().__init__(f'Generation cancelled ({reason})')
+        self.reason = reason
+
+
+class CancellationToken():
+    '''
+    Cancels a generation. cancel() is called from the event loop, and the
+    inference worker checks cancelled between decode steps, then drops the
+    request from the batch and frees its cache slot.
+    '''
+    reason: str|None = None
+
+    def __init__(self):
+        self._callbacks: list[Callable[['CancellationToken'], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str=CANCEL_USER):
+        if self.reason is not None:
+            return
+        self.reason = reason
+        for callback in self._callbacks:
+            callback(self)
+
+    def add_callback(self, callback: Callable[['CancellationToken'], None]):
+        '''
+        Call callback once the token is cancelled, right away if it already
+        is.
+        '''
+        if self.reason is not None:
+            callback(self)
+            return
+        self._callbacks.append(callback)
@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+from typing import Iterator, Type
+
+import torch
+import torch.nn as nn
+
+
+META = torch.device('meta')
+
+
+@contextmanager
+def init_on_meta(keep: tuple[Type[nn.Module], ...]=()) -> Iterator[None]:
+    '''
+    Put the parameters and persistent buffers of the modules constructed in
+    the body on the meta device, so they take no memory until a checkpoint
+    is loaded into them. Non-persistent buffers, such as the unpacking
+    shifts of QuantLinear, are never in a checkpoint and stay where they
+    were created, as do all tensors of modules of the keep types, which
+    compute more buffers from their own (e.g. the rotary caches from
+    inv_freq). Every tensor is moved right after its module creates it, so
+    at most one module is ever allocated.
+    '''
+    register_parameter = nn.Module.register_parameter
+    register_buffer = nn.Module.register_buffer
+
+    def register_meta_parameter(module, name, param):
+        if param is not None and not isinstance(module, keep):
+            param = nn.Parameter(param.to(META),
+                requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    def register_meta_buffer(module, name, tensor, persistent=True):
+        if tensor is not None and persistent and \
+            not isinstance(module, keep):
+            tensor = tensor.to(META)
+        register_buffer(module, name, tensor, persistent=persistent)
+
+    nn.Module.register_parameter = register_meta_parameter # type: ignore
+    nn.Module.register_buffer = register_meta_buffer # type: ignore
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter # type: ignore
+        nn.Module.register_buffer = register_buffer # type: ignore
+
+
+def load_safetensors(
+    model: nn.Module,
+    checkpoint: str,
+    device: torch.device,
+):
+    '''
+    Load a .safetensors checkpoint into a model made under init_on_meta().
+    The file is memory mapped and every tensor is read straight onto device
+    and assigned to its parameter or buffer, cast to its floating point
+    dtype, so host memory stays near a single tensor and loading is bound
+    by the disk. Like load_state_dict, raises if a tensor is missing,
+    unexpected or of the wrong shape.
+    '''
+    from safetensors import safe_open
+
+    expected = model.state_dict(keep_vars=True)
+    unexpected = []
+    with safe_open(checkpoint, framework='pt', device=str(device)) as tensors:
+        for name in tensors.keys():
+            target = expected.pop(name, None)
+            if target is None:
+                unexpected.append(name)
+                continue
+            tensor = tensors.get_tensor(name)
+            if tensor.shape != target.shape:
+                raise RuntimeError(f'{name} of {checkpoint} has the shape ' +
+                    f'{tuple(tensor.shape)}, expected {tuple(target.shape)}')
+            if tensor.is_floating_point() and target.is_floating_point():
+                tensor = tensor.to(target.dtype)
+            _assign(model, name, tensor)
+    if len(expected) > 0 or len(unexpected) > 0:
+        raise RuntimeError(f'Error loading {checkpoint}, missing keys: ' +
+            f'{sorted(expected)}, unexpected keys: {unexpected}')
+    left = meta_tensors(model)
+    if len(left) > 0:
+        raise RuntimeError('Tensors of the model were not loaded from ' +
+            f'{checkpoint} nor built: {left}')
+
+
+def meta_tensors(model: nn.Module) -> list[str]:
+    '''
+    The names of the parameters and buffers of model still on the meta
+    device.
+    '''
+    return [name for name, tensor in list(model.named_parameters()) +
+        list(model.named_buffers()) if tensor.is_meta]
+
+
+def _assign(model: nn.Module, name: str, tensor: torch.Tensor):
+    module_name, _, attr = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+        tensor = nn.Parameter(tensor, requires_grad=False)
+    setattr(module, attr, tensor)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import tempfile
+
+    from safetensors.torch import save_file
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    from .engine import load_quant
+    from .profiling import random_quantize
+    from .quant import QuantLinear
+
+    parser = argparse.ArgumentParser(description='Check that a random ' +
+        'quantized LLaMA saved as .safetensors loads back through ' +
+        'load_quant with the same weights and logits.')
+    parser.add_argument('--layers', type=int, default=2)
+    # QuantLinear packs zeros for 256 output features at a time.
+    parser.add_argument('--hidden-size', type=int, default=256)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--vocab-size', type=int, default=256)
+    parser.add_argument('--wbits', type=int, default=4, choices=[2, 3, 4, 8])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+    )
+    model = LlamaForCausalLM(config).eval()
+    # The quant_cuda kernel only runs on CUDA.
+    random_quantize(model, args.wbits, -1, kernel_switch_threshold=1)
+    with torch.no_grad():
+        # load_quant keeps some weights in half precision.
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            if tensor.is_floating_point():
+                tensor.copy_(tensor.half().float())
+
+    with tempfile.TemporaryDirectory() as path:
+        config.save_pretrained(path)
+        checkpoint = os.path.join(path, 'model.safetensors')
+        save_file({name: tensor.contiguous()
+            for name, tensor in model.state_dict().items()}, checkpoint)
+        loaded = load_quant(path, checkpoint, args.wbits, -1, device='cpu')
+
+    for module in loaded.modules():
+        if isinstance(module, QuantLinear):
+            module.kernel_switch_threshold = 1
+    loaded = loaded.float()
+    expected = model.state_dict()
+    mismatched = [name for name, tensor in loaded.state_dict().items()
+        if not torch.equal(tensor, expected[name])]
+    input_ids = torch.randint(3, args.vocab_size, (1, 16))
+    with torch.no_grad():
+        logits = loaded(input_ids).logits
+        expected_logits = model(input_ids).logits
+    if len(mismatched) > 0:
+        print('Tensors that differ after loading:', mismatched)
+        raise SystemExit(1)
+    if not torch.allclose(logits, expected_logits, atol=1e-4):
+        print('Logits differ by up to',
+            (logits - expected_logits).abs().max().item())
+        raise SystemExit(1)
+    print('load_quant loads .safetensors checkpoints back exactly.')
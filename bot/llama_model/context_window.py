@@ -0,0 +1,152 @@
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .tokenization import PromptEncoder
+
+
+MAX_TOKEN_WINDOW = 2048
+# Never give up more than this many new tokens to make room for the prompt.
+DEFAULT_MIN_NEW_TOKENS = 128
+
+
+class ContextWindow():
+    '''
+    Budgets the model's token window between the prompt and the tokens to
+    generate.
+
+    Prompts that do not fit are trimmed from the front at conversation turn
+    boundaries (occurrences of turn_markers, or line starts without any),
+    oldest turns first, while a matching pinned prefix such as the ALPACA
+    preamble is always kept. If even the last turn does not fit, max new
+    tokens are reduced down to min_new_tokens and after that the prompt is
+    cut at the token level.
+    '''
+    max_tokens: int = MAX_TOKEN_WINDOW
+    min_new_tokens: int = DEFAULT_MIN_NEW_TOKENS
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        max_tokens: int=MAX_TOKEN_WINDOW,
+        min_new_tokens: int=DEFAULT_MIN_NEW_TOKENS,
+        pinned_prefixes: list[str]|None=None,
+        turn_markers: list[str]|None=None,
+        encoder: 'PromptEncoder|None'=None,
+    ):
+        self.tokenizer = tokenizer
+        self.encoder = encoder
+        self.max_tokens = max_tokens
+        self.min_new_tokens = min(min_new_tokens, max_tokens - 1)
+        self.pinned_prefixes = pinned_prefixes or []
+        self.turn_markers = turn_markers or []
+        self._pinned_ids: dict[str, list[int]] = {}
+
+    def pinned_length(self, prompt: str, prompt_ids: list[int]) -> int:
+        '''
+        Return the number of tokens of the pinned prefix prompt starts with,
+        or 0 if none does or prompt_ids do not start with its tokens.
+        '''
+        for prefix in self.pinned_prefixes:
+            if not prompt.startswith(prefix):
+                continue
+            ids = self._pinned_ids.get(prefix, None)
+            if ids is None:
+                ids = self.tokenizer.encode(prefix)
+                self._pinned_ids[prefix] = ids
+            if prompt_ids[:len(ids)] == ids:
+                return len(ids)
+        return 0
+
+    def fit(
+        self,
+        prompt: str,
+        prompt_ids: list[int],
+        max_new_tokens: int,
+    ) -> tuple[list[int], int, int]:
+        '''
+        Return the prompt ids to use, the max new tokens to generate and how
+        many prompt tokens were dropped.
+        '''
+        max_new_tokens = max(1, min(max_new_tokens, self.max_tokens - 1))
+        if len(prompt_ids) + max_new_tokens <= self.max_tokens:
+            return prompt_ids, max_new_tokens, 0
+
+        pinned_text = next((prefix for prefix in self.pinned_prefixes
+            if prompt.startswith(prefix)), '')
+        newlines = None
+        if self.encoder is not None:
+            newlines = self.encoder.newline_positions(prompt, prompt_ids)
+        pinned_len = self._token_index(prompt, pinned_text, newlines)
+        pinned = prompt_ids[:pinned_len]
+
+        # Text offsets where a turn starts, oldest first. Fewer tokens are
+        # kept the later the cut, so binary search for the earliest cut that
+        # fits, tokenizing only the offsets that are looked at.
+        offsets = self._turn_starts(prompt, len(pinned_text))
+        token_idx: dict[int, int] = {}
+        def cut_at(i: int) -> int:
+            if i not in token_idx:
+                token_idx[i] = self._token_index(prompt,
+                    prompt[:offsets[i]], newlines)
+            return token_idx[i]
+
+        lo, hi = 0, len(offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._kept(pinned_len, prompt_ids, cut_at(mid)) + \
+                max_new_tokens <= self.max_tokens:
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo < len(offsets):
+            cut = cut_at(lo)
+            return pinned + prompt_ids[cut:], max_new_tokens, cut - pinned_len
+
+        # Keep at least the last turn by giving up new tokens.
+        if len(offsets) > 0:
+            cut = cut_at(len(offsets) - 1)
+            kept = self._kept(pinned_len, prompt_ids, cut)
+            if kept + self.min_new_tokens <= self.max_tokens:
+                return pinned + prompt_ids[cut:], self.max_tokens - kept, \
+                    cut - pinned_len
+
+        max_new_tokens = min(max_new_tokens, self.min_new_tokens)
+        keep_tail = self.max_tokens - max_new_tokens - pinned_len
+        if keep_tail < 1:
+            pinned, pinned_len = [], 0
+            keep_tail = self.max_tokens - max_new_tokens
+        cut = len(prompt_ids) - keep_tail
+        return pinned + prompt_ids[cut:], max_new_tokens, cut - pinned_len
+
+    def _kept(self, pinned_len: int, prompt_ids: list[int], cut: int) -> int:
+        return pinned_len + len(prompt_ids) - cut
+
+    def _token_index(
+        self,
+        prompt: str,
+        text: str,
+        newlines: list[int]|None,
+    ) -> int:
+        '''
+        Return the number of tokens of the start text of prompt, including
+        BOS so an empty pinned prefix still pins BOS. Text ending in a newline
+        is looked up from the newline tokens of the prompt when known.
+        '''
+        if newlines is not None and text.endswith('\n'):
+            return newlines[text.count('\n') - 1] + 1
+        return len(self.tokenizer.encode(text))
+
+    def _turn_starts(self, prompt: str, start: int) -> list[int]:
+        offsets = set()
+        markers = self.turn_markers or ['\n']
+        for marker in markers:
+            idx = prompt.find(marker, start + 1)
+            while idx > -1:
+                # Line starts are cut after the newline, turn markers before
+                # the marker itself.
+                offsets.add(idx + 1 if marker == '\n' else idx)
+                idx = prompt.find(marker, idx + 1)
+        # Turns always start after a newline, which LLaMA tokenizes on its
+        # own, so counting the tokens of the text before a turn gives the
+        # exact index of the turn in the full prompt.
+        return sorted(offset for offset in offsets if offset < len(prompt))
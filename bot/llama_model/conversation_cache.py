@@ -0,0 +1,174 @@
+import time
+
+import torch
+
+from .memory import tensor_bytes
+
+
+TIER_DEVICE = 'device'
+TIER_CPU = 'cpu'
+
+DEFAULT_CONVERSATION_DEVICE_MB = 2048
+DEFAULT_CONVERSATION_CPU_MB = 8192
+DEFAULT_CONVERSATION_TTL_SECONDS = 7200.
+
+
+class ConversationEntry():
+    '''
+    The tokens and final past_key_values of one finished generation.
+    '''
+    token_ids: list[int]|None = None
+    kv: tuple|None = None
+    tier: str = TIER_DEVICE
+    created: float = 0.
+    last_access: float = 0.
+    nbytes: int = 0
+
+    def __init__(self, token_ids: list[int], kv: tuple, tier: str):
+        self.token_ids = token_ids
+        self.kv = kv
+        self.tier = tier
+        self.created = time.monotonic()
+        self.last_access = self.created
+        self.nbytes = sum(tensor_bytes(k, v) for k, v in kv)
+
+
+class ConversationCache():
+    '''
+    Keeps the KV cache of completed generations keyed by their short_id so a
+    "Continue" only has to prefill the newly typed text.
+
+    Entries start on the device, are demoted to pinned CPU memory once the
+    device tier goes over its budget and are evicted once the CPU tier goes
+    over its budget or they are older than ttl_seconds. Least recently used
+    entries go first.
+    '''
+    device_max_bytes: int = DEFAULT_CONVERSATION_DEVICE_MB * 1024 ** 2
+    cpu_max_bytes: int = DEFAULT_CONVERSATION_CPU_MB * 1024 ** 2
+    ttl_seconds: float = DEFAULT_CONVERSATION_TTL_SECONDS
+    hits: int = 0
+    misses: int = 0
+    demotions: int = 0
+    evictions: int = 0
+
+    def __init__(
+        self,
+        device: torch.device,
+        device_mb: int=DEFAULT_CONVERSATION_DEVICE_MB,
+        cpu_mb: int=DEFAULT_CONVERSATION_CPU_MB,
+        ttl_seconds: float=DEFAULT_CONVERSATION_TTL_SECONDS,
+    ):
+        self.device = device
+        self.device_max_bytes = device_mb * 1024 ** 2
+        self.cpu_max_bytes = cpu_mb * 1024 ** 2
+        self.ttl_seconds = ttl_seconds
+        self.entries: dict[str, ConversationEntry] = {}
+        if device.type == 'cpu':
+            # There is no separate device tier to spill from.
+            self.cpu_max_bytes += self.device_max_bytes
+            self.device_max_bytes = 0
+
+    def put(self, short_id: str, token_ids: list[int], kv: tuple):
+        '''
+        Retain kv, ([1, heads, len(token_ids), head_dim], ...) per layer, for
+        the conversation ending in short_id.
+        '''
+        tier = TIER_CPU if self.device.type == 'cpu' else TIER_DEVICE
+        self.entries[short_id] = ConversationEntry(token_ids, kv, tier)
+        self.expire()
+        self._rebalance()
+
+    def match(
+        self,
+        short_id: str,
+        token_ids: list[int],
+    ) -> tuple[int, tuple|None]:
+        '''
+        Return the length of the common prefix of token_ids and the retained
+        conversation short_id, along with its past_key_values on the device.
+        '''
+        entry = self.entries.get(short_id, None)
+        if entry is None or self._expired(entry):
+            self.misses += 1
+            return 0, None
+
+        n = 0
+        limit = min(len(entry.token_ids), len(token_ids)) # type: ignore
+        while n < limit and entry.token_ids[n] == token_ids[n]: # type: ignore
+            n += 1
+        if n == 0:
+            self.misses += 1
+            return 0, None
+
+        self.hits += 1
+        entry.last_access = time.monotonic()
+        non_blocking = entry.tier == TIER_CPU
+        past_key_values = tuple(
+            (k[:, :, :n].to(self.device, non_blocking=non_blocking),
+                v[:, :, :n].to(self.device, non_blocking=non_blocking))
+            for k, v in entry.kv # type: ignore
+        )
+        return n, past_key_values
+
+    def expire(self):
+        for short_id in [short_id for short_id, entry in self.entries.items()
+            if self._expired(entry)]:
+            del self.entries[short_id]
+            self.evictions += 1
+
+    def demote_all(self):
+        '''
+        Move every entry off the device, e.g. when the model is offloaded.
+        '''
+        for entry in self.entries.values():
+            if entry.tier == TIER_DEVICE:
+                self._demote(entry)
+        self._rebalance()
+
+    def tier_bytes(self, tier: str) -> int:
+        return sum(entry.nbytes for entry in self.entries.values()
+            if entry.tier == tier)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'device_bytes': self.tier_bytes(TIER_DEVICE),
+            'cpu_bytes': self.tier_bytes(TIER_CPU),
+            'hits': self.hits,
+            'misses': self.misses,
+            'demotions': self.demotions,
+            'evictions': self.evictions,
+        }
+
+    def _expired(self, entry: ConversationEntry) -> bool:
+        return time.monotonic() - entry.created > self.ttl_seconds
+
+    def _lru(self, tier: str) -> tuple[str, ConversationEntry]:
+        return min(
+            ((short_id, entry) for short_id, entry in self.entries.items()
+                if entry.tier == tier),
+            key=lambda item: item[1].last_access,
+        )
+
+    def _rebalance(self):
+        while self.tier_bytes(TIER_DEVICE) > self.device_max_bytes:
+            self._demote(self._lru(TIER_DEVICE)[1])
+        while self.tier_bytes(TIER_CPU) > self.cpu_max_bytes:
+            del self.entries[self._lru(TIER_CPU)[0]]
+            self.evictions += 1
+
+    def _demote(self, entry: ConversationEntry):
+        pin = torch.cuda.is_available()
+        entry.kv = tuple(
+            (_to_host(k, pin), _to_host(v, pin))
+            for k, v in entry.kv # type: ignore
+        )
+        entry.tier = TIER_CPU
+        self.demotions += 1
+
+
+def _to_host(t: torch.Tensor, pin: bool) -> torch.Tensor:
+    t = t.to('cpu')
+    if pin:
+        t = t.pin_memory()
+    return t
@@ -0,0 +1,372 @@
+import math
+
+import torch
+
+from .context_window import MAX_TOKEN_WINDOW
+
+
+class StaticKVCache():
+    '''
+    Preallocated keys and values for up to `slots` sequences of up to max_len
+    tokens, one [slots, heads, max_len, head_dim] buffer per layer and kind.
+
+    New keys and values are written in place, so decoding does not allocate
+    or concatenate per token. lengths holds the number of tokens written to
+    every slot. With layer_devices, the buffers of every layer live on the
+    device of that layer.
+    '''
+    slots: int = 0
+    max_len: int = MAX_TOKEN_WINDOW
+
+    def __init__(
+        self,
+        num_layers: int,
+        slots: int,
+        num_heads: int,
+        head_dim: int,
+        max_len: int,
+        device: torch.device,
+        dtype: torch.dtype,
+        layer_devices: list[torch.device]|None=None,
+    ):
+        self.slots = slots
+        self.max_len = max_len
+        shape = (slots, num_heads, max_len, head_dim)
+        if layer_devices is None:
+            layer_devices = [device] * num_layers
+        self.keys = [torch.zeros(shape, dtype=dtype, device=layer_device)
+            for layer_device in layer_devices]
+        self.values = [torch.zeros(shape, dtype=dtype, device=layer_device)
+            for layer_device in layer_devices]
+        self.lengths = [0] * slots
+
+    @property
+    def nbytes(self) -> int:
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size()
+            for k, v in zip(self.keys, self.values))
+
+    @property
+    def token_bytes(self) -> int:
+        '''
+        Bytes of keys and values of a single token of a single slot.
+        '''
+        return self.nbytes // (self.slots * self.max_len)
+
+    def past(self, slot: int, length: int|None=None) -> tuple:
+        '''
+        Return views of the first length tokens of slot as HF style
+        past_key_values, ([1, heads, length, head_dim], ...) per layer.
+        '''
+        if length is None:
+            length = self.lengths[slot]
+        return tuple(
+            (k[slot:slot + 1, :, :length], v[slot:slot + 1, :, :length])
+            for k, v in zip(self.keys, self.values)
+        )
+
+    def load(self, slot: int, past_key_values: tuple, length: int):
+        '''
+        Copy the first length tokens of HF style past_key_values into slot.
+        '''
+        for k, v, (past_k, past_v) in zip(self.keys, self.values,
+            past_key_values):
+            k[slot, :, :length].copy_(past_k[0, :, :length])
+            v[slot, :, :length].copy_(past_v[0, :, :length])
+        self.lengths[slot] = length
+
+    def move(self, src: int, dst: int):
+        length = self.lengths[src]
+        for k, v in zip(self.keys, self.values):
+            k[dst, :, :length].copy_(k[src, :, :length])
+            v[dst, :, :length].copy_(v[src, :, :length])
+        self.lengths[dst] = length
+        self.lengths[src] = 0
+
+    def compact(self, keep: list[int]):
+        '''
+        Move the slots in keep, in increasing order, to the front.
+        '''
+        for dst, src in enumerate(keep):
+            if src != dst:
+                self.move(src, dst)
+        for slot in range(len(keep), self.slots):
+            self.lengths[slot] = 0
+
+
+class LlamaDecoder():
+    '''
+    Runs the layers of a LlamaForCausalLM over a StaticKVCache instead of
+    through the HF forward, which concatenates past_key_values and rebuilds
+    the 4D attention mask every step.
+
+    The running batch occupies slots 0..n-1 of the cache. Only the logits of
+    the last position are computed, the full prompt logits are never
+    materialized.
+    '''
+    cache: StaticKVCache|None = None
+    slots: int = 1
+    max_len: int = MAX_TOKEN_WINDOW
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        device: torch.device,
+        slots: int,
+        max_len: int=MAX_TOKEN_WINDOW,
+    ):
+        config = model.config
+        self.model = model
+        self.device = device
+        self.slots = slots
+        self.max_len = max_len
+        self.num_heads = config.num_attention_heads
+        self.head_dim = config.hidden_size // config.num_attention_heads
+
+        inv_freq = 1.0 / (10000 ** (torch.arange(0, self.head_dim, 2).float() /
+            self.head_dim))
+        freqs = torch.outer(torch.arange(max_len).float(), inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        self._cos_cpu = emb.cos()
+        self._sin_cpu = emb.sin()
+        self._cos: torch.Tensor|None = None
+        self._sin: torch.Tensor|None = None
+        self._positions: torch.Tensor|None = None
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.model.model.embed_tokens.weight.dtype
+
+    @property
+    def lengths(self) -> list[int]:
+        return self.cache.lengths # type: ignore
+
+    def allocate(self):
+        '''
+        Allocate the cache and position tables on the device, if needed.
+        '''
+        if self.cache is not None:
+            return
+        self.cache = StaticKVCache(len(self.model.model.layers), self.slots,
+            self.num_heads, self.head_dim, self.max_len, self.device,
+            self.dtype)
+        self._cos = self._cos_cpu.to(self.device, self.dtype)
+        self._sin = self._sin_cpu.to(self.device, self.dtype)
+        self._positions = torch.arange(self.max_len, device=self.device)
+
+    def free(self):
+        self.cache = None
+        self._cos = None
+        self._sin = None
+        self._positions = None
+
+    def prefill(
+        self,
+        slot: int,
+        input_ids: torch.Tensor,
+        start: int,
+    ) -> torch.Tensor:
+        '''
+        Run the [1, len] input_ids at positions start.. of slot, whose first
+        start tokens must already be in the cache. Returns the [1, vocab]
+        logits of the last position.
+        '''
+        length = input_ids.shape[1]
+        end = start + length
+        positions = self._positions[start:end].unsqueeze(0) # type: ignore
+        # Causal: query i (at position start + i) sees keys 0..start + i.
+        visible = self._positions[:end].unsqueeze(0) <= \
+            positions.unsqueeze(-1) # type: ignore
+        logits = self._forward(input_ids, positions, visible.unsqueeze(1),
+            slice(slot, slot + 1), end,
+            lambda cache, new: cache[slot, :, start:end].copy_(new[0]))
+        self.lengths[slot] = end
+        return logits[:, -1, :]
+
+    def decode(
+        self,
+        input_ids: torch.Tensor,
+        all_logits: bool=False,
+    ) -> torch.Tensor:
+        '''
+        Run [batch, len] tokens for each of the slots 0..batch-1 at the end of
+        its sequence and advance its length by len. Returns the [batch, vocab]
+        logits of the last position, or the [batch, len, vocab] logits of
+        every position with all_logits.
+        '''
+        batch_size, length = input_ids.shape
+        lengths = self.lengths[:batch_size]
+        span = max(lengths) + length
+        if span > self.max_len:
+            raise ValueError(f'Sequence grew past {self.max_len} tokens')
+        rows = self._positions[:batch_size].unsqueeze(1) # type: ignore
+        positions = torch.tensor(lengths, device=self.device).unsqueeze(1) + \
+            self._positions[:length].unsqueeze(0) # type: ignore
+        visible = self._positions[:span].view(1, 1, -1) <= \
+            positions.unsqueeze(-1) # type: ignore
+        def write(cache: torch.Tensor, new: torch.Tensor):
+            cache[rows, :, positions] = new.transpose(1, 2)
+        logits = self._forward(input_ids, positions, visible.unsqueeze(1),
+            slice(0, batch_size), span, write, last_only=not all_logits)
+        for slot in range(batch_size):
+            self.lengths[slot] += length
+        if not all_logits:
+            return logits[:, -1, :]
+        return logits
+
+    def _forward(
+        self,
+        input_ids: torch.Tensor,
+        positions: torch.Tensor,
+        visible: torch.Tensor,
+        slots: slice,
+        span: int,
+        write,
+        last_only: bool=True,
+    ) -> torch.Tensor:
+        model = self.model.model
+        cos = self._cos[positions].unsqueeze(1) # type: ignore
+        sin = self._sin[positions].unsqueeze(1) # type: ignore
+        hidden = self._layers(model.embed_tokens(input_ids),
+            range(len(model.layers)), cos, sin, visible, slots, span, write)
+        return self._head(hidden, last_only)
+
+    def _layers(
+        self,
+        hidden: torch.Tensor,
+        layer_ids: range,
+        cos: torch.Tensor,
+        sin: torch.Tensor,
+        visible: torch.Tensor,
+        slots: slice,
+        span: int,
+        write,
+    ) -> torch.Tensor:
+        layers = self.model.model.layers
+        batch_size, length, _ = hidden.shape
+        for idx in layer_ids:
+            layer = layers[idx]
+            k_cache = self.cache.keys[idx] # type: ignore
+            v_cache = self.cache.values[idx] # type: ignore
+            attn = layer.self_attn
+            residual = hidden
+            hidden = layer.input_layernorm(hidden)
+
+            q = self._heads(attn.q_proj(hidden), batch_size, length)
+            k = self._heads(attn.k_proj(hidden), batch_size, length)
+            v = self._heads(attn.v_proj(hidden), batch_size, length)
+            q = q * cos + _rotate_half(q) * sin
+            k = k * cos + _rotate_half(k) * sin
+            write(k_cache, k)
+            write(v_cache, v)
+            out = self._attend(q, k_cache[slots, :, :span],
+                v_cache[slots, :, :span], visible).transpose(1, 2).reshape(
+                batch_size, length, -1)
+            hidden = residual + attn.o_proj(out)
+
+            residual = hidden
+            hidden = residual + layer.mlp(
+                layer.post_attention_layernorm(hidden))
+        return hidden
+
+    def _attend(
+        self,
+        q: torch.Tensor,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        visible: torch.Tensor,
+    ) -> torch.Tensor:
+        scores = torch.matmul(q, keys.transpose(2, 3)) / \
+            math.sqrt(self.head_dim)
+        scores = scores.masked_fill(~visible, torch.finfo(scores.dtype).min)
+        probs = scores.softmax(dim=-1, dtype=torch.float32).to(q.dtype)
+        return torch.matmul(probs, values)
+
+    def _head(self, hidden: torch.Tensor, last_only: bool) -> torch.Tensor:
+        if last_only:
+            hidden = hidden[:, -1:, :]
+        return self.model.lm_head(self.model.model.norm(hidden))
+
+    def _heads(
+        self,
+        x: torch.Tensor,
+        batch_size: int,
+        length: int,
+    ) -> torch.Tensor:
+        return x.view(batch_size, length, self.num_heads,
+            self.head_dim).transpose(1, 2)
+
+
+def _rotate_half(x: torch.Tensor) -> torch.Tensor:
+    half = x.shape[-1] // 2
+    return torch.cat((-x[..., half:], x[..., :half]), dim=-1)
+
+
+@torch.no_grad()
+def check_parity(
+    model: torch.nn.Module,
+    prompt_ids: list[int],
+    max_new_tokens: int,
+    slots: int=2,
+    decoder: LlamaDecoder|None=None,
+) -> bool:
+    '''
+    Compare greedy decoding through LlamaDecoder, or the given decoder with
+    at least two slots, with model.generate. The prompt is also decoded in
+    slot 1 next to a shorter copy in slot 0 to check batched rows of
+    different lengths.
+    '''
+    device = next(model.parameters()).device
+    input_ids = torch.tensor([prompt_ids], device=device)
+    expected = model.generate(input_ids, do_sample=False,
+        max_new_tokens=max_new_tokens)[0, len(prompt_ids):].tolist()
+
+    if decoder is None:
+        decoder = LlamaDecoder(model, device, slots=slots,
+            max_len=len(prompt_ids) + max_new_tokens + 1)
+    decoder.allocate()
+    short_ids = input_ids[:, :max(1, len(prompt_ids) // 2)]
+    tokens = torch.cat([
+        decoder.prefill(0, short_ids, 0).argmax(dim=-1, keepdim=True),
+        decoder.prefill(1, input_ids, 0).argmax(dim=-1, keepdim=True),
+    ])
+    generated = [int(tokens[1, 0])]
+    while len(generated) < max_new_tokens:
+        tokens = decoder.decode(tokens).argmax(dim=-1, keepdim=True)
+        generated.append(int(tokens[1, 0]))
+    if generated != expected:
+        print('Decoder output:', generated)
+        print('generate() output:', expected)
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    parser = argparse.ArgumentParser(description='Check that LlamaDecoder ' +
+        'decodes like generate() on a tiny randomly initialized LLaMA.')
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--vocab-size', type=int, default=256)
+    parser.add_argument('--prompt-len', type=int, default=12)
+    parser.add_argument('--new-tokens', type=int, default=24)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+    )
+    model = LlamaForCausalLM(config).eval()
+    prompt = torch.randint(3, args.vocab_size, (args.prompt_len,)).tolist()
+    if check_parity(model, prompt, args.new_tokens):
+        print('LlamaDecoder matches generate().')
+    else:
+        raise SystemExit(1)
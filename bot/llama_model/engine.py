@@ -1,4 +1,5 @@
-import gc
+import asyncio
+import contextlib
 import time
 
 import torch
@@ -7,15 +8,62 @@ import torch.nn as nn
 from .gptq import *
 from .modelutils import *
 from .quant import *
-
-from transformers import AutoTokenizer
-from transformers import (
-    AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList,
+from .batching import (
+    DEFAULT_MAX_BATCH_SIZE,
+    DEFAULT_MIN_NEW_TOKENS_BEFORE_STOP,
+    BatchScheduler,
+    GenerationRequest,
+    GenerationResult,
+)
+from .cancellation import CANCEL_ABANDONED, CancellationToken
+from .checkpoint import init_on_meta, load_safetensors
+from .context_window import (
+    DEFAULT_MIN_NEW_TOKENS,
+    MAX_TOKEN_WINDOW,
+    ContextWindow,
+)
+from .conversation_cache import (
+    DEFAULT_CONVERSATION_CPU_MB,
+    DEFAULT_CONVERSATION_DEVICE_MB,
+    DEFAULT_CONVERSATION_TTL_SECONDS,
+    ConversationCache,
+)
+from .decode import LlamaDecoder
+from .memory import (
+    DEFAULT_TRIM_WATERMARK_MB,
+    MemoryAccountant,
+)
+from .metrics import REGISTRY
+from .pipeline import PipelinedDecoder
+from .prefix_cache import (
+    DEFAULT_PREFIX_CACHE_ENTRY_TOKENS,
+    DEFAULT_PREFIX_CACHE_MB,
+    PrefixCache,
 )
+from .profiling import LayerProfiler
+from .residency import (
+    DEFAULT_OFFLOAD_IDLE_SECONDS,
+    DEFAULT_OFFLOAD_MEMORY_FRACTION,
+    RESIDENCY_ALWAYS,
+    ModelResidency,
+)
+from .speculative import (
+    DEFAULT_SPECULATIVE_TOKENS,
+    DraftModelProposer,
+    PromptLookupProposer,
+    SpeculativeProposer,
+)
+from .stopping import StopSequenceMatcher
+from .stream import TokenStream
+from .tokenization import (
+    DEFAULT_PROMPT_CACHE_ENTRIES,
+    PromptEncoder,
+    load_tokenizer,
+)
+from .worker import InferenceWorker
 
 
 DEFAULT_GROUPSIZE = -1
-MAX_TOKEN_WINDOW = 2048
 
 
 def get_llama(model):
@@ -31,8 +79,9 @@ def get_llama(model):
     return model
 
 
-def load_quant(model, checkpoint, wbits, groupsize):
+def load_quant(model, checkpoint, wbits, groupsize, device=None):
     from transformers import LlamaConfig, LlamaForCausalLM 
+    from transformers.models.llama.modeling_llama import LlamaRotaryEmbedding
     model_name = model
     config = LlamaConfig.from_pretrained(model)
     def noop(*args, **kwargs):
@@ -41,45 +90,80 @@ def load_quant(model, checkpoint, wbits, groupsize):
     torch.nn.init.uniform_ = noop 
     torch.nn.init.normal_ = noop 
 
-    torch.set_default_dtype(torch.half)
-    transformers.modeling_utils._init_weights = False
-    torch.set_default_dtype(torch.half)
-    model = LlamaForCausalLM(config)
-    torch.set_default_dtype(torch.float)
-    model = model.eval()
-    layers = find_layers(model)
-    for name in ['lm_head']:
-        if name in layers:
-            del layers[name]
-    make_quant(model, layers, wbits, groupsize)
+    # A .safetensors checkpoint is memory mapped and streamed into a model
+    # without weights, straight onto device, instead of building the whole
+    # model on the CPU and copying the whole checkpoint into it.
+    lazy = checkpoint.endswith('.safetensors')
+    # The rotary embeddings compute their caches when they are created, and
+    # those are not in the checkpoint.
+    with init_on_meta(keep=(LlamaRotaryEmbedding,)) if lazy else \
+        contextlib.nullcontext():
+        torch.set_default_dtype(torch.half)
+        transformers.modeling_utils._init_weights = False
+        torch.set_default_dtype(torch.half)
+        model = LlamaForCausalLM(config)
+        torch.set_default_dtype(torch.float)
+        model = model.eval()
+        layers = find_layers(model)
+        for name in ['lm_head']:
+            if name in layers:
+                del layers[name]
+        make_quant(model, layers, wbits, groupsize)
 
     print(f'Loading model {model_name} (bits: {wbits}, groupsize: {groupsize})...')
-    if checkpoint.endswith('.safetensors'):
-        from safetensors.torch import load_file as safe_load
-        model.load_state_dict(safe_load(checkpoint))
+    tick = time.perf_counter()
+    if lazy:
+        load_safetensors(model, checkpoint, torch.device(device or 'cpu'))
     else:
         model.load_state_dict(torch.load(checkpoint))
     model.seqlen = 2048
-    print('Model loaded.')
+    print(f'Model loaded in {time.perf_counter() - tick:.1f}s.')
 
     return model
 
 
-class KeywordsStoppingCriteria(StoppingCriteria):
-    def __init__(self, keywords_ids:list):
-        self.keywords = keywords_ids
+BATCH_ROWS = REGISTRY.gauge('yal_engine_batch_rows',
+    'Generations in the running batch.', ('device',))
+PENDING_REQUESTS = REGISTRY.gauge('yal_engine_pending_requests',
+    'Generations waiting to join the batch.', ('device',))
+MEMORY_BYTES = REGISTRY.gauge('yal_engine_memory_bytes',
+    'Device memory of the engine, by what it is used for.',
+    ('device', 'kind'))
+MEMORY_TRIMS = REGISTRY.counter('yal_engine_memory_trims_total',
+    'Times the engine trimmed its caches to free device memory.',
+    ('device',))
+MODEL_RESIDENT = REGISTRY.gauge('yal_engine_model_resident',
+    'Whether the model weights are on the device.', ('device',))
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        inp_ids = input_ids[0].tolist()
-        if any(kw == inp_ids[-len(kw):] for kw in self.keywords):
-            return True
-        return False
+
+# memory_stats() keys exported as MEMORY_BYTES kinds.
+METRICS_MEMORY_KINDS = {
+    'kv_cache_bytes': 'kv_cache',
+    'activations_bytes': 'activations',
+    'output_bytes': 'output',
+    'device_allocated_bytes': 'allocated',
+    'device_reserved_bytes': 'reserved',
+    'device_peak_bytes': 'peak',
+}
 
 
 class LlamaEngine():
     model = None
     device = None
-    stop_criteria = None
+    context_window: ContextWindow|None = None
+    conversation_cache: ConversationCache|None = None
+    decoder: LlamaDecoder|None = None
+    eos_token_id: int|None = None
+    memory: MemoryAccountant|None = None
+    min_new_tokens: int = DEFAULT_MIN_NEW_TOKENS_BEFORE_STOP
+    prefix_cache: PrefixCache|None = None
+    profiler: LayerProfiler|None = None
+    prompt_encoder: PromptEncoder|None = None
+    residency: ModelResidency|None = None
+    scheduler: BatchScheduler|None = None
+    speculator: SpeculativeProposer|None = None
+    stop_matcher: StopSequenceMatcher|None = None
+    worker: InferenceWorker|None = None
 
     def __init__(
         self,
@@ -88,22 +172,141 @@ class LlamaEngine():
         wbits: int,
         groupsize: int=DEFAULT_GROUPSIZE,
         device: str='cuda:0',
+        max_batch_size: int=DEFAULT_MAX_BATCH_SIZE,
+        residency: str=RESIDENCY_ALWAYS,
+        offload_idle_seconds: float=DEFAULT_OFFLOAD_IDLE_SECONDS,
+        offload_memory_fraction: float=DEFAULT_OFFLOAD_MEMORY_FRACTION,
+        trim_watermark_mb: int=DEFAULT_TRIM_WATERMARK_MB,
+        prefix_cache_mb: int=DEFAULT_PREFIX_CACHE_MB,
+        prefix_cache_entry_tokens: int=DEFAULT_PREFIX_CACHE_ENTRY_TOKENS,
+        conversation_cache_mb: int=DEFAULT_CONVERSATION_DEVICE_MB,
+        conversation_cache_cpu_mb: int=DEFAULT_CONVERSATION_CPU_MB,
+        conversation_ttl_seconds: float=DEFAULT_CONVERSATION_TTL_SECONDS,
+        stop_strings: list[str]|None=None,
+        pinned_prefixes: list[str]|None=None,
+        turn_markers: list[str]|None=None,
+        context_min_new_tokens: int=DEFAULT_MIN_NEW_TOKENS,
+        min_new_tokens: int=DEFAULT_MIN_NEW_TOKENS_BEFORE_STOP,
+        prompt_templates: list[str]|None=None,
+        prompt_cache_entries: int=DEFAULT_PROMPT_CACHE_ENTRIES,
+        fast_tokenizer: bool=True,
+        draft_model_str: str|None=None,
+        draft_checkpoint: str|None=None,
+        draft_wbits: int|None=None,
+        draft_groupsize: int=DEFAULT_GROUPSIZE,
+        speculative_tokens: int=DEFAULT_SPECULATIVE_TOKENS,
+        prompt_lookup: bool=False,
+        prompt_lookup_ngram: int=3,
+        pipeline_devices: list[str]|None=None,
+        micro_batches: int|None=None,
+        profile_layers: bool=False,
+        model: nn.Module|None=None,
+        tokenizer=None,
     ):
+        pipelined = pipeline_devices is not None and len(pipeline_devices) > 1
+        if pipelined:
+            if residency != RESIDENCY_ALWAYS:
+                raise ValueError('A model split across devices can not be ' +
+                    'offloaded, use residency always')
+            device = pipeline_devices[0] # type: ignore
         DEV = torch.device(device)
         self.device = DEV
 
-        model = load_quant(model_str, checkpoint, wbits, groupsize)
-            
-        model.to(DEV)
+        # An already loaded model and tokenizer may be given instead, as the
+        # benchmark does with a tiny random model.
+        if model is None:
+            # A model split across devices is loaded on the CPU first.
+            model = load_quant(model_str, checkpoint, wbits, groupsize,
+                device='cpu' if pipelined else DEV)
+
+        if pipelined:
+            # Layers are split across the devices and concurrent rows stream
+            # through them in micro-batches.
+            self.decoder = PipelinedDecoder(model,
+                [torch.device(name) for name in pipeline_devices], # type: ignore
+                slots=max_batch_size,
+                max_len=MAX_TOKEN_WINDOW,
+                micro_batches=micro_batches)
+        else:
+            model.to(DEV)
+            # Every batch row decodes in its own slot of a static KV cache
+            # that is allocated the first time the device is acquired.
+            self.decoder = LlamaDecoder(model, DEV, slots=max_batch_size,
+                max_len=MAX_TOKEN_WINDOW)
         self.model = model
-        tokenizer = AutoTokenizer.from_pretrained(model_str, use_fast=False)
+        if profile_layers:
+            # Times every module of the model, printed whenever the batch
+            # drains. Slows generation down.
+            self.profiler = LayerProfiler()
+            self.profiler.attach(model)
+            self.profiler.attach_decoder(self.decoder)
+        self.residency = ModelResidency(model, DEV,
+            mode=residency,
+            idle_seconds=offload_idle_seconds,
+            memory_fraction=offload_memory_fraction,
+            resident=True)
+        if draft_checkpoint is not None:
+            if draft_model_str is None:
+                raise ValueError('A draft checkpoint needs its draft model')
+            # A much smaller model of the same family proposes tokens that
+            # the model verifies several at a time. It stays on the device.
+            draft = load_quant(draft_model_str, draft_checkpoint,
+                draft_wbits or wbits, draft_groupsize, device=DEV)
+            draft.to(DEV)
+            if draft.config.vocab_size != model.config.vocab_size:
+                raise ValueError('The draft model must share the vocabulary ' +
+                    'of the model')
+            self.speculator = DraftModelProposer(draft, DEV,
+                slots=max_batch_size,
+                max_len=MAX_TOKEN_WINDOW,
+                num_tokens=speculative_tokens)
+        elif prompt_lookup:
+            # Without a draft model, propose repeats of the prompt instead.
+            self.speculator = PromptLookupProposer(
+                num_tokens=speculative_tokens,
+                ngram=prompt_lookup_ngram)
+        self.memory = MemoryAccountant(DEV, trim_watermark_mb=trim_watermark_mb)
+        if prefix_cache_mb > 0:
+            self.prefix_cache = PrefixCache(max_mb=prefix_cache_mb,
+                max_entry_tokens=prefix_cache_entry_tokens)
+        if conversation_cache_mb > 0 or conversation_cache_cpu_mb > 0:
+            self.conversation_cache = ConversationCache(DEV,
+                device_mb=conversation_cache_mb,
+                cpu_mb=conversation_cache_cpu_mb,
+                ttl_seconds=conversation_ttl_seconds)
+        self.eos_token_id = model.config.eos_token_id
+        if tokenizer is None:
+            tokenizer = load_tokenizer(model_str, use_fast=fast_tokenizer,
+                samples=prompt_templates)
         self.tokenizer = tokenizer
+        self.prompt_encoder = PromptEncoder(tokenizer,
+            templates=prompt_templates,
+            max_entries=prompt_cache_entries)
 
         # Weird stop words from the GPT4 finetuned models.
         stop_words = ['<unk>', '<s>', '</s>', '�', '!0']
         stop_ids = [[0]]
-        stop_ids.extend([tokenizer.encode(w) for w in stop_words])
-        self.stop_criteria = KeywordsStoppingCriteria(stop_ids)
+        # Without BOS, which generated text never contains.
+        stop_ids.extend([tokenizer.encode(w, add_special_tokens=False)
+            for w in stop_words])
+        self.context_window = ContextWindow(tokenizer,
+            max_tokens=MAX_TOKEN_WINDOW,
+            min_new_tokens=context_min_new_tokens,
+            pinned_prefixes=pinned_prefixes,
+            turn_markers=turn_markers,
+            encoder=self.prompt_encoder)
+        self.min_new_tokens = min_new_tokens
+        self.stop_matcher = StopSequenceMatcher(stop_ids,
+            eos_token_id=self.eos_token_id,
+            stop_strings=stop_strings)
+
+        # All generation happens on this thread so that the event loop is
+        # never blocked by the model. The scheduler steps the running batch
+        # on it between jobs.
+        self.worker = InferenceWorker()
+        self.worker.idle_fn = self.idle
+        self.scheduler = BatchScheduler(self, max_batch_size=max_batch_size)
+        REGISTRY.add_collector(self.collect_metrics)
 
     async def predict_text(
         self,
@@ -111,39 +314,189 @@ class LlamaEngine():
         max_length: int,
         temperature: float,
         top_p: float,
-    ) -> str:
-        self.model.to(self.device)
-        input_ids = self.tokenizer.encode(prompt, return_tensors="pt") \
-            .to(self.device)
-        input_ids = input_ids[-MAX_TOKEN_WINDOW:]
-
-        with torch.no_grad():
-            generated_ids = self.model.generate(
-                input_ids,
-                do_sample=True,
-                min_length=10,
-                max_new_tokens=max_length,
-                top_p=top_p,
-                temperature=temperature,
-                stopping_criteria=StoppingCriteriaList([self.stop_criteria]),
-            )
-        output_tokens = [el.item() for el in generated_ids[0]]
-        for kw in self.stop_criteria.keywords:
-            if output_tokens[-len(kw):] == kw:
-                output_tokens = output_tokens[:-len(kw)]
-        output = self.tokenizer.decode(output_tokens)
+        request_id: str|None=None,
+        parent_id: str|None=None,
+        min_new_tokens: int|None=None,
+        cancel_token: CancellationToken|None=None,
+    ) -> GenerationResult:
+        '''
+        Queue a prompt into the running batch and await the generated text.
+
+        The final cache of the generation is retained under request_id, and
+        if parent_id is given the retained cache of that earlier generation
+        is reused for the prompt. Stop and EOS tokens can not be sampled
+        before min_new_tokens (default: the engine's) have been generated.
+
+        Cancelling cancel_token, or the awaiting task, stops the generation
+        after the current decode step and frees its slot in the batch.
+        '''
+        request = self._request(prompt, max_length, temperature, top_p,
+            request_id, parent_id, min_new_tokens, cancel_token)
+        try:
+            return await self.scheduler.submit(request) # type: ignore
+        except asyncio.CancelledError:
+            request.cancel_token.cancel(CANCEL_ABANDONED) # type: ignore
+            raise
+
+    def stream_text(
+        self,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        request_id: str|None=None,
+        parent_id: str|None=None,
+        min_new_tokens: int|None=None,
+        cancel_token: CancellationToken|None=None,
+    ) -> TokenStream:
+        '''
+        Like predict_text, but returns a TokenStream yielding the generated
+        text as it is decoded. Await stream.result() for the final
+        GenerationResult.
+        '''
+        request = self._request(prompt, max_length, temperature, top_p,
+            request_id, parent_id, min_new_tokens, cancel_token)
+        self.scheduler.enqueue(request, stream=True) # type: ignore
+        return request.stream # type: ignore
+
+    def _request(
+        self,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        request_id: str|None,
+        parent_id: str|None,
+        min_new_tokens: int|None,
+        cancel_token: CancellationToken|None,
+    ) -> GenerationRequest:
+        if min_new_tokens is None:
+            min_new_tokens = self.min_new_tokens
+        return GenerationRequest(prompt, max_length, temperature, top_p,
+            request_id=request_id, parent_id=parent_id,
+            min_new_tokens=min_new_tokens, cancel_token=cancel_token)
+
+    def encode_prompt(
+        self,
+        prompt: str,
+        parent_id: str|None=None,
+        request_id: str|None=None,
+    ) -> list[int]:
+        '''
+        Encode prompt, only tokenizing what follows the prompt of parent_id
+        or a prompt template when it starts with one. The ids are remembered
+        under request_id for prompts continuing from it.
+        '''
+        return self.prompt_encoder.encode(prompt, # type: ignore
+            parent_id=parent_id, key=request_id)
+
+    def decode_output(self, request: GenerationRequest) -> GenerationResult:
+        prompt_ids = request.prompt_ids
+        if request.dropped_tokens > 0:
+            # Return the output after the prompt as it was given, not the part
+            # of it that fit in the context window.
+            prompt_ids = self.encode_prompt(request.prompt,
+                parent_id=request.request_id)
+        output_ids = request.output_ids
+        for kw in self.stop_matcher.stop_ids: # type: ignore
+            if output_ids[-len(kw):] == kw: # type: ignore
+                output_ids = output_ids[:-len(kw)] # type: ignore
+        output, new_text = self.prompt_encoder.decode( # type: ignore
+            request.prompt, prompt_ids, output_ids) # type: ignore
+        if request.stop_string is not None:
+            if output.rfind(request.stop_string) > -1:
+                output = output[:output.rfind(request.stop_string)]
+            if new_text.rfind(request.stop_string) > -1:
+                new_text = new_text[:new_text.rfind(request.stop_string)]
 
         # TODO Why does the tokenizer generate these?
-        if output[-3:] == '</s>':
-            output = output[:-3]
         if output[-4:] == '</s>':
             output = output[:-4]
+        if new_text[-4:] == '</s>':
+            new_text = new_text[:-4]
+
+        return GenerationResult(output, new_text, request)
+
+    def acquire_device(self):
+        '''
+        Called by the scheduler before the batch goes from empty to running.
+        '''
+        self.residency.acquire() # type: ignore
+        self.decoder.allocate() # type: ignore
+        if self.speculator is not None:
+            self.speculator.allocate()
+
+    def release_device(self):
+        '''
+        Called by the scheduler once the batch has drained.
+        '''
+        self.residency.release() # type: ignore
+        self.trim_memory()
+        if self.profiler is not None:
+            print(self.profiler.report())
+
+    def trim_memory(self):
+        '''
+        Give cached allocator blocks back to the device if too much memory
+        is reserved but unused.
+        '''
+        if self.memory.maybe_trim(): # type: ignore
+            MEMORY_TRIMS.inc(device=str(self.device))
+
+    def idle(self):
+        '''
+        Called periodically by the inference worker while there is no work.
+        '''
+        if self.conversation_cache is not None:
+            self.conversation_cache.expire()
+        if self.residency.maybe_offload(): # type: ignore
+            # Cached keys and values live on the device too, give it back
+            # entirely.
+            self.decoder.free() # type: ignore
+            if self.speculator is not None:
+                self.speculator.free()
+            if self.prefix_cache is not None:
+                self.prefix_cache.clear()
+            if self.conversation_cache is not None:
+                self.conversation_cache.demote_all()
+
+    def collect_metrics(self):
+        device = str(self.device)
+        BATCH_ROWS.set(len(self.scheduler.rows), device=device) # type: ignore
+        PENDING_REQUESTS.set(len(self.scheduler.pending), device=device) # type: ignore
+        stats = self.memory_stats()
+        for key, kind in METRICS_MEMORY_KINDS.items():
+            MEMORY_BYTES.set(stats[key], device=device, kind=kind)
+        MODEL_RESIDENT.set(int(self.residency.resident), device=device) # type: ignore
+
+    def capacity(self) -> int:
+        '''
+        The number of generations batched at once.
+        '''
+        return min(self.scheduler.max_batch_size, # type: ignore
+            self.decoder.slots) # type: ignore
+
+    def layer_stats(self) -> list[dict]|None:
+        '''
+        Module timings of --profile-layers, slowest first.
+        '''
+        if self.profiler is None:
+            return None
+        return self.profiler.stats()
+
+    def memory_stats(self) -> dict:
+        return self.memory.stats() # type: ignore
+
+    def residency_stats(self) -> dict:
+        '''
+        Where the weights are and what moving them cost so far.
+        '''
+        return self.residency.stats() # type: ignore
 
-        self.model.to('cpu')
-        mem = torch.cuda.memory_allocated() / 1e6
-        del generated_ids, input_ids
-        gc.collect()
-        torch.cuda.empty_cache()
-        while torch.cuda.memory_allocated() / 1e6 >= mem:
-            time.sleep(1)
-        return output
+    def speculation_stats(self) -> dict|None:
+        '''
+        Acceptance statistics of speculative decoding, if enabled.
+        '''
+        if self.speculator is None:
+            return None
+        return self.speculator.stats()
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import struct
+
+from multiprocessing import resource_tracker, shared_memory
+
+
+DEFAULT_ENGINE_SOCKET = '/tmp/yal-engine.sock'
+
+# Upper bound of UTF-8 bytes per generated token used to size the shared
+# output buffer of a request, longer outputs are sent over the socket.
+MAX_BYTES_PER_TOKEN = 16
+
+_HEADER = struct.Struct('>I')
+
+
+async def read_message(reader: asyncio.StreamReader) -> dict|None:
+    '''
+    Read a length prefixed JSON message, or None once the other side closed
+    the connection.
+    '''
+    try:
+        header = await reader.readexactly(_HEADER.size)
+        body = await reader.readexactly(_HEADER.unpack(header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return json.loads(body)
+
+
+async def write_message(
+    writer: asyncio.StreamWriter,
+    message: dict,
+    lock: asyncio.Lock,
+):
+    body = json.dumps(message).encode('utf-8')
+    async with lock:
+        writer.write(_HEADER.pack(len(body)) + body)
+        await writer.drain()
+
+
+class SharedText():
+    '''
+    A shared memory buffer holding the prompt of a request followed by the
+    text generated for it, so neither goes through the socket.
+
+    The client creates and unlinks it, the engine process only attaches.
+    Every write appends UTF-8 text and returns the [start, end) byte span it
+    was written to, or None if it does not fit.
+    '''
+    def __init__(self, name: str|None=None, size: int=0):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Python tracks attached blocks too and would unlink them when
+            # the engine process exits, under the client.
+            resource_tracker.unregister(self.shm._name, # type: ignore
+                'shared_memory')
+            self.owner = False
+        self.end = 0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def size(self) -> int:
+        return self.shm.size
+
+    def write(self, text: str) -> tuple[int, int]|None:
+        data = text.encode('utf-8')
+        if self.end + len(data) > self.size:
+            return None
+        start = self.end
+        self.shm.buf[start:start + len(data)] = data
+        self.end = start + len(data)
+        return start, self.end
+
+    def read(self, start: int, end: int) -> str:
+        return bytes(self.shm.buf[start:end]).decode('utf-8')
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -3,7 +3,7 @@ import time
 import torch
 import torch.nn as nn
 
-from llama_engine.gptq import *
+from .gptq import *
 from .modelutils import *
 from .quant import *
 
@@ -57,12 +57,12 @@ def load_quant(model, checkpoint, wbits, groupsize):
 
 if __name__ == '__main__':
     import argparse
-    from datautils import *
+    import asyncio
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
-        'model', type=str,
+        'model', type=str, nargs='?',
         help='llama model to load'
     )
     parser.add_argument(
@@ -102,9 +102,37 @@ if __name__ == '__main__':
         '--temperature', type=float, default=0.8,
         help='The value used to module the next token probabilities.'
     )
+
+    parser.add_argument(
+        '--engine-socket', type=str,
+        help='Generate with the model of an engine server listening on this socket instead of loading it.'
+    )
     
     args = parser.parse_args()
 
+    if args.engine_socket:
+        from .remote import RemoteEngine
+
+        async def generate():
+            engine = RemoteEngine(args.engine_socket)
+            try:
+                stream = engine.stream_text(args.text, args.max_length,
+                    args.temperature, args.top_p,
+                    min_new_tokens=args.min_length)
+                print(args.text, end='', flush=True)
+                async for text in stream:
+                    print(text, end='', flush=True)
+                print()
+                return await stream.result()
+            finally:
+                await engine.close()
+
+        asyncio.run(generate())
+        exit()
+
+    if args.model is None:
+        parser.error('the model is required without --engine-socket')
+
     if type(args.load) is not str:
         args.load = args.load.as_posix()
     
@@ -0,0 +1,112 @@
+import torch
+
+
+MEMORY_KV_CACHE = 'kv_cache'
+MEMORY_ACTIVATIONS = 'activations'
+MEMORY_OUTPUT = 'output'
+
+DEFAULT_TRIM_WATERMARK_MB = 1024
+
+
+def tensor_bytes(*tensors: torch.Tensor|None) -> int:
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+class MemoryAccountant():
+    '''
+    Per-request accounting of engine memory.
+
+    The scheduler reports how many bytes each request holds of KV cache,
+    activations and output buffers while it runs and releases them when the
+    request retires. Allocator trimming (torch.cuda.empty_cache) only happens
+    when the memory cached by the allocator but not in use goes over
+    trim_watermark_bytes, instead of after every request.
+    '''
+    trim_watermark_bytes: int = DEFAULT_TRIM_WATERMARK_MB * 1024 ** 2
+    trims: int = 0
+    peak_tracked_bytes: int = 0
+    peak_device_bytes: int = 0
+
+    def __init__(
+        self,
+        device: torch.device,
+        trim_watermark_mb: int=DEFAULT_TRIM_WATERMARK_MB,
+    ):
+        self.device = device
+        self.trim_watermark_bytes = trim_watermark_mb * 1024 ** 2
+        self.requests: dict[int, dict[str, int]] = {}
+
+    def set(self, owner: object, kind: str, nbytes: int):
+        '''
+        Set the bytes of one kind currently held by owner.
+        '''
+        self.requests.setdefault(id(owner), {})[kind] = nbytes
+        self.peak_tracked_bytes = max(self.peak_tracked_bytes,
+            self.tracked_bytes())
+
+    def release(self, owner: object):
+        self.requests.pop(id(owner), None)
+
+    def tracked_bytes(self, kind: str|None=None) -> int:
+        return sum(
+            nbytes
+            for kinds in self.requests.values()
+            for k, nbytes in kinds.items()
+            if kind is None or k == kind
+        )
+
+    def device_bytes(self) -> tuple[int, int]:
+        '''
+        Return allocated and reserved bytes on the device.
+        '''
+        if self.device.type != 'cuda':
+            return 0, 0
+        return (
+            torch.cuda.memory_allocated(self.device),
+            torch.cuda.memory_reserved(self.device),
+        )
+
+    def measure_start(self):
+        '''
+        Start measuring the peak allocation of the next piece of work.
+        '''
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return torch.cuda.memory_allocated(self.device)
+        return 0
+
+    def measure_peak(self, start: int) -> int:
+        if self.device.type != 'cuda':
+            return 0
+        peak = torch.cuda.max_memory_allocated(self.device)
+        self.peak_device_bytes = max(self.peak_device_bytes, peak)
+        return peak - start
+
+    def maybe_trim(self) -> bool:
+        '''
+        Return cached allocator blocks to the device if too much memory is
+        reserved but unused.
+        '''
+        if self.device.type != 'cuda':
+            return False
+        allocated, reserved = self.device_bytes()
+        if reserved - allocated < self.trim_watermark_bytes:
+            return False
+        torch.cuda.empty_cache()
+        self.trims += 1
+        return True
+
+    def stats(self) -> dict:
+        allocated, reserved = self.device_bytes()
+        return {
+            'requests': len(self.requests),
+            'kv_cache_bytes': self.tracked_bytes(MEMORY_KV_CACHE),
+            'activations_bytes': self.tracked_bytes(MEMORY_ACTIVATIONS),
+            'output_bytes': self.tracked_bytes(MEMORY_OUTPUT),
+            'tracked_bytes': self.tracked_bytes(),
+            'peak_tracked_bytes': self.peak_tracked_bytes,
+            'device_allocated_bytes': allocated,
+            'device_reserved_bytes': reserved,
+            'device_peak_bytes': max(self.peak_device_bytes, allocated),
+            'trims': self.trims,
+        }
@@ -0,0 +1,269 @@
+import asyncio
+import math
+import os
+import threading
+
+from typing import Callable
+
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120.)
+TOKENS_PER_SECOND_BUCKETS = (1., 2., 5., 10., 15., 20., 30., 50., 75., 100.,
+    200.)
+TOKEN_COUNT_BUCKETS = (16., 64., 128., 256., 512., 1024., 2048., 4096.)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if len(names) == 0:
+        return ''
+    escaped = [str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n') for value in values]
+    return '{' + ','.join(f'{name}="{value}"'
+        for name, value in zip(names, escaped)) + '}'
+
+
+class _Metric():
+    kind: str = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        # Metrics are updated from the inference worker thread and rendered
+        # from the event loop.
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], object] = {}
+        if len(labels) == 0 and self.kind != 'histogram':
+            self._values[()] = 0.
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} takes the labels ' +
+                f'{self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key: tuple[str, ...], value: object) -> list[str]:
+        return [f'{self.name}{_format_labels(self.label_names, key)} ' +
+            _format_value(value)] # type: ignore
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float=1., **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount # type: ignore
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float=1., **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount # type: ignore
+
+    def dec(self, amount: float=1., **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...],
+        buckets: tuple[float, ...],
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, # type: ignore
+                ([0] * len(self.buckets), 0.))
+            # A new list, render() may be formatting the old one.
+            counts = list(counts)
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self, key: tuple[str, ...], value: object) -> list[str]:
+        counts, total = value # type: ignore
+        names = self.label_names + ('le',)
+        samples = [f'{self.name}_bucket' +
+            f'{_format_labels(names, key + (_format_value(bound),))} {count}'
+            for bound, count in zip(self.buckets, counts)]
+        labels = _format_labels(self.label_names, key)
+        samples.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        samples.append(f'{self.name}_count{labels} {counts[-1]}')
+        return samples
+
+
+class MetricsRegistry():
+    '''
+    The metrics of a process, rendered in the Prometheus text format.
+    Metrics are created once by name, asking again for the same name returns
+    the existing one. Collectors are called before every render to set
+    gauges that are cheaper to read when scraped, such as memory.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[Callable[[], None]] = []
+
+    def counter(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...]=(),
+    ) -> Counter:
+        return self._get(Counter, name, documentation, labels) # type: ignore
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...]=(),
+    ) -> Gauge:
+        return self._get(Gauge, name, documentation, labels) # type: ignore
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...]=(),
+        buckets: tuple[float, ...]=LATENCY_BUCKETS,
+    ) -> Histogram:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, documentation, labels,
+                    buckets)
+            return self._metrics[name] # type: ignore
+
+    def add_collector(self, collector: Callable[[], None]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = sorted(self._metrics.values(),
+                key=lambda metric: metric.name)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f'Metrics collector failed: {type(e).__name__}: {e}')
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _get(
+        self,
+        cls: type,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...],
+    ) -> _Metric:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, documentation, labels)
+            return self._metrics[name]
+
+
+REGISTRY = MetricsRegistry()
+
+PROCESS_RESIDENT_MEMORY = REGISTRY.gauge('yal_process_resident_memory_bytes',
+    'Resident memory of the process.')
+
+
+def _collect_process():
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return
+    PROCESS_RESIDENT_MEMORY.set(resident_pages * os.sysconf('SC_PAGE_SIZE'))
+
+
+REGISTRY.add_collector(_collect_process)
+
+
+class MetricsServer():
+    '''
+    Serves a MetricsRegistry for Prometheus to scrape on
+    http://host:port/metrics. Only meant to listen on a local interface.
+    '''
+    def __init__(
+        self,
+        port: int,
+        host: str=DEFAULT_METRICS_HOST,
+        registry: MetricsRegistry=REGISTRY,
+    ):
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self._server: asyncio.AbstractServer|None = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host,
+            self.port)
+        print(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def _handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers, there is no body to a GET.
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and \
+                parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write((f'HTTP/1.1 {status}\r\n' +
+                f'Content-Type: {CONTENT_TYPE}\r\n' +
+                f'Content-Length: {len(body)}\r\n' +
+                'Connection: close\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
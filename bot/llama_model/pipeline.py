@@ -0,0 +1,243 @@
+import contextlib
+import math
+
+import torch
+
+from .context_window import MAX_TOKEN_WINDOW
+from .decode import LlamaDecoder, StaticKVCache
+
+
+# Prompts are split into chunks of at least this many tokens to fill the
+# pipeline during prefill.
+DEFAULT_MIN_PREFILL_CHUNK_TOKENS = 64
+
+
+def split_layers(
+    model: torch.nn.Module,
+    devices: list[torch.device],
+) -> list[tuple[torch.device, range]]:
+    '''
+    Place the model across devices like llama_multigpu in llama.py: the
+    embeddings on the first device, the final norm and lm_head on the last
+    one and consecutive runs of ceil(layers / devices) decoder layers on each.
+    Layers are not wrapped in MoveModule, PipelinedDecoder moves activations
+    between stages itself. Returns the (device, layer indices) of every
+    stage.
+    '''
+    model.model.embed_tokens.to(devices[0])
+    model.model.norm.to(devices[-1])
+    model.lm_head.to(devices[-1])
+    layers = model.model.layers
+    per_device = math.ceil(len(layers) / len(devices))
+    stages = []
+    for stage, device in enumerate(devices):
+        layer_ids = range(stage * per_device,
+            min((stage + 1) * per_device, len(layers)))
+        for idx in layer_ids:
+            layers[idx].to(device)
+        if len(layer_ids) > 0:
+            stages.append((device, layer_ids))
+    return stages
+
+
+class _MicroBatch():
+    '''
+    Rows of the batch, or a chunk of a prompt, going through the pipeline
+    together.
+    '''
+    def __init__(
+        self,
+        input_ids: torch.Tensor,
+        slots: slice,
+        positions: torch.Tensor,
+        span: int,
+    ):
+        self.input_ids = input_ids
+        self.slots = slots
+        self.positions = positions
+        self.span = span
+        self.hidden: torch.Tensor|None = None
+        self.logits: torch.Tensor|None = None
+
+
+class PipelinedDecoder(LlamaDecoder):
+    '''
+    A LlamaDecoder for models split across several devices by split_layers.
+
+    Each decode step splits the running batch into micro_batches groups of
+    rows, and prefill splits the prompt into chunks. The stages are issued
+    as a wavefront, stage s of micro-batch m together with stage s + 1 of
+    micro-batch m - 1, and since kernel launches and copies between devices
+    do not block the host, every device works on a different micro-batch at
+    the same time instead of waiting for the stages before it.
+
+    The KV cache of every layer lives on the device of that layer. Logits are
+    returned on the first device, where the scheduler keeps its state.
+    '''
+    micro_batches: int = 1
+    min_prefill_chunk: int = DEFAULT_MIN_PREFILL_CHUNK_TOKENS
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        devices: list[torch.device],
+        slots: int,
+        max_len: int=MAX_TOKEN_WINDOW,
+        micro_batches: int|None=None,
+        min_prefill_chunk: int=DEFAULT_MIN_PREFILL_CHUNK_TOKENS,
+    ):
+        super().__init__(model, devices[0], slots, max_len=max_len)
+        self.stages = split_layers(model, devices)
+        self.devices = [device for device, _ in self.stages]
+        self.micro_batches = micro_batches or len(self.stages)
+        self.min_prefill_chunk = min_prefill_chunk
+        self._tables: dict[torch.device, tuple[torch.Tensor, torch.Tensor,
+            torch.Tensor]] = {}
+
+    def allocate(self):
+        if self.cache is not None:
+            return
+        layer_devices = [device for device, layer_ids in self.stages
+            for _ in layer_ids]
+        self.cache = StaticKVCache(len(layer_devices), self.slots,
+            self.num_heads, self.head_dim, self.max_len, self.device,
+            self.dtype, layer_devices=layer_devices)
+        for device in self.devices:
+            self._tables[device] = (
+                self._cos_cpu.to(device, self.dtype),
+                self._sin_cpu.to(device, self.dtype),
+                torch.arange(self.max_len, device=device),
+            )
+
+    def free(self):
+        super().free()
+        self._tables = {}
+
+    def prefill(
+        self,
+        slot: int,
+        input_ids: torch.Tensor,
+        start: int,
+    ) -> torch.Tensor:
+        length = input_ids.shape[1]
+        chunk = max(self.min_prefill_chunk,
+            math.ceil(length / len(self.stages)))
+        parts = []
+        for idx in range(0, length, chunk):
+            end = min(idx + chunk, length)
+            positions = torch.arange(start + idx, start + end).unsqueeze(0)
+            parts.append(_MicroBatch(input_ids[:, idx:end],
+                slice(slot, slot + 1), positions, start + end))
+        self._run(parts, last_only=True)
+        self.lengths[slot] = start + length
+        return parts[-1].logits[:, -1, :].to(self.device) # type: ignore
+
+    def decode(
+        self,
+        input_ids: torch.Tensor,
+        all_logits: bool=False,
+    ) -> torch.Tensor:
+        batch_size, length = input_ids.shape
+        lengths = self.lengths[:batch_size]
+        if max(lengths) + length > self.max_len:
+            raise ValueError(f'Sequence grew past {self.max_len} tokens')
+        size = math.ceil(batch_size / self.micro_batches)
+        parts = []
+        for start in range(0, batch_size, size):
+            end = min(start + size, batch_size)
+            positions = torch.tensor(lengths[start:end]).unsqueeze(1) + \
+                torch.arange(length).unsqueeze(0)
+            parts.append(_MicroBatch(input_ids[start:end], slice(start, end),
+                positions, max(lengths[start:end]) + length))
+        self._run(parts, last_only=not all_logits)
+        for slot in range(batch_size):
+            self.lengths[slot] += length
+        logits = torch.cat([part.logits for part in parts]).to( # type: ignore
+            self.device)
+        if not all_logits:
+            return logits[:, -1, :]
+        return logits
+
+    def _run(self, parts: list[_MicroBatch], last_only: bool):
+        embed_tokens = self.model.model.embed_tokens
+        for part in parts:
+            part.hidden = embed_tokens(part.input_ids.to(self.devices[0]))
+        last = len(self.stages) - 1
+        for step in range(len(parts) + last):
+            # Issue the later stages first, their inputs were produced in the
+            # previous step.
+            for stage in range(last, -1, -1):
+                if not 0 <= step - stage < len(parts):
+                    continue
+                part = parts[step - stage]
+                device, layer_ids = self.stages[stage]
+                # The quantized matmul kernels launch on the current device.
+                cos, sin, visible, write = self._stage_inputs(part, device)
+                with _on_device(device):
+                    part.hidden = self._layers(part.hidden.to(device), # type: ignore
+                        layer_ids, cos, sin, visible, part.slots, part.span,
+                        write)
+                    if stage == last:
+                        part.logits = self._head(part.hidden, last_only)
+                        part.hidden = None
+
+    def _stage_inputs(self, part: _MicroBatch, device: torch.device) -> tuple:
+        cos, sin, arange = self._tables[device]
+        positions = part.positions.to(device)
+        rows = arange[part.slots].unsqueeze(1)
+        # Causal: a token sees the keys of its slot up to its own position.
+        visible = arange[:part.span].view(1, 1, -1) <= positions.unsqueeze(-1)
+        def write(cache: torch.Tensor, new: torch.Tensor):
+            cache[rows, :, positions] = new.transpose(1, 2)
+        return cos[positions].unsqueeze(1), sin[positions].unsqueeze(1), \
+            visible.unsqueeze(1), write
+
+
+def _on_device(device: torch.device):
+    if device.type == 'cuda':
+        return torch.cuda.device(device)
+    return contextlib.nullcontext()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    from .decode import check_parity
+
+    parser = argparse.ArgumentParser(description='Check that ' +
+        'PipelinedDecoder decodes like generate() on a tiny randomly ' +
+        'initialized LLaMA split across devices.')
+    parser.add_argument('--devices', type=str, default='cpu,cpu',
+        help='Comma separated devices to split the layers across')
+    parser.add_argument('--micro-batches', type=int, default=2)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--vocab-size', type=int, default=256)
+    parser.add_argument('--prompt-len', type=int, default=12)
+    parser.add_argument('--new-tokens', type=int, default=24)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+    )
+    model = LlamaForCausalLM(config).eval()
+    prompt = torch.randint(3, args.vocab_size, (args.prompt_len,)).tolist()
+    devices = [torch.device(name) for name in args.devices.split(',')]
+    # Small chunks so that the prompt is prefilled in several micro-batches.
+    decoder = PipelinedDecoder(model, devices, slots=2,
+        max_len=args.prompt_len + args.new_tokens + 1,
+        micro_batches=args.micro_batches,
+        min_prefill_chunk=max(1, args.prompt_len // 3))
+    if check_parity(model, prompt, args.new_tokens, decoder=decoder):
+        print('PipelinedDecoder matches generate().')
+    else:
+        raise SystemExit(1)
@@ -0,0 +1,216 @@
+import asyncio
+import time
+
+from collections import OrderedDict
+
+from .batching import GenerationResult
+from .cancellation import CancellationToken
+from .engine import LlamaEngine
+from .stream import TokenStream
+
+
+# Prompts are only tokenized on the replica, route on a rough estimate.
+CHARS_PER_TOKEN = 4
+# A "Continue" stays on the replica holding its conversation cache unless
+# that replica has this many more queued tokens than the least loaded one.
+DEFAULT_STICKY_SLACK_TOKENS = 2048
+MAX_TRACKED_CONVERSATIONS = 4096
+
+
+class EngineReplica():
+    '''
+    A LlamaEngine of an EnginePool and the load routed to it.
+    '''
+    engine: LlamaEngine|None = None
+    queued_tokens: int = 0
+    active_requests: int = 0
+    completed_requests: int = 0
+    generated_tokens: int = 0
+
+    def __init__(self, engine: LlamaEngine):
+        self.engine = engine
+        self._last_sample = (time.monotonic(), 0.)
+
+    @property
+    def device(self) -> str:
+        return str(self.engine.device) # type: ignore
+
+    def utilization(self) -> dict:
+        '''
+        Load of the replica. busy_fraction covers the lifetime of the
+        replica, recent_busy_fraction the time since the previous call.
+        '''
+        worker = self.engine.worker # type: ignore
+        now = time.monotonic()
+        busy = worker.busy_seconds
+        last_time, last_busy = self._last_sample
+        self._last_sample = (now, busy)
+        return {
+            'device': self.device,
+            'queued_tokens': self.queued_tokens,
+            'active_requests': self.active_requests,
+            'completed_requests': self.completed_requests,
+            'generated_tokens': self.generated_tokens,
+            'busy_fraction': busy / max(now - worker.started, 1e-9),
+            'recent_busy_fraction': (busy - last_busy) /
+                max(now - last_time, 1e-9),
+        }
+
+
+class EnginePool():
+    '''
+    One LlamaEngine replica per device behind the interface of a single
+    LlamaEngine.
+
+    Every request goes to the replica with the fewest queued tokens (prompt
+    and new tokens of the requests it is working on), except that a
+    "Continue" prefers the replica that generated the conversation so its
+    retained cache is reused.
+    '''
+    sticky_slack_tokens: int = DEFAULT_STICKY_SLACK_TOKENS
+
+    def __init__(
+        self,
+        engines: list[LlamaEngine],
+        sticky_slack_tokens: int=DEFAULT_STICKY_SLACK_TOKENS,
+    ):
+        if len(engines) == 0:
+            raise ValueError('An engine pool needs at least one engine')
+        self.replicas = [EngineReplica(engine) for engine in engines]
+        self.sticky_slack_tokens = sticky_slack_tokens
+        self._owners: OrderedDict[str, EngineReplica] = OrderedDict()
+
+    @classmethod
+    def from_devices(
+        cls,
+        devices: list[str],
+        model_str: str,
+        checkpoint: str,
+        wbits: int,
+        groupsize: int,
+        **kwargs,
+    ) -> 'EnginePool':
+        '''
+        Load a replica of the model onto each of devices, CPU devices
+        included. kwargs are passed to every LlamaEngine.
+        '''
+        engines = []
+        for device in devices:
+            print(f'Loading replica on {device}...')
+            engines.append(LlamaEngine(model_str, checkpoint, wbits, groupsize,
+                device, **kwargs))
+        return cls(engines)
+
+    @property
+    def engines(self) -> list[LlamaEngine]:
+        return [replica.engine for replica in self.replicas] # type: ignore
+
+    async def predict_text(
+        self,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        request_id: str|None=None,
+        parent_id: str|None=None,
+        min_new_tokens: int|None=None,
+        cancel_token: CancellationToken|None=None,
+    ) -> GenerationResult:
+        replica = self._route(prompt, max_length, request_id, parent_id)
+        cost = self._cost(prompt, max_length)
+        self._start(replica, cost)
+        result = None
+        try:
+            result = await replica.engine.predict_text(prompt, max_length, # type: ignore
+                temperature, top_p, request_id=request_id,
+                parent_id=parent_id, min_new_tokens=min_new_tokens,
+                cancel_token=cancel_token)
+        finally:
+            self._finish(replica, cost, result)
+        return result
+
+    def stream_text(
+        self,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        request_id: str|None=None,
+        parent_id: str|None=None,
+        min_new_tokens: int|None=None,
+        cancel_token: CancellationToken|None=None,
+    ) -> TokenStream:
+        replica = self._route(prompt, max_length, request_id, parent_id)
+        cost = self._cost(prompt, max_length)
+        self._start(replica, cost)
+        stream = replica.engine.stream_text(prompt, max_length, temperature, # type: ignore
+            top_p, request_id=request_id, parent_id=parent_id,
+            min_new_tokens=min_new_tokens, cancel_token=cancel_token)
+        def done(future: asyncio.Future):
+            result = None
+            if not future.cancelled() and future.exception() is None:
+                result = future.result()
+            self._finish(replica, cost, result)
+        stream.request.future.add_done_callback(done) # type: ignore
+        return stream
+
+    def capacity(self) -> int:
+        return sum(engine.capacity() for engine in self.engines)
+
+    def utilization(self) -> list[dict]:
+        return [replica.utilization() for replica in self.replicas]
+
+    def memory_stats(self) -> dict:
+        return {replica.device: replica.engine.memory_stats() # type: ignore
+            for replica in self.replicas}
+
+    def residency_stats(self) -> dict:
+        return {replica.device: replica.engine.residency_stats() # type: ignore
+            for replica in self.replicas}
+
+    def speculation_stats(self) -> dict|None:
+        stats = {replica.device: replica.engine.speculation_stats() # type: ignore
+            for replica in self.replicas}
+        if all(value is None for value in stats.values()):
+            return None
+        return stats
+
+    def _cost(self, prompt: str, max_length: int) -> int:
+        return len(prompt) // CHARS_PER_TOKEN + max_length
+
+    def _route(
+        self,
+        prompt: str,
+        max_length: int,
+        request_id: str|None,
+        parent_id: str|None,
+    ) -> EngineReplica:
+        replica = min(self.replicas,
+            key=lambda replica: (replica.queued_tokens, replica.active_requests))
+        owner = self._owners.get(parent_id, None) \
+            if parent_id is not None else None
+        if owner is not None and owner.queued_tokens - replica.queued_tokens \
+            <= self.sticky_slack_tokens:
+            replica = owner
+        if request_id is not None:
+            self._owners[request_id] = replica
+            self._owners.move_to_end(request_id)
+            while len(self._owners) > MAX_TRACKED_CONVERSATIONS:
+                self._owners.popitem(last=False)
+        return replica
+
+    def _start(self, replica: EngineReplica, cost: int):
+        replica.queued_tokens += cost
+        replica.active_requests += 1
+
+    def _finish(
+        self,
+        replica: EngineReplica,
+        cost: int,
+        result: GenerationResult|None,
+    ):
+        replica.queued_tokens -= cost
+        replica.active_requests -= 1
+        replica.completed_requests += 1
+        if result is not None:
+            replica.generated_tokens += result.new_tokens
@@ -0,0 +1,201 @@
+import torch
+
+from .memory import tensor_bytes
+
+
+DEFAULT_PREFIX_CACHE_MB = 1024
+# About 128 MB of keys and values for LLaMA 7B in fp16, so a single long
+# prompt can not evict the shared prefixes.
+DEFAULT_PREFIX_CACHE_ENTRY_TOKENS = 256
+
+
+class RadixNode():
+    '''
+    An edge of the radix tree. kv holds the cache of this edge's tokens only,
+    as one (key, value) pair of [heads, len(tokens), head_dim] per layer.
+    '''
+    tokens: tuple[int, ...] = ()
+    kv: tuple|None = None
+    parent: 'RadixNode|None' = None
+    last_access: int = 0
+    nbytes: int = 0
+
+    def __init__(
+        self,
+        tokens: tuple[int, ...],
+        kv: tuple|None,
+        parent: 'RadixNode|None',
+    ):
+        self.tokens = tokens
+        self.kv = kv
+        self.parent = parent
+        self.children: dict[int, RadixNode] = {}
+        if kv is not None:
+            self.nbytes = sum(tensor_bytes(k, v) for k, v in kv)
+
+
+class PrefixCache():
+    '''
+    Token-level radix tree of past_key_values shared across requests.
+
+    Prompts that start with tokens seen before (the ALPACA preamble, or the
+    previous turns of a conversation being continued) reuse the cached keys
+    and values of that prefix so only the new suffix has to be prefilled.
+    Least recently used leaves are evicted once the cache goes over
+    max_bytes. At most the first max_entry_tokens of a prompt are inserted.
+    '''
+    max_bytes: int = DEFAULT_PREFIX_CACHE_MB * 1024 ** 2
+    max_entry_tokens: int = DEFAULT_PREFIX_CACHE_ENTRY_TOKENS
+    nbytes: int = 0
+    hits: int = 0
+    misses: int = 0
+    hit_tokens: int = 0
+    evictions: int = 0
+
+    def __init__(
+        self,
+        max_mb: int=DEFAULT_PREFIX_CACHE_MB,
+        max_entry_tokens: int=DEFAULT_PREFIX_CACHE_ENTRY_TOKENS,
+    ):
+        self.max_bytes = max_mb * 1024 ** 2
+        self.max_entry_tokens = max_entry_tokens
+        self.root = RadixNode((), None, None)
+        self._clock = 0
+
+    def match(self, token_ids: list[int]) -> tuple[int, tuple|None]:
+        '''
+        Find the longest cached prefix of token_ids. Returns its length and
+        its past_key_values as ([1, heads, length, head_dim], ...) per layer.
+        '''
+        node = self.root
+        idx = 0
+        segments: list[tuple[RadixNode, int]] = []
+        while idx < len(token_ids):
+            child = node.children.get(token_ids[idx])
+            if child is None:
+                break
+            n = _common_prefix_length(child.tokens, token_ids, idx)
+            self._touch(child)
+            segments.append((child, n))
+            idx += n
+            if n < len(child.tokens):
+                break
+            node = child
+
+        if idx == 0:
+            self.misses += 1
+            return 0, None
+
+        self.hits += 1
+        self.hit_tokens += idx
+        past_key_values = tuple(
+            (
+                torch.cat([seg.kv[layer][0][:, :n] # type: ignore
+                    for seg, n in segments], dim=1).unsqueeze(0),
+                torch.cat([seg.kv[layer][1][:, :n] # type: ignore
+                    for seg, n in segments], dim=1).unsqueeze(0),
+            )
+            for layer in range(len(segments[0][0].kv)) # type: ignore
+        )
+        return idx, past_key_values
+
+    def insert(self, token_ids: list[int], past_key_values: tuple):
+        '''
+        Cache the keys and values of token_ids. past_key_values must hold
+        ([1, heads, length, head_dim], ...) per layer with its first
+        len(token_ids) positions belonging to token_ids. Only the first
+        max_entry_tokens are cached.
+        '''
+        token_ids = token_ids[:self.max_entry_tokens]
+        node = self.root
+        idx = 0
+        while idx < len(token_ids):
+            child = node.children.get(token_ids[idx])
+            if child is None:
+                end = len(token_ids)
+                child = RadixNode(
+                    tuple(token_ids[idx:]),
+                    tuple((k[0, :, idx:end].clone(), v[0, :, idx:end].clone())
+                        for k, v in past_key_values),
+                    node,
+                )
+                node.children[token_ids[idx]] = child
+                self.nbytes += child.nbytes
+                self._touch(child)
+                break
+            n = _common_prefix_length(child.tokens, token_ids, idx)
+            if n < len(child.tokens):
+                child = self._split(child, n)
+            self._touch(child)
+            node = child
+            idx += n
+        self._evict()
+
+    def clear(self):
+        self.root = RadixNode((), None, None)
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_tokens': self.hit_tokens,
+            'evictions': self.evictions,
+        }
+
+    def _split(self, node: RadixNode, n: int) -> RadixNode:
+        '''
+        Split node after its first n tokens and return the new upper half.
+        '''
+        parent = node.parent
+        upper = RadixNode(
+            node.tokens[:n],
+            tuple((k[:, :n].clone(), v[:, :n].clone()) for k, v in node.kv), # type: ignore
+            parent,
+        )
+        upper.last_access = node.last_access
+        self.nbytes -= node.nbytes
+        node.tokens = node.tokens[n:]
+        node.kv = tuple((k[:, n:].clone(), v[:, n:].clone())
+            for k, v in node.kv) # type: ignore
+        node.nbytes = sum(tensor_bytes(k, v) for k, v in node.kv)
+        node.parent = upper
+        self.nbytes += upper.nbytes + node.nbytes
+
+        upper.children[node.tokens[0]] = node
+        parent.children[upper.tokens[0]] = upper # type: ignore
+        return upper
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            leaf = None
+            stack = list(self.root.children.values())
+            while len(stack) > 0:
+                node = stack.pop()
+                if len(node.children) > 0:
+                    stack.extend(node.children.values())
+                elif leaf is None or node.last_access < leaf.last_access:
+                    leaf = node
+            if leaf is None:
+                return
+            del leaf.parent.children[leaf.tokens[0]] # type: ignore
+            self.nbytes -= leaf.nbytes
+            self.evictions += 1
+
+    def _touch(self, node: RadixNode):
+        self._clock += 1
+        node.last_access = self._clock
+
+
+def _common_prefix_length(
+    tokens: tuple[int, ...],
+    token_ids: list[int],
+    start: int,
+) -> int:
+    n = 0
+    limit = min(len(tokens), len(token_ids) - start)
+    while n < limit and tokens[n] == token_ids[start + n]:
+        n += 1
+    return n
@@ -0,0 +1,257 @@
+import re
+import time
+
+from typing import Any
+
+import torch
+
+from .decode import LlamaDecoder
+from .quant import QuantLinear
+
+
+PATH_KERNEL = 'kernel'
+PATH_KERNEL_FASTER = 'kernel_faster'
+PATH_MATMUL = 'matmul'
+
+GROUP_ROLE = 'role'
+GROUP_TYPE = 'type'
+
+# The attention of LlamaDecoder, which is not a module.
+ATTENTION_KEY = 'attention'
+
+_LAYER_INDEX = re.compile(r'\.\d+(\.|$)')
+
+
+def quant_linear_path(module: QuantLinear, x: torch.Tensor) -> str:
+    '''
+    The code path QuantLinear.forward takes for input x: the quant_cuda
+    kernel, or unpacking the weights for torch.matmul past its
+    kernel_switch_threshold.
+    '''
+    if module.kernel_switch_threshold is not None and \
+        x.shape[0] * x.shape[1] >= module.kernel_switch_threshold:
+        return PATH_MATMUL
+    return PATH_KERNEL_FASTER if module.faster else PATH_KERNEL
+
+
+class _Timing():
+    __slots__ = ('calls', 'seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.
+
+
+class LayerProfiler():
+    '''
+    Opt-in wall time and call counts of the modules of a LLaMA model, by
+    module type and by role (the module's name with the layer index
+    replaced by *), each split by code path for QuantLinear.
+
+    Forward hooks go on every module inside the decoder layers, on the
+    embedding, final norm and lm_head, and on QuantLinear anywhere. Times are
+    inclusive, LlamaMLP contains its projections. LlamaDecoder runs
+    attention inline rather than through the layers' forward, so
+    attach_decoder() times it as ATTENTION_KEY.
+
+    With synchronize, CUDA is synchronized around every module so its time
+    is its own and not its launch, which slows decoding down a lot. Only
+    profile to find out what got slow.
+    '''
+    synchronize: bool = True
+
+    def __init__(self, synchronize: bool=True):
+        self.synchronize = synchronize
+        self._handles: list[Any] = []
+        self._decoders: list[LlamaDecoder] = []
+        self._starts: dict[int, list[tuple[float, str]]] = {}
+        self._roles: dict[int, str] = {}
+        self._timings: dict[tuple[str, str, str], _Timing] = {}
+        self.started = time.perf_counter()
+
+    def attach(self, model: torch.nn.Module):
+        for name, module in model.named_modules():
+            if not self._wanted(name, module):
+                continue
+            self._roles[id(module)] = _LAYER_INDEX.sub(r'.*\1', name)
+            self._handles.append(
+                module.register_forward_pre_hook(self._pre_hook))
+            self._handles.append(module.register_forward_hook(self._hook))
+
+    def attach_decoder(self, decoder: LlamaDecoder):
+        attend = decoder._attend
+        def timed_attend(q, keys, values, visible):
+            self._sync(q)
+            start = time.perf_counter()
+            out = attend(q, keys, values, visible)
+            self._sync(out)
+            self._add(ATTENTION_KEY, ATTENTION_KEY, '',
+                time.perf_counter() - start)
+            return out
+        # Shadows the method on this instance only.
+        decoder._attend = timed_attend # type: ignore
+        self._decoders.append(decoder)
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        for decoder in self._decoders:
+            del decoder._attend
+        self._handles = []
+        self._decoders = []
+        self._roles = {}
+        self._starts = {}
+
+    def reset(self):
+        self._timings = {}
+        self.started = time.perf_counter()
+
+    def stats(self, group: str=GROUP_TYPE) -> list[dict]:
+        '''
+        Timings grouped by GROUP_TYPE or GROUP_ROLE, slowest first.
+        '''
+        grouped: dict[tuple[str, str], _Timing] = {}
+        for (type_key, role, path), timing in list(self._timings.items()):
+            key = (type_key if group == GROUP_TYPE else role, path)
+            total = grouped.setdefault(key, _Timing())
+            total.calls += timing.calls
+            total.seconds += timing.seconds
+        return [{
+            'module': module,
+            'path': path,
+            'calls': timing.calls,
+            'seconds': timing.seconds,
+            'mean_ms': 1000. * timing.seconds / timing.calls,
+        } for (module, path), timing in sorted(grouped.items(),
+            key=lambda item: item[1].seconds, reverse=True)]
+
+    def report(self, group: str=GROUP_TYPE, limit: int|None=None) -> str:
+        rows = self.stats(group)[:limit]
+        width = max([len(row['module']) for row in rows] + [6])
+        lines = [f'Layer profile by {group} over ' +
+            f'{time.perf_counter() - self.started:.1f}s (inclusive times)',
+            f'{"module":<{width}}  {"path":<13} {"calls":>8} ' +
+            f'{"total ms":>10} {"mean ms":>9}']
+        for row in rows:
+            lines.append(f'{row["module"]:<{width}}  {row["path"]:<13} ' +
+                f'{row["calls"]:>8} {1000. * row["seconds"]:>10.1f} ' +
+                f'{row["mean_ms"]:>9.3f}')
+        return '\n'.join(lines)
+
+    def _wanted(self, name: str, module: torch.nn.Module) -> bool:
+        if isinstance(module, QuantLinear):
+            return True
+        if '.layers.' in name:
+            return True
+        return name.endswith('embed_tokens') or name.endswith('model.norm') \
+            or name == 'lm_head'
+
+    def _pre_hook(self, module: torch.nn.Module, args: tuple):
+        x = args[0] if len(args) > 0 else None
+        path = ''
+        if isinstance(module, QuantLinear) and isinstance(x, torch.Tensor):
+            path = quant_linear_path(module, x)
+        self._sync(x)
+        self._starts.setdefault(id(module), []).append(
+            (time.perf_counter(), path))
+
+    def _hook(self, module: torch.nn.Module, args: tuple, output: Any):
+        starts = self._starts.get(id(module))
+        if not starts:
+            return
+        self._sync(output)
+        start, path = starts.pop()
+        self._add(type(module).__name__, self._roles.get(id(module), ''),
+            path, time.perf_counter() - start)
+
+    def _add(self, type_key: str, role: str, path: str, seconds: float):
+        timing = self._timings.get((type_key, role, path))
+        if timing is None:
+            timing = self._timings[(type_key, role, path)] = _Timing()
+        timing.calls += 1
+        timing.seconds += seconds
+
+    def _sync(self, value: Any):
+        if not self.synchronize:
+            return
+        if isinstance(value, tuple) and len(value) > 0:
+            value = value[0]
+        if isinstance(value, torch.Tensor) and value.is_cuda:
+            torch.cuda.synchronize(value.device)
+
+
+def random_quantize(model: torch.nn.Module, wbits: int, groupsize: int,
+    kernel_switch_threshold: int):
+    from .modelutils import find_layers
+    from .quant import make_quant
+
+    layers = find_layers(model)
+    del layers['lm_head']
+    make_quant(model, layers, wbits, groupsize,
+        kernel_switch_threshold=kernel_switch_threshold)
+    for module in model.modules():
+        if isinstance(module, QuantLinear):
+            module.qweight.random_(-2 ** 31, 2 ** 31 - 1)
+            module.qzeros.random_(-2 ** 31, 2 ** 31 - 1)
+            module.scales.uniform_(0.001, 0.01)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    parser = argparse.ArgumentParser(description='Profile prefill and ' +
+        'decode of a tiny randomly initialized LLaMA through LlamaDecoder.')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--layers', type=int, default=2)
+    # QuantLinear packs zeros for 256 output features at a time.
+    parser.add_argument('--hidden-size', type=int, default=256)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--vocab-size', type=int, default=256)
+    parser.add_argument('--prompt-len', type=int, default=160)
+    parser.add_argument('--new-tokens', type=int, default=32)
+    parser.add_argument('--slots', type=int, default=2)
+    parser.add_argument('--wbits', type=int, default=4, choices=[2, 3, 4, 8, 16],
+        help='Replace the linear layers with random QuantLinear weights ' +
+        'of this many bits, 16 to keep them in full precision')
+    parser.add_argument('--groupsize', type=int, default=-1)
+    parser.add_argument('--kernel-switch-threshold', type=int, default=128,
+        help='Inputs of at least this many tokens unpack the weights for ' +
+        'torch.matmul, forced to 1 without CUDA')
+    parser.add_argument('--group', type=str, default=GROUP_TYPE,
+        choices=[GROUP_TYPE, GROUP_ROLE])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.layers,
+        num_attention_heads=args.heads,
+    )
+    model = LlamaForCausalLM(config).eval()
+    if args.wbits < 16:
+        threshold = args.kernel_switch_threshold
+        if device.type != 'cuda':
+            # The quant_cuda kernel only runs on CUDA.
+            threshold = 1
+        random_quantize(model, args.wbits, args.groupsize, threshold)
+    model = model.to(device)
+
+    profiler = LayerProfiler()
+    decoder = LlamaDecoder(model, device, slots=args.slots,
+        max_len=args.prompt_len + args.new_tokens + 1)
+    profiler.attach(model)
+    profiler.attach_decoder(decoder)
+    decoder.allocate()
+    with torch.no_grad():
+        tokens = torch.cat([decoder.prefill(slot, torch.randint(3,
+            args.vocab_size, (1, args.prompt_len), device=device), 0)
+            .argmax(dim=-1, keepdim=True) for slot in range(args.slots)])
+        for _ in range(args.new_tokens):
+            tokens = decoder.decode(tokens).argmax(dim=-1, keepdim=True)
+    print(profiler.report(args.group))
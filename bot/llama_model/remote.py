@@ -0,0 +1,334 @@
+import asyncio
+import itertools
+
+from .cancellation import (
+    CANCEL_ABANDONED,
+    CANCEL_USER,
+    CancellationToken,
+    GenerationCancelled,
+)
+from .ipc import (
+    DEFAULT_ENGINE_SOCKET,
+    MAX_BYTES_PER_TOKEN,
+    SharedText,
+    read_message,
+    write_message,
+)
+from .metrics import REGISTRY
+from .result import GenerationResult
+from .server import (
+    EVENT_ERROR,
+    EVENT_RESULT,
+    EVENT_STATS,
+    EVENT_TEXT,
+    OP_CANCEL,
+    OP_GENERATE,
+    OP_STATS,
+)
+
+
+CONNECTS = REGISTRY.counter('yal_engine_connects_total',
+    'Connections opened to the engine server, more than one means it was ' +
+    'reconnected to.')
+CONNECTION_FAILURES = REGISTRY.counter('yal_engine_connection_failures_total',
+    'Requests that failed because the engine server could not be reached.')
+
+
+class RemoteTokenStream():
+    '''
+    TokenStream of a generation running in an EngineServer process.
+    '''
+    def __init__(
+        self,
+        shared: SharedText,
+        future: asyncio.Future,
+        cancel_token: CancellationToken,
+    ):
+        self.shared = shared
+        self.future = future
+        self.cancel_token = cancel_token
+        self.read_offset = shared.end
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def __aiter__(self) -> 'RemoteTokenStream':
+        return self
+
+    async def __anext__(self) -> str:
+        try:
+            text = await self._queue.get()
+        except asyncio.CancelledError:
+            self.cancel(CANCEL_ABANDONED)
+            raise
+        if text is None:
+            raise StopAsyncIteration
+        return text
+
+    async def result(self) -> GenerationResult:
+        try:
+            return await self.future
+        except asyncio.CancelledError:
+            self.cancel(CANCEL_ABANDONED)
+            raise
+
+    def cancel(self, reason: str=CANCEL_USER):
+        self.cancel_token.cancel(reason)
+
+    def put(self, text: str):
+        self._queue.put_nowait(text)
+
+    def close(self):
+        self._queue.put_nowait(None)
+
+
+class RemoteEngine():
+    '''
+    Client of an EngineServer with the generation interface of LlamaEngine.
+
+    A single connection is shared by all requests and opened again on the
+    next request if the engine process restarts. Requests running when the
+    connection is lost fail with ConnectionError.
+    '''
+    path: str = DEFAULT_ENGINE_SOCKET
+
+    def __init__(self, path: str=DEFAULT_ENGINE_SOCKET):
+        self.path = path
+        self._ids = itertools.count()
+        self._streams: dict[int, RemoteTokenStream] = {}
+        self._waiters: dict[int, asyncio.Future] = {}
+        self._connecting: asyncio.Task|None = None
+        # The event loop only keeps weak references to tasks.
+        self._tasks: set[asyncio.Task] = set()
+        self._reader: asyncio.Task|None = None
+        self._writer: asyncio.StreamWriter|None = None
+        self._lock: asyncio.Lock|None = None
+
+    async def predict_text(
+        self,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        request_id: str|None=None,
+        parent_id: str|None=None,
+        min_new_tokens: int|None=None,
+        cancel_token: CancellationToken|None=None,
+    ) -> GenerationResult:
+        stream = self._generate(prompt, max_length, temperature, top_p,
+            request_id, parent_id, min_new_tokens, cancel_token,
+            streaming=False)
+        return await stream.result()
+
+    def stream_text(
+        self,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        request_id: str|None=None,
+        parent_id: str|None=None,
+        min_new_tokens: int|None=None,
+        cancel_token: CancellationToken|None=None,
+    ) -> RemoteTokenStream:
+        return self._generate(prompt, max_length, temperature, top_p,
+            request_id, parent_id, min_new_tokens, cancel_token,
+            streaming=True)
+
+    async def close(self):
+        '''
+        Close the connection to the engine, failing the requests running on
+        it.
+        '''
+        tasks = list(self._tasks)
+        for task in [self._connecting, self._reader]:
+            if task is not None:
+                tasks.append(task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._connecting = None
+        self._reader = None
+        # Requests cancelled before they were sent.
+        self._fail_all(ConnectionError('Closed the connection to the ' +
+            f'engine at {self.path}'))
+
+    async def stats(self) -> dict:
+        '''
+        Capacity, memory, residency, speculation and, for a pool,
+        utilization stats of the engine.
+        '''
+        await self._connect()
+        idx = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[idx] = future
+        await write_message(self._writer, {'op': OP_STATS, 'id': idx}, # type: ignore
+            self._lock) # type: ignore
+        return await future
+
+    async def capacity(self) -> int:
+        '''
+        The number of generations the engine batches at once, across all of
+        its devices.
+        '''
+        return (await self.stats())['capacity']
+
+    def _generate(
+        self,
+        prompt: str,
+        max_length: int,
+        temperature: float,
+        top_p: float,
+        request_id: str|None,
+        parent_id: str|None,
+        min_new_tokens: int|None,
+        cancel_token: CancellationToken|None,
+        streaming: bool,
+    ) -> RemoteTokenStream:
+        prompt_size = len(prompt.encode('utf-8'))
+        # Room for the streamed text and, after it, the final text which
+        # repeats the prompt.
+        shared = SharedText(size=2 * (prompt_size +
+            max_length * MAX_BYTES_PER_TOKEN))
+        shared.write(prompt)
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda _: shared.close())
+        stream = RemoteTokenStream(shared, future,
+            cancel_token or CancellationToken())
+        message = {
+            'op': OP_GENERATE,
+            'id': next(self._ids),
+            'shm': shared.name,
+            'prompt_size': prompt_size,
+            'max_length': max_length,
+            'temperature': temperature,
+            'top_p': top_p,
+            'request_id': request_id,
+            'parent_id': parent_id,
+            'min_new_tokens': min_new_tokens,
+            'stream': streaming,
+        }
+        self._streams[message['id']] = stream
+        self._spawn(self._send(message, stream))
+        stream.cancel_token.add_callback(lambda token:
+            self._spawn(self._cancel(message['id'], token.reason))) # type: ignore
+        return stream
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _cancel(self, idx: int, reason: str):
+        if idx not in self._streams or self._writer is None:
+            return
+        try:
+            await write_message(self._writer, {'op': OP_CANCEL, 'id': idx,
+                'reason': reason}, self._lock) # type: ignore
+        except ConnectionError:
+            pass
+
+    async def _send(self, message: dict, stream: RemoteTokenStream):
+        try:
+            await self._connect()
+            await write_message(self._writer, message, self._lock) # type: ignore
+            # Cancelled before the server knew the request.
+            if stream.cancel_token.cancelled:
+                await self._cancel(message['id'],
+                    stream.cancel_token.reason) # type: ignore
+        except (OSError, ConnectionError) as e:
+            CONNECTION_FAILURES.inc()
+            self._streams.pop(message['id'], None)
+            self._fail(stream, ConnectionError('Could not reach the engine ' +
+                f'at {self.path}: {e}'))
+
+    async def _connect(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return
+        if self._connecting is None or self._connecting.done():
+            self._connecting = asyncio.create_task(self._open())
+        await self._connecting
+
+    async def _open(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        CONNECTS.inc()
+        self._writer = writer
+        self._lock = asyncio.Lock()
+        self._reader = asyncio.create_task(self._read(reader, writer))
+
+    async def _read(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                self._dispatch(message)
+        finally:
+            # Also when close() cancels the reader.
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            self._fail_all(ConnectionError('Lost the connection to the ' +
+                f'engine at {self.path}'))
+
+    def _dispatch(self, message: dict):
+        idx = message.get('id')
+        if message['event'] == EVENT_STATS:
+            future = self._waiters.pop(idx, None) # type: ignore
+            if future is not None and not future.done():
+                future.set_result(message['stats'])
+            return
+
+        stream = self._streams.get(idx, None) # type: ignore
+        if stream is None:
+            future = self._waiters.pop(idx, None) # type: ignore
+            if future is not None and message['event'] == EVENT_ERROR:
+                future.set_exception(RuntimeError(message['error']))
+            return
+        if message['event'] == EVENT_TEXT:
+            if 'text' in message:
+                stream.put(message['text'])
+            else:
+                stream.put(stream.shared.read(stream.read_offset,
+                    message['end']))
+                stream.read_offset = message['end']
+        elif message['event'] == EVENT_RESULT:
+            del self._streams[idx] # type: ignore
+            result = GenerationResult(self._text(stream, message['text']),
+                self._text(stream, message['new_text']))
+            counts = message['counts']
+            result.prompt_tokens = counts['prompt_tokens']
+            result.new_tokens = counts['new_tokens']
+            result.cached_tokens = counts['cached_tokens']
+            result.dropped_tokens = counts['dropped_tokens']
+            result.finish_reason = counts['finish_reason']
+            result.spans = counts.get('spans', [])
+            stream.close()
+            stream.future.set_result(result)
+        elif message['event'] == EVENT_ERROR:
+            del self._streams[idx] # type: ignore
+            if message.get('cancelled') is not None:
+                self._fail(stream, GenerationCancelled(message['cancelled']))
+            else:
+                self._fail(stream, RuntimeError(message['error']))
+
+    def _text(self, stream: RemoteTokenStream, value: str|list[int]) -> str:
+        if isinstance(value, str):
+            return value
+        return stream.shared.read(value[0], value[1])
+
+    def _fail_all(self, error: Exception):
+        for stream in self._streams.values():
+            self._fail(stream, error)
+        self._streams.clear()
+        for future in self._waiters.values():
+            if not future.done():
+                future.set_exception(error)
+        self._waiters.clear()
+
+    def _fail(self, stream: RemoteTokenStream, error: Exception):
+        stream.close()
+        if not stream.future.done():
+            stream.future.set_exception(error)
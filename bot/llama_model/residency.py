@@ -0,0 +1,136 @@
+import time
+
+import torch
+import torch.nn as nn
+
+from .metrics import LATENCY_BUCKETS, REGISTRY
+
+
+RESIDENCY_ALWAYS = 'always'
+RESIDENCY_IDLE = 'idle'
+RESIDENCY_PRESSURE = 'pressure'
+RESIDENCY_MODES = [RESIDENCY_ALWAYS, RESIDENCY_IDLE, RESIDENCY_PRESSURE]
+
+DEFAULT_OFFLOAD_IDLE_SECONDS = 300.
+DEFAULT_OFFLOAD_MEMORY_FRACTION = 0.9
+
+MODEL_TRANSFERS = REGISTRY.counter('yal_engine_model_transfers_total',
+    'Moves of the model weights onto or off the device.', ('device', 'to'))
+MODEL_TRANSFER_SECONDS = REGISTRY.histogram(
+    'yal_engine_model_transfer_seconds',
+    'Seconds moving the model weights onto or off the device.',
+    ('device', 'to'), buckets=LATENCY_BUCKETS)
+
+
+class ModelResidency():
+    '''
+    Decides when the model weights live on the device.
+
+    - always: the weights stay on the device for the lifetime of the bot.
+    - idle: the weights are moved to the CPU after idle_seconds without
+      requests and moved back on the next request.
+    - pressure: while idle, the weights are moved to the CPU only when the
+      used fraction of device memory goes over memory_fraction, e.g. because
+      another process on a shared GPU needs it.
+
+    Every transfer is timed so the reload cost is visible in stats().
+    '''
+    mode: str = RESIDENCY_ALWAYS
+    idle_seconds: float = DEFAULT_OFFLOAD_IDLE_SECONDS
+    memory_fraction: float = DEFAULT_OFFLOAD_MEMORY_FRACTION
+
+    resident: bool = False
+    busy: bool = False
+    last_used: float = 0.
+    transfers: int = 0
+    transfer_seconds_total: float = 0.
+    last_load_seconds: float|None = None
+    last_offload_seconds: float|None = None
+
+    def __init__(
+        self,
+        model: nn.Module,
+        device: torch.device,
+        mode: str=RESIDENCY_ALWAYS,
+        idle_seconds: float=DEFAULT_OFFLOAD_IDLE_SECONDS,
+        memory_fraction: float=DEFAULT_OFFLOAD_MEMORY_FRACTION,
+        resident: bool=False,
+    ):
+        if mode not in RESIDENCY_MODES:
+            raise ValueError(f'Unknown residency mode {mode}, expected one ' +
+                f'of {RESIDENCY_MODES}')
+        self.model = model
+        self.device = device
+        self.mode = mode
+        self.idle_seconds = idle_seconds
+        self.memory_fraction = memory_fraction
+        self.resident = resident
+        self.last_used = time.monotonic()
+
+    def acquire(self):
+        '''
+        Make sure the weights are on the device before running the model.
+        '''
+        self.busy = True
+        self.last_used = time.monotonic()
+        if self.resident:
+            return
+        self.last_load_seconds = self._move(self.device)
+        self.resident = True
+        print(f'Moved model to {self.device} in {self.last_load_seconds:.2f}s')
+
+    def release(self):
+        '''
+        The model is no longer in use. Offloading, if any, happens later from
+        maybe_offload().
+        '''
+        self.busy = False
+        self.last_used = time.monotonic()
+
+    def maybe_offload(self) -> bool:
+        '''
+        Called periodically while the model is idle. Returns True if the
+        weights were moved off the device.
+        '''
+        if self.busy or not self.resident or self.mode == RESIDENCY_ALWAYS:
+            return False
+        if self.device.type != 'cuda':
+            return False
+
+        if self.mode == RESIDENCY_IDLE:
+            if time.monotonic() - self.last_used < self.idle_seconds:
+                return False
+        if self.mode == RESIDENCY_PRESSURE:
+            free, total = torch.cuda.mem_get_info(self.device)
+            if (total - free) / total < self.memory_fraction:
+                return False
+
+        self.last_offload_seconds = self._move(torch.device('cpu'))
+        self.resident = False
+        torch.cuda.empty_cache()
+        print(f'Offloaded model to cpu in {self.last_offload_seconds:.2f}s ' +
+            f'({self.mode})')
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'mode': self.mode,
+            'resident': self.resident,
+            'transfers': self.transfers,
+            'transfer_seconds_total': self.transfer_seconds_total,
+            'last_load_seconds': self.last_load_seconds,
+            'last_offload_seconds': self.last_offload_seconds,
+        }
+
+    def _move(self, device: torch.device) -> float:
+        tick = time.perf_counter()
+        self.model.to(device)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - tick
+        self.transfers += 1
+        self.transfer_seconds_total += elapsed
+        MODEL_TRANSFERS.inc(device=str(self.device), to=device.type)
+        MODEL_TRANSFER_SECONDS.observe(elapsed, device=str(self.device),
+            to=device.type)
+        return elapsed
@@ -0,0 +1,70 @@
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .batching import GenerationRequest
+
+
+FINISH_CANCELLED = 'cancelled'
+FINISH_EOS = 'eos'
+FINISH_LENGTH = 'length'
+FINISH_STOP_SEQUENCE = 'stop_sequence'
+FINISH_STOP_STRING = 'stop_string'
+
+
+class GenerationResult():
+    '''
+    The outcome of a GenerationRequest.
+
+    text is the prompt followed by the generated text, new_text only the
+    generated text, both with stop sequences stripped. finish_reason is one
+    of FINISH_EOS, FINISH_LENGTH, FINISH_STOP_SEQUENCE, FINISH_STOP_STRING or
+    FINISH_CANCELLED, in which case the text is what was generated until then.
+    spans are the trace spans the engine recorded for the request. Results
+    received from another process have no request.
+    '''
+    text: str = ''
+    new_text: str = ''
+    prompt_tokens: int = 0
+    new_tokens: int = 0
+    cached_tokens: int = 0
+    dropped_tokens: int = 0
+    finish_reason: str|None = None
+
+    def __init__(
+        self,
+        text: str,
+        new_text: str,
+        request: 'GenerationRequest|None'=None,
+    ):
+        self.text = text
+        self.new_text = new_text
+        self.spans: list[dict] = []
+        if request is None:
+            return
+        self.prompt_tokens = len(request.prompt_ids) # type: ignore
+        self.new_tokens = len(request.output_ids) # type: ignore
+        self.cached_tokens = request.cached_tokens
+        self.dropped_tokens = request.dropped_tokens
+        self.finish_reason = request.finish_reason
+        self.spans = request.spans # type: ignore
+
+    @property
+    def stopped_early(self) -> bool:
+        '''
+        Whether the model stopped without generating any text.
+        '''
+        return self.finish_reason != FINISH_LENGTH and \
+            self.new_text.strip() == ''
+
+    def counts(self) -> dict:
+        '''
+        Everything but the text, e.g. to send it to another process.
+        '''
+        return {
+            'prompt_tokens': self.prompt_tokens,
+            'new_tokens': self.new_tokens,
+            'cached_tokens': self.cached_tokens,
+            'dropped_tokens': self.dropped_tokens,
+            'finish_reason': self.finish_reason,
+            'spans': self.spans,
+        }
@@ -0,0 +1,67 @@
+import torch
+
+
+# model.generate() samples with the top_k of the default generation config,
+# keep the same to not change the output distribution.
+DEFAULT_TOP_K = 50
+
+
+def sample_tokens(
+    logits: torch.Tensor,
+    temperature: torch.Tensor,
+    top_p: torch.Tensor,
+    top_k: int=DEFAULT_TOP_K,
+) -> torch.Tensor:
+    '''
+    Sample one token per row of logits [batch, vocab] with per-row temperature
+    and top p. Returns a [batch, 1] tensor of token ids.
+    '''
+    logits = logits.float() / temperature.unsqueeze(1)
+    sorted_logits, sorted_idx = torch.sort(logits, descending=True, dim=-1)
+    if top_k > 0 and top_k < sorted_logits.shape[-1]:
+        sorted_logits[:, top_k:] = float('-inf')
+    probs = sorted_logits.softmax(dim=-1)
+    # Drop every token whose preceding cumulative probability already reaches
+    # top_p, this always keeps at least the most likely token.
+    cumulative_before = probs.cumsum(dim=-1) - probs
+    sorted_logits = sorted_logits.masked_fill(
+        cumulative_before >= top_p.unsqueeze(1), float('-inf'))
+    choice = torch.multinomial(sorted_logits.softmax(dim=-1), 1)
+    return sorted_idx.gather(-1, choice)
+
+
+def sampling_probs(
+    logits: torch.Tensor,
+    temperature: torch.Tensor,
+    top_p: torch.Tensor,
+    top_k: int=DEFAULT_TOP_K,
+) -> torch.Tensor:
+    '''
+    Return the distribution sample_tokens samples from, as probabilities of
+    the same shape as logits [batch, ..., vocab], with per-row temperature
+    and top p.
+    '''
+    shape = (-1,) + (1,) * (logits.dim() - 1)
+    logits = logits.float() / temperature.view(shape)
+    sorted_logits, sorted_idx = torch.sort(logits, descending=True, dim=-1)
+    if top_k > 0 and top_k < sorted_logits.shape[-1]:
+        sorted_logits[..., top_k:] = float('-inf')
+    probs = sorted_logits.softmax(dim=-1)
+    cumulative_before = probs.cumsum(dim=-1) - probs
+    sorted_logits = sorted_logits.masked_fill(
+        cumulative_before >= top_p.view(shape), float('-inf'))
+    probs = sorted_logits.softmax(dim=-1)
+    return torch.zeros_like(probs).scatter_(-1, sorted_idx, probs)
+
+
+def suppress_tokens(
+    logits: torch.Tensor,
+    token_ids: torch.Tensor,
+    rows: torch.Tensor,
+) -> torch.Tensor:
+    '''
+    Mask the token_ids [n] out of logits [batch, ..., vocab] wherever the
+    bool mask rows [batch, ...] is set.
+    '''
+    masked = logits.index_fill(-1, token_ids, float('-inf'))
+    return torch.where(rows.unsqueeze(-1), masked, logits)
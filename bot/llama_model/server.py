@@ -0,0 +1,184 @@
+import asyncio
+import os
+
+from typing import TYPE_CHECKING
+
+from .cancellation import (
+    CANCEL_DISCONNECTED,
+    CancellationToken,
+    GenerationCancelled,
+)
+from .ipc import SharedText, read_message, write_message
+from .metrics import MetricsServer
+from .result import GenerationResult
+
+if TYPE_CHECKING:
+    from .engine import LlamaEngine
+    from .pool import EnginePool
+
+
+OP_CANCEL = 'cancel'
+OP_GENERATE = 'generate'
+OP_STATS = 'stats'
+
+EVENT_ERROR = 'error'
+EVENT_RESULT = 'result'
+EVENT_STATS = 'stats'
+EVENT_TEXT = 'text'
+
+
+class EngineServer():
+    '''
+    Serves a loaded LlamaEngine (or EnginePool) to other processes over a
+    local unix socket, so frontends such as the bot can restart without
+    reloading the model and several of them can share it.
+
+    Messages on the socket are small length prefixed JSON. The prompt and
+    the generated text of every request go through a SharedText buffer
+    created by the client: the prompt is read from its start, and every
+    streamed text delta is appended after it with only its end offset sent
+    as an EVENT_TEXT message. The final text is written after that and its
+    span sent with the EVENT_RESULT message.
+
+    An OP_CANCEL message cancels a request of the same connection, and all
+    requests still running when their connection closes are cancelled.
+    '''
+    def __init__(
+        self,
+        engine: 'LlamaEngine|EnginePool',
+        path: str,
+        metrics_port: int|None=None,
+    ):
+        self.engine = engine
+        self.path = path
+        self.metrics_port = metrics_port
+
+    async def serve(self):
+        if self.metrics_port is not None:
+            await MetricsServer(self.metrics_port).start()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        print(f'Serving the engine on {self.path}')
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        lock = asyncio.Lock()
+        tasks: set[asyncio.Task] = set()
+        cancel_tokens: dict[int, CancellationToken] = {}
+        while True:
+            message = await read_message(reader)
+            if message is None:
+                break
+            if message.get('op') == OP_GENERATE:
+                cancel_token = CancellationToken()
+                cancel_tokens[message['id']] = cancel_token
+                task = asyncio.create_task(self._generate(message, writer,
+                    lock, cancel_token))
+                task.add_done_callback(
+                    lambda _, idx=message['id']: cancel_tokens.pop(idx, None))
+            elif message.get('op') == OP_CANCEL:
+                cancel_token = cancel_tokens.get(message.get('id'), None) # type: ignore
+                if cancel_token is not None:
+                    cancel_token.cancel(message.get('reason') or
+                        CANCEL_DISCONNECTED)
+                continue
+            elif message.get('op') == OP_STATS:
+                task = asyncio.create_task(self._stats(message, writer, lock))
+            else:
+                await self._send(writer, lock, {'id': message.get('id'),
+                    'event': EVENT_ERROR,
+                    'error': f'Unknown op {message.get("op")!r}'})
+                continue
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # Nobody is left to read what the requests of a client that went away
+        # generate.
+        for cancel_token in list(cancel_tokens.values()):
+            cancel_token.cancel(CANCEL_DISCONNECTED)
+        writer.close()
+
+    async def _generate(
+        self,
+        message: dict,
+        writer: asyncio.StreamWriter,
+        lock: asyncio.Lock,
+        cancel_token: CancellationToken,
+    ):
+        shared = None
+        try:
+            shared = SharedText(message['shm'])
+            prompt = shared.read(0, message['prompt_size'])
+            shared.end = message['prompt_size']
+            stream = self.engine.stream_text(prompt, message['max_length'],
+                message['temperature'], message['top_p'],
+                request_id=message.get('request_id'),
+                parent_id=message.get('parent_id'),
+                min_new_tokens=message.get('min_new_tokens'),
+                cancel_token=cancel_token)
+            async for delta in stream:
+                if not message.get('stream', True):
+                    continue
+                span = shared.write(delta)
+                event = {'id': message['id'], 'event': EVENT_TEXT}
+                if span is None:
+                    event['text'] = delta
+                else:
+                    event['end'] = span[1]
+                await self._send(writer, lock, event)
+            result: GenerationResult = await stream.result()
+            event = {'id': message['id'], 'event': EVENT_RESULT,
+                'counts': result.counts()}
+            for key, text in (('text', result.text),
+                ('new_text', result.new_text)):
+                span = shared.write(text)
+                event[key] = text if span is None else list(span)
+            await self._send(writer, lock, event)
+        except GenerationCancelled as e:
+            await self._send(writer, lock, {'id': message.get('id'),
+                'event': EVENT_ERROR, 'error': str(e),
+                'cancelled': e.reason})
+        except Exception as e:
+            await self._send(writer, lock, {'id': message.get('id'),
+                'event': EVENT_ERROR, 'error': f'{type(e).__name__}: {e}'})
+        finally:
+            if shared is not None:
+                shared.close()
+
+    async def _stats(
+        self,
+        message: dict,
+        writer: asyncio.StreamWriter,
+        lock: asyncio.Lock,
+    ):
+        stats = {
+            'capacity': self.engine.capacity(),
+            'memory': self.engine.memory_stats(),
+            'residency': self.engine.residency_stats(),
+            'speculation': self.engine.speculation_stats(),
+        }
+        if hasattr(self.engine, 'utilization'):
+            stats['utilization'] = self.engine.utilization() # type: ignore
+        if hasattr(self.engine, 'layer_stats'):
+            stats['layers'] = self.engine.layer_stats() # type: ignore
+        await self._send(writer, lock, {'id': message['id'],
+            'event': EVENT_STATS, 'stats': stats})
+
+    async def _send(
+        self,
+        writer: asyncio.StreamWriter,
+        lock: asyncio.Lock,
+        message: dict,
+    ):
+        if writer.is_closing():
+            return
+        try:
+            await write_message(writer, message, lock)
+        except ConnectionError:
+            pass
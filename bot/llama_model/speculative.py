@@ -0,0 +1,229 @@
+import abc
+
+from typing import TYPE_CHECKING
+
+import torch
+
+from .decode import LlamaDecoder
+from .sampling import sampling_probs
+
+if TYPE_CHECKING:
+    from .batching import BatchScheduler
+
+
+DEFAULT_SPECULATIVE_TOKENS = 4
+
+
+class SpeculativeProposer(abc.ABC):
+    '''
+    Proposes up to num_tokens continuation tokens for every row of the batch,
+    which the target model then verifies in a single forward pass.
+
+    propose() returns the [batch, n] proposed tokens, the [batch, n, vocab]
+    probabilities they were drawn with (None for deterministic proposals) and
+    the [batch, n] mask of proposed positions, or None if nothing could be
+    proposed.
+    '''
+    num_tokens: int = DEFAULT_SPECULATIVE_TOKENS
+    steps: int = 0
+    row_steps: int = 0
+    proposed: int = 0
+    accepted: int = 0
+
+    def allocate(self):
+        pass
+
+    def free(self):
+        pass
+
+    def prefill(self, slot: int, prompt_ids: list[int]):
+        pass
+
+    def compact(self, keep: list[int]):
+        pass
+
+    @abc.abstractmethod
+    def propose(
+        self,
+        scheduler: 'BatchScheduler',
+        num_tokens: int,
+    ) -> tuple[torch.Tensor, torch.Tensor|None, torch.Tensor]|None:
+        ...
+
+    def record(self, rows: int, proposed: int, accepted: int):
+        self.steps += 1
+        self.row_steps += rows
+        self.proposed += proposed
+        self.accepted += accepted
+
+    def stats(self) -> dict:
+        return {
+            'steps': self.steps,
+            'proposed_tokens': self.proposed,
+            'accepted_tokens': self.accepted,
+            'acceptance_rate': self.accepted / self.proposed
+                if self.proposed > 0 else 0.,
+            # Tokens every row gains per forward pass of the target model.
+            'tokens_per_step': (self.accepted + self.row_steps) / self.row_steps
+                if self.row_steps > 0 else 0.,
+        }
+
+
+class DraftModelProposer(SpeculativeProposer):
+    '''
+    Samples proposals autoregressively from a small draft model that shares
+    the target's tokenizer, decoding in its own static KV cache with the same
+    slots as the batch.
+
+    Each round the draft cache is rolled back to the tokens the target
+    accepted, and the last accepted token is written again together with the
+    newly sampled one. This covers the draft being one token behind when all
+    of its proposals were accepted.
+    '''
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        device: torch.device,
+        slots: int,
+        max_len: int,
+        num_tokens: int=DEFAULT_SPECULATIVE_TOKENS,
+    ):
+        self.decoder = LlamaDecoder(model, device, slots=slots,
+            max_len=max_len)
+        self.num_tokens = num_tokens
+
+    def allocate(self):
+        self.decoder.allocate()
+
+    def free(self):
+        self.decoder.free()
+
+    def prefill(self, slot: int, prompt_ids: list[int]):
+        self.decoder.prefill(slot, torch.tensor([prompt_ids],
+            dtype=torch.long, device=self.decoder.device), 0)
+
+    def compact(self, keep: list[int]):
+        if self.decoder.cache is not None:
+            self.decoder.cache.compact(keep)
+
+    def propose(
+        self,
+        scheduler: 'BatchScheduler',
+        num_tokens: int,
+    ) -> tuple[torch.Tensor, torch.Tensor|None, torch.Tensor]|None:
+        target_lengths = scheduler.engine.decoder.lengths # type: ignore
+        for slot in range(len(scheduler.rows)):
+            self.decoder.lengths[slot] = target_lengths[slot] - 1
+
+        inputs = torch.cat([scheduler.prev_tokens, # type: ignore
+            scheduler.next_tokens], dim=1) # type: ignore
+        tokens, probs = [], []
+        for _ in range(num_tokens):
+            q = sampling_probs(self.decoder.decode(inputs),
+                scheduler.temperatures, scheduler.top_ps) # type: ignore
+            inputs = torch.multinomial(q, 1)
+            tokens.append(inputs)
+            probs.append(q)
+        draft = torch.cat(tokens, dim=1)
+        return draft, torch.stack(probs, dim=1), torch.ones_like(draft,
+            dtype=torch.bool)
+
+
+class PromptLookupProposer(SpeculativeProposer):
+    '''
+    Proposes the tokens that followed the last earlier occurrence of the
+    row's final ngram tokens (trying shorter ngrams down to min_ngram) in its
+    prompt and output, without a draft model and without extra memory.
+
+    Continued conversations and code answers often repeat spans of the
+    prompt, which then decode several tokens per step.
+    '''
+    ngram: int = 3
+    min_ngram: int = 1
+
+    def __init__(
+        self,
+        num_tokens: int=DEFAULT_SPECULATIVE_TOKENS,
+        ngram: int=3,
+        min_ngram: int=1,
+    ):
+        self.num_tokens = num_tokens
+        self.ngram = ngram
+        self.min_ngram = min(min_ngram, ngram)
+
+    def propose(
+        self,
+        scheduler: 'BatchScheduler',
+        num_tokens: int,
+    ) -> tuple[torch.Tensor, torch.Tensor|None, torch.Tensor]|None:
+        proposals = [
+            self.lookup(request.prompt_ids + request.output_ids, num_tokens) # type: ignore
+            for request in scheduler.rows
+        ]
+        longest = max(len(tokens) for tokens in proposals)
+        if longest == 0:
+            return None
+        draft = torch.tensor([tokens + [0] * (longest - len(tokens))
+            for tokens in proposals], dtype=torch.long)
+        proposed = torch.tensor([[idx < len(tokens) for idx in range(longest)]
+            for tokens in proposals], dtype=torch.bool)
+        device = scheduler.next_tokens.device # type: ignore
+        return draft.to(device), None, proposed.to(device)
+
+    def lookup(self, token_ids: list[int], num_tokens: int) -> list[int]:
+        '''
+        Return up to num_tokens tokens that followed the most recent earlier
+        occurrence of the longest matching ngram at the end of token_ids.
+        '''
+        for n in range(min(self.ngram, len(token_ids) - 1),
+            self.min_ngram - 1, -1):
+            pattern = token_ids[-n:]
+            # Scan backwards for the last token of the pattern first, it is
+            # far cheaper than comparing slices at every position.
+            for end in range(len(token_ids) - 2, n - 2, -1):
+                if token_ids[end] == pattern[-1] and \
+                    token_ids[end - n + 1:end + 1] == pattern:
+                    return token_ids[end + 1:end + 1 + num_tokens]
+        return []
+
+
+def verify_proposals(
+    logits: torch.Tensor,
+    draft: torch.Tensor,
+    draft_probs: torch.Tensor|None,
+    proposed: torch.Tensor,
+    temperature: torch.Tensor,
+    top_p: torch.Tensor,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Speculative sampling. logits [batch, n + 1, vocab] are the target logits
+    after the last token and each of the n draft tokens.
+
+    Draft token i is accepted with probability min(1, p(x) / q(x)) as long as
+    all before it were. The token after the accepted run is sampled from
+    max(0, p - q) at the first rejection, or from p after the last draft
+    token, so outputs follow the target distribution exactly. Deterministic
+    proposals (draft_probs None) have q(x) = 1. Returns the
+    [batch] count of accepted tokens and the [batch, 1] token sampled after
+    them.
+    '''
+    num_tokens = draft.shape[1]
+    p = sampling_probs(logits, temperature, top_p)
+    # Positions without a proposal have q == 0 and sample from p itself.
+    if draft_probs is None:
+        q = torch.zeros_like(p[:, :num_tokens]).scatter_(-1,
+            draft.unsqueeze(-1), proposed.unsqueeze(-1).float())
+    else:
+        q = draft_probs * proposed.unsqueeze(-1)
+    p_draft = p[:, :num_tokens].gather(-1, draft.unsqueeze(-1)).squeeze(-1)
+    q_draft = q.gather(-1, draft.unsqueeze(-1)).squeeze(-1)
+    accept = (torch.rand_like(p_draft) * q_draft < p_draft) & proposed
+    accepted = accept.long().cumprod(dim=1).sum(dim=1)
+
+    residual = torch.cat([(p[:, :num_tokens] - q).clamp(min=0),
+        p[:, num_tokens:]], dim=1)
+    rows = torch.arange(draft.shape[0], device=draft.device)
+    chosen = residual[rows, accepted]
+    chosen = torch.where(chosen.sum(dim=-1, keepdim=True) > 0, chosen,
+        p[rows, accepted])
+    return accepted, torch.multinomial(chosen, 1)
@@ -0,0 +1,127 @@
+import torch
+
+
+class StopSequenceMatcher():
+    '''
+    Decides which sequences of a batch are finished, on the device.
+
+    Token-level stop sequences (of any length) are compared against the tail
+    of every row at once as a tensor suffix comparison, together with EOS and
+    the per-row token budget, so a decode step only needs a single transfer
+    of the sampled tokens and done flags to the host. String-level stop
+    sequences are matched on the decoded text by the scheduler.
+    '''
+    eos_token_id: int|None = None
+    window: int = 1
+
+    def __init__(
+        self,
+        stop_ids: list[list[int]],
+        eos_token_id: int|None=None,
+        stop_strings: list[str]|None=None,
+    ):
+        self.stop_ids = [ids for ids in stop_ids if len(ids) > 0]
+        self.eos_token_id = eos_token_id
+        self.stop_strings = [text for text in stop_strings or [] if text != '']
+        if len(self.stop_ids) > 0:
+            self.window = max(len(ids) for ids in self.stop_ids)
+        self._patterns: dict[torch.device, tuple[torch.Tensor, torch.Tensor]] = {}
+        self._suppress_ids: dict[torch.device, torch.Tensor] = {}
+
+    def patterns(self, device: torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Return the stop sequences right aligned in a [count, window] tensor
+        and the mask of its padding, which matches anything.
+        '''
+        cached = self._patterns.get(device, None)
+        if cached is None:
+            patterns = torch.full((len(self.stop_ids), self.window), -1,
+                dtype=torch.long)
+            for idx, ids in enumerate(self.stop_ids):
+                patterns[idx, self.window - len(ids):] = torch.tensor(ids)
+            cached = (patterns.to(device), (patterns < 0).to(device))
+            self._patterns[device] = cached
+        return cached
+
+    def suppress_ids(self, device: torch.device) -> torch.Tensor:
+        '''
+        The ids that end a sequence by themselves: EOS and every single token
+        stop sequence. Masking them keeps a sequence from finishing. The last
+        token of a longer stop sequence is left alone, as it is usually an
+        ordinary token (the 0 of '!0') that only stops after its prefix.
+        '''
+        cached = self._suppress_ids.get(device, None)
+        if cached is None:
+            ids = {ids[0] for ids in self.stop_ids if len(ids) == 1}
+            if self.eos_token_id is not None:
+                ids.add(self.eos_token_id)
+            cached = torch.tensor(sorted(ids), dtype=torch.long,
+                device=device)
+            self._suppress_ids[device] = cached
+        return cached
+
+    def history_for(
+        self,
+        token_ids: list[int],
+        device: torch.device,
+    ) -> torch.Tensor:
+        '''
+        Build the [1, window] tail of token_ids that __call__ compares against.
+        '''
+        tail = token_ids[-self.window:]
+        return torch.tensor([[-1] * (self.window - len(tail)) + tail],
+            dtype=torch.long, device=device)
+
+    def histories_for(
+        self,
+        token_ids: list[list[int]],
+        device: torch.device,
+    ) -> torch.Tensor:
+        '''
+        Build the [batch, window] tails of several rows in one transfer.
+        '''
+        rows = []
+        for ids in token_ids:
+            tail = ids[-self.window:]
+            rows.append([-1] * (self.window - len(tail)) + tail)
+        return torch.tensor(rows, dtype=torch.long, device=device)
+
+    def __call__(
+        self,
+        history: torch.Tensor,
+        tokens: torch.Tensor,
+        remaining: torch.Tensor,
+    ) -> torch.Tensor:
+        '''
+        history is the [batch, window] tail of every row including the newly
+        sampled tokens [batch], remaining the [batch] tokens each row may
+        still generate. Returns the [batch] done flags.
+        '''
+        done = remaining <= 0
+        if self.eos_token_id is not None:
+            done |= tokens == self.eos_token_id
+        if len(self.stop_ids) > 0:
+            patterns, wildcard = self.patterns(history.device)
+            matched = (history.unsqueeze(1) == patterns.unsqueeze(0)) | \
+                wildcard.unsqueeze(0)
+            done |= matched.all(dim=-1).any(dim=-1)
+        return done
+
+    def match(self, token_ids: list[int]) -> list[int]|None:
+        '''
+        Return the first stop sequence that token_ids ends with, if any.
+        '''
+        for ids in self.stop_ids:
+            if ids == token_ids[-len(ids):]:
+                return ids
+        return None
+
+    def match_text(self, text: str) -> int|None:
+        '''
+        Return the index of the earliest stop string in text, if any.
+        '''
+        found = [text.find(stop) for stop in self.stop_strings]
+        found = [idx for idx in found if idx > -1]
+        if len(found) == 0:
+            return None
+        return min(found)
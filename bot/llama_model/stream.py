@@ -0,0 +1,93 @@
+import asyncio
+
+from typing import TYPE_CHECKING, Any
+
+from .cancellation import CANCEL_ABANDONED, CANCEL_USER
+
+if TYPE_CHECKING:
+    from .batching import GenerationRequest, GenerationResult
+
+
+# How many tokens before the read position are decoded again for context, so
+# that SentencePiece spacing at the start of the new text comes out right.
+DETOKENIZE_CONTEXT_TOKENS = 6
+
+
+class IncrementalDetokenizer():
+    '''
+    Turns a growing list of token ids into text deltas.
+
+    Only a small window of tokens is decoded per new token instead of the
+    whole sequence, and text is held back while it ends in an incomplete
+    UTF-8 sequence (multi-token characters such as emoji).
+    '''
+    def __init__(self, tokenizer: Any, prompt_ids: list[int]):
+        self.tokenizer = tokenizer
+        self.token_ids = list(prompt_ids)
+        self.prefix_offset = max(len(prompt_ids) - DETOKENIZE_CONTEXT_TOKENS, 0)
+        self.read_offset = len(prompt_ids)
+
+    def push(self, token_id: int) -> str:
+        self.token_ids.append(token_id)
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith('�'):
+            return ''
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class TokenStream():
+    '''
+    Async iterator over the text of a generation as it is produced. The
+    GenerationResult, with stop keywords stripped, is available from result()
+    once the iteration ends.
+
+    put() and close() are called from the inference worker thread. A
+    consumer cancelled while waiting for text, for example by a timeout,
+    cancels the generation too.
+    '''
+    def __init__(
+        self,
+        request: 'GenerationRequest',
+        loop: asyncio.AbstractEventLoop,
+    ):
+        self.request = request
+        self.loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def __aiter__(self) -> 'TokenStream':
+        return self
+
+    async def __anext__(self) -> str:
+        try:
+            text = await self._queue.get()
+        except asyncio.CancelledError:
+            self.cancel(CANCEL_ABANDONED)
+            raise
+        if text is None:
+            raise StopAsyncIteration
+        return text
+
+    async def result(self) -> 'GenerationResult':
+        try:
+            return await self.request.future # type: ignore
+        except asyncio.CancelledError:
+            self.cancel(CANCEL_ABANDONED)
+            raise
+
+    def cancel(self, reason: str=CANCEL_USER):
+        '''
+        Stop the generation after its current decode step. result() then
+        gives the text generated so far, finish_reason FINISH_CANCELLED.
+        '''
+        self.request.cancel_token.cancel(reason) # type: ignore
+
+    def put(self, text: str):
+        if text != '':
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, text)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, None)
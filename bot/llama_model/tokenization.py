@@ -0,0 +1,255 @@
+from collections import OrderedDict
+from typing import Any
+
+from transformers import AutoTokenizer
+
+from .stream import DETOKENIZE_CONTEXT_TOKENS
+
+
+DEFAULT_PROMPT_CACHE_ENTRIES = 1024
+
+# Texts the fast tokenizer has to encode and decode exactly like the slow one
+# before it is used, in addition to the prompt templates.
+PARITY_SAMPLES = [
+    'Hello world',
+    ' leading space and trailing space ',
+    'Multiple   spaces\tand\ttabs',
+    'Line one\nLine two\n\nLine four\n',
+    '### Instruction:\nWrite a poem.\n\n### Response:\nRoses are red.',
+    'Unicode: café, naïve, 日本語, Ελληνικά, emoji 🎉👍',
+    'Numbers 1234567890, punctuation !?.,;:()[]{}<>"\'',
+    'https://example.com/path?query=1&other=two',
+    'def f(x):\n    return x * 2\n',
+]
+
+
+def load_tokenizer(
+    model_str: str,
+    use_fast: bool=True,
+    samples: list[str]|None=None,
+) -> Any:
+    '''
+    Load the fast tokenizer of model_str if it encodes and decodes the parity
+    samples exactly like the slow SentencePiece tokenizer, else the slow one.
+    '''
+    slow = AutoTokenizer.from_pretrained(model_str, use_fast=False)
+    if not use_fast:
+        return slow
+    try:
+        fast = AutoTokenizer.from_pretrained(model_str, use_fast=True)
+    except Exception as e:
+        print(f'Could not load a fast tokenizer ({type(e).__name__}: {e}), ' +
+            'using the slow one')
+        return slow
+    if not getattr(fast, 'is_fast', False):
+        return slow
+
+    mismatch = check_parity(slow, fast, PARITY_SAMPLES + (samples or []))
+    if mismatch is not None:
+        print(f'Fast tokenizer differs from the slow one on {mismatch!r}, ' +
+            'using the slow one')
+        return slow
+    print('Using the fast tokenizer.')
+    return fast
+
+
+def check_parity(expected: Any, actual: Any, samples: list[str]) -> str|None:
+    '''
+    Return the first sample that actual tokenizes or detokenizes differently
+    from expected, if any.
+    '''
+    for text in samples:
+        ids = expected.encode(text)
+        if actual.encode(text) != ids or \
+            actual.decode(ids) != expected.decode(ids):
+            return text
+    return None
+
+
+class PromptEncoder():
+    '''
+    Encodes prompts without tokenizing again text that was tokenized before.
+
+    SentencePiece never merges a newline with its neighbours, so the ids of a
+    prompt that extends a known text (a prompt template, or the prompt of the
+    conversation being continued) are the ids of the known text up to its
+    last newline followed by the ids of the rest, and only the rest has to be
+    encoded. The rest is encoded behind a newline so that it does not get the
+    dummy prefix space. Whether this holds for the tokenizer is checked
+    against full encodes of the samples, and if it does not everything is
+    encoded in full.
+
+    Likewise, if the tokenizer decodes prompts back to exactly their text,
+    outputs are decoded from the generated tokens only.
+    '''
+    newline_id: int|None = None
+    bos_text: str|None = None
+    max_entries: int = DEFAULT_PROMPT_CACHE_ENTRIES
+    hits: int = 0
+    misses: int = 0
+    reused_tokens: int = 0
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        templates: list[str]|None=None,
+        max_entries: int=DEFAULT_PROMPT_CACHE_ENTRIES,
+    ):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[str, list[int]]] = OrderedDict()
+        # Longest first, so the most specific template is used.
+        self.templates = [(text, tokenizer.encode(text))
+            for text in sorted(set(templates or []), key=len, reverse=True)]
+
+        self._anchor = tokenizer.encode('\n', add_special_tokens=False)
+        if len(self._anchor) > 0:
+            self.newline_id = self._anchor[-1]
+        samples = PARITY_SAMPLES + [text for text, _ in self.templates]
+        if not self._check_splicing(samples):
+            print('Prompts will be tokenized in full, the tokenizer does ' +
+                'not split on newlines')
+            self.newline_id = None
+        self.bos_text = self._check_round_trip(samples)
+
+    def encode(
+        self,
+        text: str,
+        parent_id: str|None=None,
+        key: str|None=None,
+    ) -> list[int]:
+        '''
+        Encode text, reusing the ids of the text remembered under parent_id
+        or of a template if text starts with it. The result is remembered
+        under key for later prompts extending text.
+        '''
+        base = None
+        if parent_id is not None:
+            base = self.entries.get(parent_id, None)
+            if base is not None and text.startswith(base[0]):
+                self.entries.move_to_end(parent_id)
+            else:
+                base = None
+        if base is None:
+            base = next(((template, ids) for template, ids in self.templates
+                if text.startswith(template)), None)
+
+        ids = None
+        if base is not None:
+            ids = self._extend(text, base[0], base[1])
+        if ids is None:
+            self.misses += 1
+            ids = self.tokenizer.encode(text)
+        else:
+            self.hits += 1
+
+        if key is not None:
+            self.entries[key] = (text, ids)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return ids
+
+    def decode(
+        self,
+        prompt: str,
+        prompt_ids: list[int],
+        output_ids: list[int],
+    ) -> tuple[str, str]:
+        '''
+        Decode the prompt followed by the generated output_ids, as
+        tokenizer.decode(prompt_ids + output_ids) would for the whole prompt,
+        and the generated text on its own. prompt_ids may be a truncated tail
+        of the prompt.
+        '''
+        context = prompt_ids[-DETOKENIZE_CONTEXT_TOKENS:]
+        context_text = self.tokenizer.decode(context)
+        new_text = self.tokenizer.decode(context + output_ids)[
+            len(context_text):]
+        # SentencePiece does not give back leading whitespace.
+        if self.bos_text is None or prompt[:1].isspace():
+            return self.tokenizer.decode(prompt_ids + output_ids), new_text
+        return self.bos_text + prompt + new_text, new_text
+
+    def newline_positions(
+        self,
+        text: str,
+        ids: list[int],
+    ) -> list[int]|None:
+        '''
+        Return the index of the token of every newline in text, or None if
+        they can not be told from ids.
+        '''
+        if self.newline_id is None:
+            return None
+        positions = [idx for idx, token in enumerate(ids)
+            if token == self.newline_id]
+        if len(positions) != text.count('\n'):
+            return None
+        return positions
+
+    def stats(self) -> dict:
+        return {
+            'fast': getattr(self.tokenizer, 'is_fast', False),
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'reused_tokens': self.reused_tokens,
+        }
+
+    def _extend(
+        self,
+        text: str,
+        base_text: str,
+        base_ids: list[int],
+    ) -> list[int]|None:
+        cut = base_text.rfind('\n') + 1
+        if cut == 0:
+            return None
+        positions = self.newline_positions(base_text, base_ids)
+        if positions is None:
+            return None
+        keep = positions[-1] + 1
+        suffix = text[cut:]
+        ids = base_ids[:keep]
+        if suffix != '':
+            suffix_ids = self._encode_after_newline(suffix)
+            if suffix_ids is None:
+                return None
+            ids = ids + suffix_ids
+        self.reused_tokens += keep
+        return ids
+
+    def _encode_after_newline(self, text: str) -> list[int]|None:
+        ids = self.tokenizer.encode('\n' + text, add_special_tokens=False)
+        if ids[:len(self._anchor)] != self._anchor:
+            return None
+        return ids[len(self._anchor):]
+
+    def _check_splicing(self, samples: list[str]) -> bool:
+        if self.newline_id is None:
+            return False
+        for text in samples:
+            cut = text.rfind('\n', 0, len(text) - 1) + 1
+            if cut == 0:
+                continue
+            expected = self.tokenizer.encode(text)
+            base_ids = self.tokenizer.encode(text[:cut])
+            if self._extend(text, text[:cut], base_ids) != expected:
+                return False
+        self.reused_tokens = 0
+        return True
+
+    def _check_round_trip(self, samples: list[str]) -> str|None:
+        probe = 'Hello'
+        decoded = self.tokenizer.decode(self.tokenizer.encode(probe))
+        if not decoded.endswith(probe):
+            return None
+        bos_text = decoded[:-len(probe)]
+        for text in samples:
+            if text[:1].isspace():
+                continue
+            if self.tokenizer.decode(self.tokenizer.encode(text)) != \
+                bos_text + text:
+                return None
+        return bos_text
@@ -0,0 +1,105 @@
+import json
+import logging
+import logging.handlers
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+
+DEFAULT_TRACE_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_TRACE_BACKUPS = 4
+
+
+class TraceLog():
+    '''
+    A local log of finished traces, one JSON object per line, rotated to
+    path.1 .. path.backups once it grows past max_bytes.
+    '''
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int=DEFAULT_TRACE_MAX_BYTES,
+        backups: int=DEFAULT_TRACE_BACKUPS,
+    ):
+        self.path = path
+        handler = logging.handlers.RotatingFileHandler(path,
+            maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._logger = logging.getLogger(f'yal.trace.{path}')
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._logger.addHandler(handler)
+
+    def write(self, record: dict):
+        self._logger.info(json.dumps(record, default=str))
+
+
+_trace_log: TraceLog|None = None
+
+
+def set_trace_log(trace_log: TraceLog|None):
+    '''
+    Write every finished Trace of the process to trace_log, or nowhere if it
+    is None.
+    '''
+    global _trace_log
+    _trace_log = trace_log
+
+
+def make_span(name: str, start: float, seconds: float, **attrs) -> dict:
+    '''
+    A span that was timed elsewhere, start being a time.time().
+    '''
+    return {'name': name, 'start': start, 'seconds': seconds, **attrs}
+
+
+class Trace():
+    '''
+    The named spans of one request, keyed by trace_id (the short id of a
+    prompt). Spans may be added from any thread, for example the spans an
+    engine recorded on its inference worker. finish() writes the trace with
+    span starts as offsets in seconds from the start of the trace.
+    '''
+    def __init__(self, trace_id: str, **attrs):
+        self.trace_id = trace_id
+        self.attrs = attrs
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self._spans: list[dict] = []
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[dict[str, Any]]:
+        '''
+        Time the body as a span. Attributes set on the yielded dict are
+        written with it.
+        '''
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            self.add(make_span(name, start, time.time() - start, **attrs))
+
+    def add(self, span: dict):
+        with self._lock:
+            self._spans.append(span)
+
+    def extend(self, spans: list[dict]):
+        with self._lock:
+            self._spans.extend(spans)
+
+    def finish(self, **attrs):
+        self.attrs.update(attrs)
+        if _trace_log is None:
+            return
+        with self._lock:
+            spans = sorted(self._spans, key=lambda span: span['start'])
+        _trace_log.write({
+            'trace_id': self.trace_id,
+            'time': self.start,
+            'seconds': round(time.time() - self.start, 6),
+            **self.attrs,
+            'spans': [{**span, 'start': round(span['start'] - self.start, 6),
+                'seconds': round(span['seconds'], 6)} for span in spans],
+        })
@@ -0,0 +1,134 @@
+import asyncio
+import queue
+import threading
+import time
+
+from typing import Any, Callable
+
+
+def resolve_future(
+    loop: asyncio.AbstractEventLoop,
+    future: asyncio.Future,
+    result: Any=None,
+    exception: BaseException|None=None,
+):
+    '''
+    Thread-safe completion of an asyncio future owned by another event loop.
+    '''
+    def _resolve():
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    loop.call_soon_threadsafe(_resolve)
+
+
+class InferenceWorker():
+    '''
+    A dedicated thread that owns all blocking model calls. Jobs are submitted
+    from the event loop and awaited without ever blocking it, so discord.py
+    heartbeats and interactions keep running while the model generates.
+
+    If step_fn is set it is called after every round of jobs and should return
+    True while it still has work, in which case the worker keeps stepping
+    instead of sleeping on the job queue. If idle_fn is set it is called every
+    idle_interval seconds while there is no work at all.
+    '''
+    name: str = 'llama-inference'
+    step_fn: Callable[[], bool]|None = None
+    idle_fn: Callable[[], Any]|None = None
+    idle_interval: float = 5.
+    # Seconds spent running jobs and steps, for utilization.
+    busy_seconds: float = 0.
+    started: float = 0.
+
+    def __init__(self, name: str|None=None):
+        if name is not None:
+            self.name = name
+        self._jobs: queue.Queue = queue.Queue()
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name=self.name,
+            daemon=True)
+        self._thread.start()
+
+    async def submit(self, fn: Callable, *args, **kwargs) -> Any:
+        '''
+        Run fn(*args, **kwargs) on the worker thread and await its result.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._jobs.put((fn, args, kwargs, loop, future))
+        return await future
+
+    def call_soon(self, fn: Callable, *args, **kwargs):
+        '''
+        Queue fn(*args, **kwargs) on the worker thread without waiting for it.
+        '''
+        self._jobs.put((fn, args, kwargs, None, None))
+
+    def on_worker_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def shutdown(self):
+        self._jobs.put(None)
+
+    def _run(self):
+        busy = False
+        while True:
+            try:
+                if busy:
+                    job = self._jobs.get_nowait()
+                elif self.idle_fn is not None:
+                    job = self._jobs.get(timeout=self.idle_interval)
+                else:
+                    job = self._jobs.get()
+            except queue.Empty:
+                job = False
+                if not busy and self.idle_fn is not None:
+                    self._run_idle()
+            # Drain everything that arrived since the last step so new work is
+            # admitted at the next step boundary.
+            while job is not False:
+                if job is None:
+                    return
+                self._run_job(job)
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    job = False
+
+            busy = False
+            if self.step_fn is not None:
+                start = time.monotonic()
+                try:
+                    busy = self.step_fn()
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+                self.busy_seconds += time.monotonic() - start
+
+    def _run_idle(self):
+        try:
+            self.idle_fn() # type: ignore
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+    def _run_job(self, job):
+        fn, args, kwargs, loop, future = job
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if future is None:
+                import traceback
+                traceback.print_exc()
+                return
+            resolve_future(loop, future, exception=e)
+        else:
+            if future is not None:
+                resolve_future(loop, future, result=result)
+        finally:
+            self.busy_seconds += time.monotonic() - start
@@ -0,0 +1,10 @@
+from scheduler.fair_share import (
+    FairShareScheduler,
+    Job,
+    SchedulerRejected,
+    REJECT_BUSY,
+    REJECT_DEADLINE,
+    REJECT_QUEUE_FULL,
+    REJECT_USER_LIMIT,
+)
+from scheduler.throughput import ThroughputEstimator
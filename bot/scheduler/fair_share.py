@@ -0,0 +1,357 @@
+import asyncio
+import itertools
+import time
+
+from collections import OrderedDict
+
+from llama_model.metrics import REGISTRY
+from scheduler.ranked import RankedQueue
+from scheduler.throughput import ThroughputEstimator
+
+
+# Prompts are not tokenized before they are scheduled, estimate instead.
+CHARS_PER_TOKEN = 4
+
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_MAX_QUEUED_TOKENS = 32768
+DEFAULT_SHORT_PROMPT_TOKENS = 512
+DEFAULT_LONG_PROMPT_TOKENS = 1536
+DEFAULT_MAX_WAIT_SECONDS = 60.
+# Fraction of the deadline that the estimated generation time may take.
+DEFAULT_DEADLINE_SAFETY = 0.9
+
+PRIORITY_SHORT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LONG = 2
+
+REJECT_BUSY = 'busy'
+REJECT_USER_LIMIT = 'user_limit'
+REJECT_QUEUE_FULL = 'queue_full'
+REJECT_DEADLINE = 'deadline'
+
+QUEUE_WAIT = REGISTRY.histogram('yal_queue_wait_seconds',
+    'Seconds prompts waited in the queue before they were admitted.')
+REJECTED = REGISTRY.counter('yal_queue_rejected_total',
+    'Prompts rejected before queueing, by reason.', ('reason',))
+SHORTENED = REGISTRY.counter('yal_queue_shortened_total',
+    'Prompts whose max tokens were shortened to finish in time.')
+QUEUE_JOBS = REGISTRY.gauge('yal_queue_jobs',
+    'Prompts running or waiting in the queue.', ('state',))
+QUEUE_TOKENS = REGISTRY.gauge('yal_queue_tokens',
+    'Estimated tokens of the prompts running or waiting in the queue.')
+QUEUE_TOKENS_PER_SECOND = REGISTRY.gauge('yal_queue_tokens_per_second',
+    'Rolling estimate of the tokens per second of a single generation.')
+
+
+class SchedulerRejected(Exception):
+    '''
+    A job could not be queued, reason is one of REJECT_BUSY (the user already
+    has a job and may not queue more), REJECT_USER_LIMIT, REJECT_QUEUE_FULL or
+    REJECT_DEADLINE (it would not finish or start in time).
+    '''
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Job():
+    '''
+    A prompt of a user, waiting for or holding one of the scheduler's
+    concurrent slots.
+    '''
+    user_id: str = ''
+    description: str = ''
+    tokens: int = 0
+    max_tokens: int = 0
+    requested_max_tokens: int = 0
+    priority: int = PRIORITY_NORMAL
+    seq: int = 0
+    finish_tag: float = 0.
+    start_tag: float = 0.
+    submitted: float = 0.
+    admitted: bool = False
+    admitted_at: float = 0.
+
+    def __init__(
+        self,
+        user_id: str,
+        description: str,
+        tokens: int,
+        max_tokens: int,
+        requested_max_tokens: int,
+        priority: int,
+        seq: int,
+    ):
+        self.user_id = user_id
+        self.description = description
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.requested_max_tokens = requested_max_tokens
+        self.priority = priority
+        self.seq = seq
+        self.submitted = time.monotonic()
+        self.future: asyncio.Future = \
+            asyncio.get_running_loop().create_future()
+
+    @property
+    def key(self) -> tuple[int, float, int]:
+        return self.priority, self.finish_tag, self.seq
+
+    @property
+    def shortened(self) -> bool:
+        return self.max_tokens < self.requested_max_tokens
+
+
+class FairShareScheduler():
+    '''
+    Decides which prompts run and in what order, across all users.
+
+    At most max_concurrent jobs run at once, and at most max_queued_tokens
+    estimated tokens (prompt and max new tokens) are running or waiting.
+    Every user may have max_per_user jobs, and waiting jobs are ordered by
+    priority class (short prompts first), then by start-time fair queuing
+    over estimated tokens: every job is tagged with the virtual time its user
+    finishes it at, so a user queueing many or long prompts waits behind the
+    prompts of other users instead of in front of them. A job that waited
+    more than max_wait_seconds runs next regardless, so short prompts can
+    not starve long ones.
+
+    With a deadline_seconds, a rolling estimate of the tokens per second of
+    a generation (see record()) decides at submission whether a job can
+    finish within the deadline once it runs. If it can not, its max tokens
+    are shortened to what fits, or it is rejected if fewer than min_tokens
+    fit. A job that would not even start within max_start_eta_seconds is
+    rejected as well. Until enough generations finished to estimate, jobs
+    are queued as they are.
+
+    Queueing, admitting and the position and ETA of a job are O(log n).
+    '''
+    max_concurrent: int = DEFAULT_MAX_CONCURRENT
+    max_queued_tokens: int = DEFAULT_MAX_QUEUED_TOKENS
+    max_per_user: int|None = None
+    short_prompt_tokens: int = DEFAULT_SHORT_PROMPT_TOKENS
+    long_prompt_tokens: int = DEFAULT_LONG_PROMPT_TOKENS
+    max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS
+    deadline_seconds: float|None = None
+    min_tokens: int = 1
+    max_start_eta_seconds: float|None = None
+
+    running: int = 0
+    running_new_tokens: int = 0
+    queued_tokens: int = 0
+    virtual_time: float = 0.
+    admitted_total: int = 0
+    rejected_total: int = 0
+    shortened_total: int = 0
+
+    def __init__(
+        self,
+        max_concurrent: int=DEFAULT_MAX_CONCURRENT,
+        max_queued_tokens: int=DEFAULT_MAX_QUEUED_TOKENS,
+        max_per_user: int|None=None,
+        short_prompt_tokens: int=DEFAULT_SHORT_PROMPT_TOKENS,
+        long_prompt_tokens: int=DEFAULT_LONG_PROMPT_TOKENS,
+        max_wait_seconds: float=DEFAULT_MAX_WAIT_SECONDS,
+        deadline_seconds: float|None=None,
+        min_tokens: int=1,
+        max_start_eta_seconds: float|None=None,
+        throughput: ThroughputEstimator|None=None,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queued_tokens = max_queued_tokens
+        self.max_per_user = max_per_user
+        self.short_prompt_tokens = short_prompt_tokens
+        self.long_prompt_tokens = long_prompt_tokens
+        self.max_wait_seconds = max_wait_seconds
+        self.deadline_seconds = deadline_seconds
+        self.min_tokens = min_tokens
+        self.max_start_eta_seconds = max_start_eta_seconds
+        self.throughput = throughput or ThroughputEstimator()
+        REGISTRY.add_collector(self.collect_metrics)
+        self._seq = itertools.count()
+        self._waiting = RankedQueue()
+        # Waiting jobs in submission order, to find the longest waiting one.
+        self._by_age: OrderedDict[int, Job] = OrderedDict()
+        self._user_jobs: dict[str, dict[int, Job]] = {}
+        self._user_finish: dict[str, float] = {}
+
+    def submit(
+        self,
+        user_id: str,
+        description: str,
+        prompt: str,
+        max_tokens: int,
+    ) -> Job:
+        '''
+        Queue a job, admitting it right away if there is a free slot. Raises
+        SchedulerRejected if a limit does not allow it. The job's max_tokens
+        may be less than max_tokens, to finish within the deadline.
+        '''
+        jobs = self._user_jobs.get(user_id, {})
+        if self.max_per_user is not None and len(jobs) >= self.max_per_user:
+            if self.max_per_user == 1:
+                raise self._reject(REJECT_BUSY,
+                    f'User {user_id} already has a job')
+            raise self._reject(REJECT_USER_LIMIT,
+                f'User {user_id} has {len(jobs)} jobs')
+        requested_max_tokens = max_tokens
+        max_tokens = self._fit_deadline(max_tokens)
+        tokens = len(prompt) // CHARS_PER_TOKEN + max_tokens
+        if self.queued_tokens > 0 and \
+            self.queued_tokens + tokens > self.max_queued_tokens:
+            raise self._reject(REJECT_QUEUE_FULL,
+                f'{self.queued_tokens} tokens are already queued')
+
+        priority = PRIORITY_NORMAL
+        if tokens <= self.short_prompt_tokens:
+            priority = PRIORITY_SHORT
+        elif tokens > self.long_prompt_tokens:
+            priority = PRIORITY_LONG
+        job = Job(user_id, description, tokens, max_tokens,
+            requested_max_tokens, priority, next(self._seq))
+        job.start_tag = max(self.virtual_time,
+            self._user_finish.get(user_id, 0.))
+        job.finish_tag = job.start_tag + tokens
+        if self.max_start_eta_seconds is not None and \
+            self.running >= self.max_concurrent:
+            eta = self._start_eta(job.key)
+            if eta is not None and eta > self.max_start_eta_seconds:
+                raise self._reject(REJECT_DEADLINE,
+                    f'Job would start in {eta:.0f}s')
+        self._user_finish[user_id] = job.finish_tag
+        if job.shortened:
+            self.shortened_total += 1
+            SHORTENED.inc()
+
+        self._user_jobs.setdefault(user_id, {})[job.seq] = job
+        self.queued_tokens += tokens
+        self._waiting.insert(job.key, job, max_tokens)
+        self._by_age[job.seq] = job
+        self._dispatch()
+        return job
+
+    async def wait(self, job: Job, timeout: float|None=None) -> bool:
+        '''
+        Wait until job is admitted, or for at most timeout seconds. Returns
+        whether it was admitted.
+        '''
+        if not job.admitted:
+            await asyncio.wait([job.future], timeout=timeout)
+        return job.admitted
+
+    def position(self, job: Job) -> int|None:
+        '''
+        Return the 1-based place of job among the waiting jobs, or None once
+        it was admitted.
+        '''
+        if job.admitted:
+            return None
+        return self._waiting.rank(job.key) + 1
+
+    def start_eta(self, job: Job) -> float|None:
+        '''
+        Return the estimated seconds until job is admitted, 0 once it was,
+        or None without an estimate of the throughput.
+        '''
+        if job.admitted:
+            return 0.
+        return self._start_eta(job.key)
+
+    def record(self, job: Job, new_tokens: int):
+        '''
+        Account the tokens a finished job generated since it was admitted to
+        the throughput estimate.
+        '''
+        if job.admitted:
+            self.throughput.record(new_tokens,
+                time.monotonic() - job.admitted_at)
+
+    def release(self, job: Job):
+        '''
+        Remove job, whether it finished, failed or never ran, and admit the
+        next ones.
+        '''
+        jobs = self._user_jobs.get(job.user_id, {})
+        if jobs.pop(job.seq, None) is None:
+            return
+        if job.admitted:
+            self.running -= 1
+            self.running_new_tokens -= job.max_tokens
+        else:
+            self._waiting.remove(job.key)
+            del self._by_age[job.seq]
+        self.queued_tokens -= job.tokens
+        if len(jobs) == 0:
+            del self._user_jobs[job.user_id]
+            if self._user_finish.get(job.user_id, 0.) <= self.virtual_time:
+                del self._user_finish[job.user_id]
+        self._dispatch()
+
+    def user_descriptions(self, user_id: str) -> list[str]:
+        jobs = self._user_jobs.get(user_id, {})
+        return [job.description for job in jobs.values()]
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'waiting': len(self._waiting),
+            'queued_tokens': self.queued_tokens,
+            'users': len(self._user_jobs),
+            'admitted_total': self.admitted_total,
+            'rejected_total': self.rejected_total,
+            'shortened_total': self.shortened_total,
+            'tokens_per_second': self.throughput.tokens_per_second,
+        }
+
+    def collect_metrics(self):
+        QUEUE_JOBS.set(self.running, state='running')
+        QUEUE_JOBS.set(len(self._waiting), state='waiting')
+        QUEUE_TOKENS.set(self.queued_tokens)
+        QUEUE_TOKENS_PER_SECOND.set(self.throughput.tokens_per_second or 0.)
+
+    def _reject(self, reason: str, message: str) -> SchedulerRejected:
+        self.rejected_total += 1
+        REJECTED.inc(reason=reason)
+        return SchedulerRejected(reason, message)
+
+    def _fit_deadline(self, max_tokens: int) -> int:
+        rate = self.throughput.tokens_per_second
+        if self.deadline_seconds is None or rate is None:
+            return max_tokens
+        budget = int(rate * self.deadline_seconds * DEFAULT_DEADLINE_SAFETY)
+        if budget >= max_tokens:
+            return max_tokens
+        if budget < self.min_tokens:
+            raise self._reject(REJECT_DEADLINE,
+                f'Only {budget} tokens can be generated in ' +
+                f'{self.deadline_seconds:.0f}s')
+        return budget
+
+    def _start_eta(self, key: tuple[int, float, int]) -> float|None:
+        rate = self.throughput.tokens_per_second
+        if rate is None:
+            return None
+        # Running jobs are half done on average, and every slot frees up for
+        # the next job right away.
+        ahead = self.running_new_tokens / 2 + self._waiting.amount_before(key)
+        return ahead / (rate * self.max_concurrent)
+
+    def _dispatch(self):
+        while self.running < self.max_concurrent and len(self._waiting) > 0:
+            job = next(iter(self._by_age.values()))
+            if time.monotonic() - job.submitted < self.max_wait_seconds:
+                job = self._waiting.first()
+            self._admit(job)
+
+    def _admit(self, job: Job):
+        self._waiting.remove(job.key)
+        del self._by_age[job.seq]
+        self.virtual_time = max(self.virtual_time, job.start_tag)
+        self.running += 1
+        self.running_new_tokens += job.max_tokens
+        self.admitted_total += 1
+        job.admitted = True
+        job.admitted_at = time.monotonic()
+        QUEUE_WAIT.observe(job.admitted_at - job.submitted)
+        if not job.future.done():
+            job.future.set_result(None)
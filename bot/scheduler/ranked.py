@@ -0,0 +1,126 @@
+import random
+
+from typing import Any
+
+
+class _Node():
+    __slots__ = ('key', 'value', 'weight', 'left', 'right', 'size', 'amount',
+        'total')
+
+    def __init__(self, key: Any, value: Any, amount: float):
+        self.key = key
+        self.value = value
+        self.weight = random.random()
+        self.left: '_Node|None' = None
+        self.right: '_Node|None' = None
+        self.size = 1
+        self.amount = amount
+        self.total = amount
+
+
+def _size(node: _Node|None) -> int:
+    return node.size if node is not None else 0
+
+
+def _total(node: _Node|None) -> float:
+    return node.total if node is not None else 0.
+
+
+def _update(node: _Node) -> _Node:
+    node.size = 1 + _size(node.left) + _size(node.right)
+    node.total = node.amount + _total(node.left) + _total(node.right)
+    return node
+
+
+def _split(node: _Node|None, key: Any) -> tuple[_Node|None, _Node|None]:
+    '''
+    Split into the nodes with keys smaller than key and the rest.
+    '''
+    if node is None:
+        return None, None
+    if node.key < key:
+        left, right = _split(node.right, key)
+        node.right = left
+        return _update(node), right
+    left, right = _split(node.left, key)
+    node.left = right
+    return left, _update(node)
+
+
+def _merge(left: _Node|None, right: _Node|None) -> _Node|None:
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.weight > right.weight:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+def _drop_first(node: _Node) -> _Node|None:
+    if node.left is None:
+        return node.right
+    node.left = _drop_first(node.left)
+    return _update(node)
+
+
+class RankedQueue():
+    '''
+    Values ordered by unique, comparable keys, with expected O(log n)
+    insert, remove and rank, the number of keys before a given key. A treap
+    whose nodes count the size of their subtree.
+
+    Every value may carry an amount, and amount_before() sums the amounts of
+    the keys before a given key in the same O(log n).
+    '''
+    def __init__(self):
+        self._root: _Node|None = None
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def insert(self, key: Any, value: Any, amount: float=0.):
+        left, right = _split(self._root, key)
+        self._root = _merge(_merge(left, _Node(key, value, amount)), right)
+
+    def remove(self, key: Any):
+        left, right = _split(self._root, key)
+        if right is not None:
+            node = right
+            while node.left is not None:
+                node = node.left
+            if node.key == key:
+                right = _drop_first(right)
+        self._root = _merge(left, right)
+
+    def first(self) -> Any:
+        node = self._root
+        if node is None:
+            return None
+        while node.left is not None:
+            node = node.left
+        return node.value
+
+    def rank(self, key: Any) -> int:
+        rank = 0
+        node = self._root
+        while node is not None:
+            if node.key < key:
+                rank += _size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return rank
+
+    def amount_before(self, key: Any) -> float:
+        amount = 0.
+        node = self._root
+        while node is not None:
+            if node.key < key:
+                amount += _total(node.left) + node.amount
+                node = node.right
+            else:
+                node = node.left
+        return amount
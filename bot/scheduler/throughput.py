@@ -0,0 +1,48 @@
+from collections import deque
+
+
+DEFAULT_THROUGHPUT_WINDOW = 32
+DEFAULT_THROUGHPUT_MIN_SAMPLES = 4
+
+
+class ThroughputEstimator():
+    '''
+    Rolling tokens per second of a single generation, over the last window
+    generations that finished. Generations are timed from when they were
+    admitted, so prefill and the other rows sharing the batch are accounted
+    for. No estimate is given before min_samples generations finished.
+    '''
+    window: int = DEFAULT_THROUGHPUT_WINDOW
+    min_samples: int = DEFAULT_THROUGHPUT_MIN_SAMPLES
+
+    tokens: int = 0
+    seconds: float = 0.
+
+    def __init__(
+        self,
+        window: int=DEFAULT_THROUGHPUT_WINDOW,
+        min_samples: int=DEFAULT_THROUGHPUT_MIN_SAMPLES,
+    ):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: deque[tuple[int, float]] = deque()
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, tokens: int, seconds: float):
+        if tokens <= 0 or seconds <= 0.:
+            return
+        if len(self._samples) == self.window:
+            old_tokens, old_seconds = self._samples.popleft()
+            self.tokens -= old_tokens
+            self.seconds -= old_seconds
+        self._samples.append((tokens, seconds))
+        self.tokens += tokens
+        self.seconds += seconds
+
+    @property
+    def tokens_per_second(self) -> float|None:
+        if len(self._samples) < self.min_samples or self.seconds <= 0.:
+            return None
+        return self.tokens / self.seconds
@@ -1 +1,2 @@
+from ui.cancel import CancelButton
 from ui.chat import ChatButtons
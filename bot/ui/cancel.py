@@ -0,0 +1,36 @@
+import discord
+
+from llama_model.cancellation import CANCEL_USER, CancellationToken
+
+
+class CancelButton(discord.ui.View):
+    '''
+    Shown on the work message of a prompt while it waits and generates. Only
+    the user who sent the prompt can cancel it. Not persisted, a restart ends
+    the generation anyway.
+    '''
+    cancel_token: CancellationToken|None = None
+    uid: int|None = None
+
+    def __init__(
+        self,
+        *,
+        cancel_token: CancellationToken,
+        timeout=None,
+        uid: int|None=None,
+    ):
+        super().__init__(timeout=timeout)
+        self.cancel_token = cancel_token
+        self.uid = uid
+
+    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger, row=0)
+    async def cancel_button(self, interaction: discord.Interaction,
+        button: discord.ui.Button):
+        if interaction.user.id != self.uid:
+            await interaction.response.send_message(
+                'Only the author of the prompt can cancel it.',
+                ephemeral=True)
+            return
+        self.cancel_token.cancel(CANCEL_USER) # type: ignore
+        button.disabled = True
+        await interaction.response.edit_message(view=self)
@@ -165,9 +165,9 @@ class ChatButtons(discord.ui.View):
                 prompt = ALPACA_INSTRUCT_STRING + prompt + ALPACA_ANSWER_STRING
                 prompt = ALPACA_PREFIX_NO_INPUT_STRING + prompt
 
-                final_prompt = original_prompt + '\n' + original_answer[:-1] + '\n' + prompt
+                final_prompt = original_prompt + original_answer[:-1] + '\n' + prompt
             if prompt == '':
-                final_prompt = original_prompt + '\n' + original_answer[:-1]
+                final_prompt = original_prompt + original_answer[:-1]
         else:
             if self.prompt_input_element.value: # type: ignore
                 prompt = self.prompt_input_element.value # type: ignore
@@ -187,6 +187,7 @@ class ChatButtons(discord.ui.View):
             final_prompt,
             bypass_alpaca_formatting=True,
             max_tokens=settings_dict['max_tokens'], # type: ignore
+            parent_short_id=self.short_id_parent,
             temperature=settings_dict['temperature'], # type: ignore
             top_p=settings_dict['top_p']) # type: ignore
 
@@ -10,10 +10,17 @@ import discord
 
 if TYPE_CHECKING:
     from client import YALClient
+    from scheduler import Job
 
 from constants import (
     ID_LENGTH,
 )
+from scheduler import (
+    REJECT_BUSY,
+    REJECT_DEADLINE,
+    REJECT_USER_LIMIT,
+    SchedulerRejected,
+)
 
 
 random.seed()
@@ -32,31 +39,31 @@ async def check_queue_and_maybe_write_to(
     channel: discord.abc.GuildChannel,
     author_id: str,
     queue_message: str,
-) -> bool:
-    queue_for_user = context.currently_fetching_ai_text.get(author_id, False)
-    queue_not_empty = queue_for_user is not False # type: ignore
-    max_queue = context.cli_args.max_queue
-    if not context.cli_args.allow_queue and queue_not_empty:
-        await channel.send(f'Sorry, I am currently working on the text prompt(s) "{context.currently_fetching_ai_text[author_id]}". Please be patient until I finish that.', # type: ignore
-            delete_after=5)
-        return False
-    if context.cli_args.allow_queue and \
-        queue_not_empty and \
-        isinstance(queue_for_user, list) and \
-        max_queue is not None and \
-        len(queue_for_user) >= max_queue:
-        await channel.send(f'Sorry, I am currently working on the text prompt(s) "{context.currently_fetching_ai_text[author_id]}" and you are presently at your limit of {max_queue} simultaneous actions. Please be patient until I finish that.', # type: ignore
-            delete_after=5)
-        return False
-
-    if context.cli_args.allow_queue:
-        if isinstance(queue_for_user, list):
-            context.currently_fetching_ai_text[author_id].append(queue_message)
+    prompt: str,
+    max_tokens: int,
+) -> 'Job|None':
+    '''
+    Queue a prompt with the scheduler and return its job, or tell the user
+    why it can not be queued and return None.
+    '''
+    try:
+        return context.scheduler.submit(author_id, queue_message, prompt, # type: ignore
+            max_tokens)
+    except SchedulerRejected as e:
+        working_on = context.scheduler.user_descriptions(author_id) # type: ignore
+        if e.reason == REJECT_BUSY:
+            await channel.send(f'Sorry, I am currently working on the text prompt(s) "{working_on}". Please be patient until I finish that.', # type: ignore
+                delete_after=5)
+        elif e.reason == REJECT_DEADLINE:
+            await channel.send('Sorry, I am too busy to finish this prompt in time right now. Please try again in a little while, or with fewer tokens.',
+                delete_after=5)
+        elif e.reason == REJECT_USER_LIMIT:
+            await channel.send(f'Sorry, I am currently working on the text prompt(s) "{working_on}" and you are presently at your limit of {context.scheduler.max_per_user} simultaneous actions. Please be patient until I finish that.', # type: ignore
+                delete_after=5)
         else:
-            context.currently_fetching_ai_text[author_id] = [queue_message]
-    else:
-        context.currently_fetching_ai_text[author_id] = queue_message # type: ignore
-    return True
+            await channel.send('Sorry, I have too much work queued right now. Please try again in a little while.',
+                delete_after=5)
+        return None
 
 
 async def check_restricted_to_channel(
@@ -89,22 +96,17 @@ async def check_user_joined_at(
 
 def complete_request(
     context: 'YALClient',
-    author_id: str,
-    queue_message: str,
+    job: 'Job',
+    new_tokens: int|None=None,
 ):
     '''
-    Complete a request for a user. If the user has a string in the queue (queue
-    is not enable), it sets the value to False. If the user has a list of
-    strings in the queue, it attempts to remove the message from the list,
-    then, if empty, sets the value to False.
+    Complete a request for a user, giving its slot to the next queued job.
+    new_tokens, if it finished generating, goes into the scheduler's
+    throughput estimate.
     '''
-    queue_for_user = context.currently_fetching_ai_text.get(author_id, False)
-    if queue_for_user is not False and isinstance(queue_for_user, str):
-        context.currently_fetching_ai_text[author_id] = False
-    if queue_for_user is not False and isinstance(queue_for_user, list):
-        context.currently_fetching_ai_text[author_id].remove(queue_message)
-        if len(context.currently_fetching_ai_text[author_id]) == 0:
-            context.currently_fetching_ai_text[author_id] = False
+    if new_tokens is not None:
+        context.scheduler.record(job, new_tokens) # type: ignore
+    context.scheduler.release(job) # type: ignore
 
 
 def prompt_contains_nsfw(